@@ -503,6 +503,25 @@ CONTAINER_EXEC_DOCKER_TLSCERT = os.environ.get(
 CONTAINER_EXEC_DOCKER_TLSKEY = os.environ.get(
     "CONTAINER_EXEC_DOCKER_TLSKEY", ""
 )
+# The docker hosts that execute the containers, a comma separated list of
+# base urls that use the tls settings above
+CONTAINER_EXEC_DOCKER_HOSTS = [
+    url.strip()
+    for url in os.environ.get(
+        "CONTAINER_EXEC_DOCKER_HOSTS", CONTAINER_EXEC_DOCKER_BASE_URL
+    ).split(",")
+    if url.strip()
+]
+# How long, in seconds, the health of a docker host is cached for
+CONTAINER_EXEC_HOST_CHECK_INTERVAL = 30
+# How a job is placed on the docker hosts where it fits, after the hosts that
+# have its image, either "least_loaded" or "best_fit"
+CONTAINER_EXEC_HOST_SELECTION = os.environ.get(
+    "CONTAINER_EXEC_HOST_SELECTION", "least_loaded"
+)
+# How long, in seconds, a shared docker client can be idle before its
+# connection is checked
+CONTAINER_EXEC_DOCKER_CLIENT_CHECK_INTERVAL = 60
 CONTAINER_EXEC_MEMORY_LIMIT = "4g"
 CONTAINER_EXEC_IO_IMAGE = "alpine:3.8"
 CONTAINER_EXEC_IO_SHA256 = (
@@ -510,6 +529,39 @@ CONTAINER_EXEC_IO_SHA256 = (
 )
 CONTAINER_EXEC_CPU_QUOTA = 100000
 CONTAINER_EXEC_CPU_PERIOD = 100000
+# The limits of the io helper container, which runs next to the exec
+# container for the whole job and is not counted in its reservation
+CONTAINER_EXEC_IO_MEMORY_LIMIT = "256m"
+CONTAINER_EXEC_IO_CPU_QUOTA = 20000
+# The resources of each execution host that can be reserved by jobs. The
+# memory and cpu cores are read from the docker host if they are not set,
+# the gpu memory is not limited if it is not set.
+CONTAINER_EXEC_HOST_MEMORY_GB = (
+    float(os.environ["CONTAINER_EXEC_HOST_MEMORY_GB"])
+    if "CONTAINER_EXEC_HOST_MEMORY_GB" in os.environ
+    else None
+)
+CONTAINER_EXEC_HOST_CPU_CORES = (
+    float(os.environ["CONTAINER_EXEC_HOST_CPU_CORES"])
+    if "CONTAINER_EXEC_HOST_CPU_CORES" in os.environ
+    else None
+)
+CONTAINER_EXEC_HOST_GPU_MEMORY_GB = (
+    float(os.environ["CONTAINER_EXEC_HOST_GPU_MEMORY_GB"])
+    if "CONTAINER_EXEC_HOST_GPU_MEMORY_GB" in os.environ
+    else None
+)
+# How long, in seconds, a job waits before it tries again to reserve the
+# resources that it requires, and how many times it tries
+CONTAINER_EXEC_CAPACITY_RETRY_DELAY = 30
+CONTAINER_EXEC_CAPACITY_MAX_RETRIES = 240
+# How long the presence of an image on the execution host is cached for
+CONTAINER_EXEC_IMAGE_PRESENCE_TIMEOUT = 60 * 10
+# The disk space, in bytes, that the images loaded for jobs can use on the
+# execution host before the least recently used images are removed
+CONTAINER_EXEC_IMAGE_DISK_BUDGET = 100 * 2 ** 30
+# The maximum size, in bytes, of a file that is read from a container
+CONTAINER_EXEC_MAX_OUTPUT_FILE_SIZE = 10 * 2 ** 30
 
 CELERY_BEAT_SCHEDULE = {
     "cleanup_stale_uploads": {
@@ -528,10 +580,21 @@ CELERY_BEAT_SCHEDULE = {
         "task": "grandchallenge.challenges.tasks.check_external_challenge_urls",
         "schedule": timedelta(days=1),
     },
+    "evict_docker_images": {
+        "task": "grandchallenge.container_exec.tasks.evict_docker_images",
+        "schedule": timedelta(hours=1),
+    },
+    "cleanup_docker_objects": {
+        "task": "grandchallenge.container_exec.tasks.cleanup_docker_objects",
+        "schedule": timedelta(hours=1),
+    },
 }
 
 CELERY_TASK_ROUTES = {
-    "grandchallenge.container_exec.tasks.execute_job": "evaluation"
+    "grandchallenge.container_exec.tasks.execute_job": "evaluation",
+    "grandchallenge.container_exec.tasks.load_docker_image": "evaluation",
+    "grandchallenge.container_exec.tasks.evict_docker_images": "evaluation",
+    "grandchallenge.container_exec.tasks.cleanup_docker_objects": "evaluation",
 }
 
 # Set which template pack to use for forms
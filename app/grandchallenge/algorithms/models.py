@@ -10,11 +10,7 @@ from django.utils import timezone
 from django.utils.text import slugify
 
 from grandchallenge.cases.models import RawImageUploadSession, RawImageFile
-from grandchallenge.container_exec.backends.docker import (
-    Executor,
-    cleanup,
-    get_file,
-)
+from grandchallenge.container_exec.backends.docker import Executor
 from grandchallenge.container_exec.models import (
     ContainerExecJobModel,
     ContainerImageModel,
@@ -66,20 +62,9 @@ class AlgorithmExecutor(Executor):
         """
 
         try:
-            with cleanup(
-                self._client.containers.run(
-                    image=self._io_image,
-                    volumes={
-                        self._output_volume: {"bind": "/output/", "mode": "ro"}
-                    },
-                    detach=True,
-                    tty=True,
-                    **self._run_kwargs,
-                )
-            ) as reader:
-                self._copy_output_files(
-                    container=reader, base_dir=Path(self.output_images_dir)
-                )
+            self._copy_output_files(
+                container=self._helper, base_dir=Path(self.output_images_dir)
+            )
         except Exception as exc:
             raise RuntimeError(str(exc))
 
@@ -113,7 +98,7 @@ class AlgorithmExecutor(Executor):
         for file in output_files:
             new_uuid = uuid.uuid4()
 
-            django_file = File(get_file(container=container, src=file))
+            django_file = File(self._get_file(src=file))
 
             staged_file = StagedFile(
                 csrf="staging_conversion_csrf",
@@ -147,6 +132,8 @@ class Job(UUIDModel, ContainerExecJobModel):
     algorithm = models.ForeignKey(Algorithm, on_delete=models.CASCADE)
     image = models.ForeignKey("cases.Image", on_delete=models.CASCADE)
 
+    container_image_sha256_lookup = "algorithm__image_sha256"
+
     @property
     def container(self):
         return self.algorithm
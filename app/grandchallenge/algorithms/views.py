@@ -9,6 +9,7 @@ from grandchallenge.algorithms.forms import AlgorithmForm
 from grandchallenge.algorithms.models import Algorithm
 from grandchallenge.cases.forms import UploadRawImagesForm
 from grandchallenge.cases.models import RawImageUploadSession
+from grandchallenge.container_exec.models import get_phase_timings
 from grandchallenge.core.permissions.mixins import UserIsStaffMixin
 from grandchallenge.subdomains.utils import reverse
 
@@ -53,6 +54,18 @@ class AlgorithmCreate(UserIsStaffMixin, CreateView):
 class AlgorithmDetail(UserIsStaffMixin, DetailView):
     model = Algorithm
 
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(*args, **kwargs)
+
+        timed_jobs, phase_timings = get_phase_timings(
+            jobs=self.object.job_set.all()
+        )
+        context.update(
+            {"timed_jobs": timed_jobs, "phase_timings": phase_timings}
+        )
+
+        return context
+
 
 class AlgorithmExecutionSessionCreate(
     UserIsStaffMixin, SuccessMessageMixin, CreateView
@@ -0,0 +1,176 @@
+"""
+A registry of the docker clients of this process. The clients are shared
+between jobs so that the connections to a docker host are kept alive,
+rather than a client and its connection pool being created for each job.
+
+A client that is not used for CONTAINER_EXEC_DOCKER_CLIENT_CHECK_INTERVAL
+seconds is checked with a ping before it is handed out again, and replaced
+if the docker host cannot be reached. Clients are not shared across a fork,
+as the forked process cannot safely use the connections of its parent.
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from typing import Dict, NamedTuple
+
+import docker
+from django.conf import settings
+from docker.errors import APIError
+from docker.tls import TLSConfig
+from requests import RequestException
+
+logger = logging.getLogger(__name__)
+
+
+class ClientKey(NamedTuple):
+    base_url: str
+    tls_verify: bool = False
+    tls_ca_cert: str = ""
+    tls_cert: str = ""
+    tls_key: str = ""
+
+
+class _Entry(NamedTuple):
+    client: docker.DockerClient
+    pid: int
+    checked: float
+
+
+_lock = threading.Lock()
+_clients = {}  # type: Dict[ClientKey, _Entry]
+_stats = {}  # type: Dict[ClientKey, Counter]
+
+
+def get_client(*, key: ClientKey) -> docker.DockerClient:
+    """
+    Gets the shared client for a docker host, creating it if needed.
+
+    :param key: The base url and tls settings of the docker host
+    :return: The docker client
+    """
+    with _lock:
+        stats = _stats.setdefault(key, Counter())
+        entry = _clients.get(key)
+
+        if entry is not None and entry.pid != os.getpid():
+            # Created before this process was forked
+            entry = None
+
+        if entry is not None and time.monotonic() - entry.checked <= (
+            settings.CONTAINER_EXEC_DOCKER_CLIENT_CHECK_INTERVAL
+        ):
+            stats["reused"] += 1
+            return entry.client
+
+        if entry is not None:
+            # The other threads keep using the client while it is checked
+            _clients[key] = entry._replace(checked=time.monotonic())
+
+    # The lock is not held while the docker host is pinged, so that a slow
+    # or unreachable host does not block the clients of the other hosts
+    alive = entry is not None and _is_alive(client=entry.client)
+
+    with _lock:
+        current = _clients.get(key)
+
+        if current is not None and current.pid != os.getpid():
+            current = None
+        elif (
+            entry is not None
+            and not alive
+            and current is not None
+            and current.client is entry.client
+        ):
+            logger.warning(f"Reconnecting to docker at {key.base_url}")
+            entry.client.close()
+            current = None
+            stats["reconnects"] += 1
+
+        if current is None:
+            current = _Entry(
+                client=_create_client(key=key),
+                pid=os.getpid(),
+                checked=time.monotonic(),
+            )
+            _clients[key] = current
+            stats["created"] += 1
+        else:
+            stats["reused"] += 1
+
+        return current.client
+
+
+def _create_client(*, key: ClientKey) -> docker.DockerClient:
+    client_kwargs = {"base_url": key.base_url}
+
+    if key.tls_verify:
+        client_kwargs["tls"] = TLSConfig(
+            verify=True,
+            client_cert=(key.tls_cert, key.tls_key),
+            ca_cert=key.tls_ca_cert,
+        )
+
+    return docker.DockerClient(**client_kwargs)
+
+
+def _is_alive(*, client: docker.DockerClient) -> bool:
+    try:
+        return client.ping()
+    except (APIError, RequestException):
+        return False
+
+
+def get_client_stats() -> Dict[str, Dict[str, int]]:
+    """
+    Gets the statistics of the clients of this process, keyed by the base
+    url of the docker host. Created, reused and reconnects count the
+    requests for a client, connections and requests are the totals of its
+    connection pools, and idle is the number of connections that are kept
+    alive.
+    """
+    stats = {}
+
+    with _lock:
+        for key, counts in _stats.items():
+            host_stats = stats.setdefault(key.base_url, Counter())
+            host_stats.update(counts)
+
+            entry = _clients.get(key)
+
+            if entry is not None and entry.pid == os.getpid():
+                host_stats.update(_get_pool_stats(client=entry.client))
+
+    return {k: dict(v) for k, v in stats.items()}
+
+
+def log_client_stats():
+    """ Logs the statistics of the clients of this process, eg. after a job """
+    for base_url, stats in sorted(get_client_stats().items()):
+        logger.info(
+            f"Docker client for {base_url}: "
+            + " ".join(f"{k}={v}" for k, v in sorted(stats.items()))
+        )
+
+
+def _get_pool_stats(*, client: docker.DockerClient) -> Counter:
+    stats = Counter()
+
+    for adapter in client.api.adapters.values():
+        # The unix socket adapter manages its own pools
+        pools = getattr(adapter, "pools", None)
+
+        if pools is None:
+            pools = adapter.poolmanager.pools
+
+        for pool_key in pools.keys():
+            pool = pools[pool_key]
+            stats["connections"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+            # The queue of a pool is padded with None up to its size
+            stats["idle"] += sum(
+                conn is not None for conn in list(pool.pool.queue)
+            )
+
+    return stats
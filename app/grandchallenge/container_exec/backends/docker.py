@@ -1,23 +1,47 @@
 import io
 import json
+import logging
 import os
+import shutil
 import tarfile
+import tempfile
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from json import JSONDecodeError
 from pathlib import Path
-from random import randint
-from time import sleep
-from typing import Tuple
+from typing import Tuple, Iterator, Dict, List, Iterable
 
 import docker
 from django.conf import settings
 from django.core.files import File
 from docker.api.container import ContainerApiMixin
-from docker.errors import ContainerError, APIError
-from docker.tls import TLSConfig
+from docker.errors import ContainerError, APIError, NotFound
 from requests import HTTPError
 
+from grandchallenge.container_exec.backends.clients import (
+    ClientKey,
+    get_client,
+)
+from grandchallenge.container_exec.backends.images import (
+    ensure_image,
+    ensure_io_image,
+)
+from grandchallenge.container_exec.backends.resources import (
+    Resources,
+    get_run_kwargs,
+)
+
+logger = logging.getLogger(__name__)
+
+# The size of the chunks of files that are streamed to and from containers
+CHUNK_SIZE = 2 ** 20
+# The number of docker objects that are removed at the same time
+REMOVAL_WORKERS = 4
+# The phases of a job that are timed by the executor, in order
+PHASES = ("image", "input", "execution", "output", "teardown")
+
 
 class Executor(object):
     def __init__(
@@ -28,6 +52,8 @@ class Executor(object):
         exec_image: File,
         exec_image_sha256: str,
         results_file: Path,
+        requirements: Resources = None,
+        docker_base_url: str = None,
     ):
         super().__init__()
         self._job_id = str(job_id)
@@ -36,24 +62,24 @@ class Executor(object):
         self._exec_image_sha256 = exec_image_sha256
         self._io_image = settings.CONTAINER_EXEC_IO_IMAGE
         self._results_file = results_file
+        self._client = get_docker_client(base_url=docker_base_url)
 
-        client_kwargs = {"base_url": settings.CONTAINER_EXEC_DOCKER_BASE_URL}
+        # The io helper container of the running job
+        self._helper = None
 
-        if settings.CONTAINER_EXEC_DOCKER_TLSVERIFY:
-            tlsconfig = TLSConfig(
-                verify=True,
-                client_cert=(
-                    settings.CONTAINER_EXEC_DOCKER_TLSCERT,
-                    settings.CONTAINER_EXEC_DOCKER_TLSKEY,
-                ),
-                ca_cert=settings.CONTAINER_EXEC_DOCKER_TLSCACERT,
-            )
-            client_kwargs.update({"tls": tlsconfig})
+        # The names of the containers and volumes created for this job,
+        # which are removed when the job exits
+        self._containers = []  # type: List[str]
+        self._volumes = []  # type: List[str]
 
-        self._client = docker.DockerClient(**client_kwargs)
+        # The wall time and bytes moved of each phase of the job
+        self.timings = {}  # type: Dict[str, Dict[str, float]]
+        self._phase_timing = None
 
         self._input_volume = f"{self._job_id}-input"
         self._output_volume = f"{self._job_id}-output"
+        self._io_container = f"{self._job_id}-io"
+        self._exec_container = f"{self._job_id}-exec"
 
         self._run_kwargs = {
             "labels": {"job_id": self._job_id},
@@ -63,100 +89,192 @@ class Executor(object):
             "cpu_quota": settings.CONTAINER_EXEC_CPU_QUOTA,
         }
 
+        if requirements is not None:
+            # Limit the containers to the resources reserved for this job
+            self._run_kwargs.update(get_run_kwargs(requirements))
+
+        # The io helper only copies files, so it gets small fixed limits
+        # rather than the limits of the job
+        self._io_run_kwargs = {
+            "labels": self._run_kwargs["labels"],
+            "network_disabled": True,
+            "mem_limit": settings.CONTAINER_EXEC_IO_MEMORY_LIMIT,
+            "cpu_period": settings.CONTAINER_EXEC_CPU_PERIOD,
+            "cpu_quota": settings.CONTAINER_EXEC_IO_CPU_QUOTA,
+        }
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        flt = {"label": f"job_id={self._job_id}"}
+        with self._phase("teardown"):
+            remove_docker_objects(
+                client=self._client,
+                containers=self._containers,
+                volumes=self._volumes,
+            )
 
-        for container in self._client.containers.list(filters=flt):
-            container.stop()
+    def execute(self) -> dict:
+        with self._phase("image"):
+            self._pull_images()
 
-        self.__retry_docker_obj_prune(obj=self._client.containers, filters=flt)
-        self.__retry_docker_obj_prune(obj=self._client.volumes, filters=flt)
+        with self._phase("input"):
+            self._remove_stale_objects()
+            self._create_io_volumes()
+            # One helper container is used for all of the io of this job
+            self._helper = self._start_io_helper()
 
-    @staticmethod
-    def __retry_docker_obj_prune(*, obj, filters: dict):
-        # Retry and exponential backoff of the prune command as only 1 prune
-        # operation can occur at a time on a docker host
-        num_retries = 0
-        e = APIError
-        while num_retries < 3:
-            try:
-                obj.prune(filters=filters)
-                break
-            except (APIError, HTTPError) as e:
-                num_retries += 1
-                sleep((2 ** num_retries) + (randint(0, 1000) / 1000))
-        else:
-            raise e
+        try:
+            with self._phase("input") as timing:
+                self._provision_input_volume()
+                self._chmod_output()
+                timing["bytes"] += sum(f.size for f in self._input_files)
+
+            with self._phase("execution"):
+                self._execute_container()
+
+            with self._phase("output"):
+                return self._get_result()
+        finally:
+            with self._phase("teardown"):
+                self._helper.remove(force=True)
+
+    @contextmanager
+    def _phase(self, name: str):
+        """ Adds the wall time of the block to the timing of a phase """
+        timing = self.timings.setdefault(name, {"seconds": 0.0, "bytes": 0})
+        self._phase_timing = timing
+        start = time.monotonic()
 
-    def execute(self) -> dict:
-        self._pull_images()
-        self._create_io_volumes()
-        self._provision_input_volume()
-        self._chmod_output()
-        self._execute_container()
-        return self._get_result()
+        try:
+            yield timing
+        finally:
+            timing["seconds"] += time.monotonic() - start
+            self._phase_timing = None
 
     def _pull_images(self):
-        self._client.images.pull(repository=self._io_image)
+        ensure_io_image(client=self._client)
+        loaded = ensure_image(
+            client=self._client,
+            sha256=self._exec_image_sha256,
+            image=self._exec_image,
+        )
+
+        if loaded:
+            self._phase_timing["bytes"] += self._exec_image.size
+
+    def _get_file(self, *, src: Path):
+        """
+        Gets a file from the io helper container, and counts its size for
+        the current phase
+        """
+        f = get_file(container=self._helper, src=src)
+
+        if self._phase_timing is not None:
+            f.seek(0, os.SEEK_END)
+            self._phase_timing["bytes"] += f.tell()
+            f.seek(0)
 
-        if self._exec_image_sha256 not in [
-            img.id for img in self._client.images.list()
-        ]:
-            with self._exec_image.open("rb") as f:
-                self._client.images.load(f)
+        return f
+
+    def _remove_stale_objects(self):
+        """
+        Removes the containers and volumes that are left over from an earlier
+        attempt of this job, eg. when the task was redelivered after its
+        worker was lost, as the names of the containers would conflict and
+        the volumes could hold the files of that attempt.
+        """
+        failed = remove_docker_objects(
+            client=self._client,
+            containers=[self._io_container, self._exec_container],
+            volumes=[self._input_volume, self._output_volume],
+        )
+
+        if failed:
+            raise RuntimeError(
+                f"Could not remove the docker objects of an earlier attempt "
+                f"of this job: {', '.join(failed)}"
+            )
 
     def _create_io_volumes(self):
         for volume in [self._input_volume, self._output_volume]:
+            self._volumes.append(volume)
             self._client.volumes.create(
                 name=volume, labels=self._run_kwargs["labels"]
             )
 
+    def _start_io_helper(self) -> ContainerApiMixin:
+        """
+        Starts a container with both of the io volumes mounted, which is used
+        to write the input files, set the permissions and read the result.
+        """
+        self._containers.append(self._io_container)
+
+        try:
+            return self._client.containers.run(
+                name=self._io_container,
+                image=self._io_image,
+                volumes={
+                    self._input_volume: {"bind": "/input/", "mode": "rw"},
+                    self._output_volume: {"bind": "/output/", "mode": "rw"},
+                },
+                detach=True,
+                tty=True,
+                **self._io_run_kwargs,
+            )
+        except Exception as exc:
+            raise RuntimeError(str(exc))
+
     def _provision_input_volume(self):
         try:
-            with cleanup(
-                self._client.containers.run(
-                    image=self._io_image,
-                    volumes={
-                        self._input_volume: {"bind": "/input/", "mode": "rw"}
-                    },
-                    detach=True,
-                    tty=True,
-                    **self._run_kwargs,
-                )
-            ) as writer:
-                self._copy_input_files(writer=writer)
+            self._copy_input_files(writer=self._helper)
         except Exception as exc:
             raise RuntimeError(str(exc))
 
     def _copy_input_files(self, writer):
-        for file in self._input_files:
-            put_file(
-                container=writer,
-                src=file,
-                dest=f"/input/{Path(file.name).name}",
-            )
+        self._put_input_files(
+            writer=writer,
+            files={Path(f.name).name: f for f in self._input_files},
+            dest="/input/",
+        )
+
+    def _put_input_files(
+        self, *, writer: ContainerApiMixin, files: Dict[str, File], dest: str
+    ):
+        """
+        Writes the input files to a directory in the writer with a single
+        archive. The number of files and the time of the transfer are added
+        to the timing of the input phase.
+        """
+        stats = put_files(container=writer, files=files, dest=dest)
+
+        timing = self.timings.setdefault("input", {"seconds": 0.0, "bytes": 0})
+        timing["files"] = timing.get("files", 0) + stats["files"]
+        timing["transfer_seconds"] = (
+            timing.get("transfer_seconds", 0.0) + stats["seconds"]
+        )
+
+        throughput = stats["bytes"] / max(stats["seconds"], 1e-6) / 2 ** 20
+
+        logger.info(
+            f"Provisioned {stats['files']} input files ({stats['bytes']} "
+            f"bytes) for job {self._job_id} in {stats['seconds']:.3f}s "
+            f"({throughput:.1f} MB/s)"
+        )
 
     def _chmod_output(self):
         """ Ensure that the output is writable """
-        try:
-            self._client.containers.run(
-                image=self._io_image,
-                volumes={
-                    self._output_volume: {"bind": "/output/", "mode": "rw"}
-                },
-                command="chmod 777 /output/",
-                remove=True,
-                **self._run_kwargs,
-            )
-        except Exception as exc:
-            raise RuntimeError(str(exc))
+        result = self._helper.exec_run("chmod 777 /output/")
+
+        if result.exit_code != 0:
+            raise RuntimeError(result.output.decode())
 
     def _execute_container(self):
+        self._containers.append(self._exec_container)
+
         try:
             self._client.containers.run(
+                name=self._exec_container,
                 image=self._exec_image_sha256,
                 volumes={
                     self._input_volume: {"bind": "/input/", "mode": "rw"},
@@ -171,22 +289,11 @@ class Executor(object):
     def _get_result(self) -> dict:
         """
         Read and parse the created results file. Due to a bug in the docker
-        client, copy the file to memory first rather than cat and read
+        client, copy the file out of the container rather than cat and read
         stdout.
         """
         try:
-            with cleanup(
-                self._client.containers.run(
-                    image=self._io_image,
-                    volumes={
-                        self._output_volume: {"bind": "/output/", "mode": "ro"}
-                    },
-                    detach=True,
-                    tty=True,
-                    **self._run_kwargs,
-                )
-            ) as reader:
-                result = get_file(container=reader, src=self._results_file)
+            result = self._get_file(src=self._results_file)
         except Exception as e:
             raise RuntimeError(str(e))
 
@@ -201,10 +308,75 @@ class Executor(object):
         return result
 
 
+def get_docker_client(*, base_url: str = None) -> docker.DockerClient:
+    """
+    Gets the client for a docker host that executes the containers, which
+    is shared by the jobs of this process.
+
+    :param base_url: The url of the docker host, defaults to
+        CONTAINER_EXEC_DOCKER_BASE_URL
+    :return: The docker client
+    """
+    if base_url is None:
+        base_url = settings.CONTAINER_EXEC_DOCKER_BASE_URL
+
+    return get_client(
+        key=ClientKey(
+            base_url=base_url,
+            tls_verify=settings.CONTAINER_EXEC_DOCKER_TLSVERIFY,
+            tls_ca_cert=settings.CONTAINER_EXEC_DOCKER_TLSCACERT,
+            tls_cert=settings.CONTAINER_EXEC_DOCKER_TLSCERT,
+            tls_key=settings.CONTAINER_EXEC_DOCKER_TLSKEY,
+        )
+    )
+
+
+def remove_docker_objects(
+    *,
+    client: docker.DockerClient,
+    containers: Iterable[str] = (),
+    volumes: Iterable[str] = (),
+) -> List[str]:
+    """
+    Removes containers and volumes by name or id. The removals run
+    concurrently, the containers are removed before the volumes as a volume
+    cannot be removed while it is in use. Objects that no longer exist are
+    skipped, and a failed removal is logged rather than raised so that the
+    other objects are still removed.
+
+    :param client: The docker client
+    :param containers: The names or ids of the containers
+    :param volumes: The names of the volumes
+    :return: The names of the objects that could not be removed
+    """
+    failed = []
+
+    def remove(func, name):
+        try:
+            func(name, force=True)
+        except NotFound:
+            pass
+        except (APIError, HTTPError) as e:
+            logger.warning(f"Could not remove docker object {name}: {e}")
+            failed.append(name)
+
+    with ThreadPoolExecutor(max_workers=REMOVAL_WORKERS) as pool:
+        for func, names in (
+            (client.api.remove_container, containers),
+            (client.api.remove_volume, volumes),
+        ):
+            # Wait for each group to finish before the next one starts
+            list(pool.map(lambda n: remove(func, n), names))
+
+    return failed
+
+
 @contextmanager
 def cleanup(container: ContainerApiMixin):
     """
-    Cleans up a docker container which is running in detached mode
+    Cleans up a docker container which is running in detached mode. The
+    container is killed rather than stopped, as a shell running with a tty
+    ignores SIGTERM and stopping would wait for the timeout.
 
     :param container: An instance of a container
     :return:
@@ -213,45 +385,143 @@ def cleanup(container: ContainerApiMixin):
         yield container
 
     finally:
-        container.stop()
         container.remove(force=True)
 
 
 def put_file(*, container: ContainerApiMixin, src: File, dest: str) -> ():
     """
     Puts a file on the host into a container.
-    This method will create an in memory tar archive, add the src file to this
-    and upload it to the docker container where it will be unarchived at dest.
+    This method will stream a tar archive containing the src file to the
+    docker container, where it will be unarchived at dest. Only one chunk of
+    the file is held in memory at a time.
 
     :param container: The container to write to
     :param src: The path to the source file on the host
     :param dest: The path to the target file in the container
     :return:
     """
-    tar_b = io.BytesIO()
+    put_files(
+        container=container,
+        files={os.path.basename(dest): src},
+        dest=os.path.dirname(dest),
+    )
+
+
+def put_files(
+    *, container: ContainerApiMixin, files: Dict[str, File], dest: str
+) -> Dict[str, float]:
+    """
+    Puts several files on the host into a directory in a container, with a
+    single streamed tar archive.
+
+    :param container: The container to write to
+    :param files: The source files, keyed by their name in the container
+    :param dest: The directory in the container
+    :return: The number of files and bytes that were sent, and the elapsed
+        time
+    """
+    start = time.monotonic()
+
+    container.put_archive(dest, _stream_tar(files=files))
+
+    return {
+        "files": len(files),
+        "bytes": sum(f.size for f in files.values()),
+        "seconds": time.monotonic() - start,
+    }
+
+
+def _stream_tar(*, files: Dict[str, File]) -> Iterator[bytes]:
+    """
+    Generates a tar archive containing the files, the equivalent of
+    tarfile.addfile without building the archive in memory.
+    """
+    for name, src in files.items():
+        tarinfo = tarfile.TarInfo(name=name)
+        tarinfo.size = src.size
+
+        yield tarinfo.tobuf()
+
+        written = 0
+
+        with src.open("rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                written += len(chunk)
+                yield chunk
+
+        if written != tarinfo.size:
+            raise IOError(f"{name} changed size while it was being archived")
 
-    tarinfo = tarfile.TarInfo(name=os.path.basename(dest))
-    tarinfo.size = src.size
+        # Each file is padded to a whole block
+        remainder = tarinfo.size % tarfile.BLOCKSIZE
 
-    with tarfile.open(fileobj=tar_b, mode="w") as tar, src.open("rb") as f:
-        tar.addfile(tarinfo, fileobj=f)
+        if remainder:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
 
-    tar_b.seek(0)
-    container.put_archive(os.path.dirname(dest), tar_b)
+    # The archive ends with two empty blocks
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
 
 
 def get_file(*, container: ContainerApiMixin, src: Path):
+    """
+    Gets a file from a container. The tar archive from docker is read as a
+    stream and the file is written to a temporary file, which is only held
+    in memory while it is smaller than CHUNK_SIZE.
+
+    :param container: The container to read from
+    :param src: The path to the file in the container
+    :return: The file, opened for reading
+    """
     tarstrm, info = container.get_archive(src)
 
-    if info["size"] > 2E9:
+    max_size = settings.CONTAINER_EXEC_MAX_OUTPUT_FILE_SIZE
+
+    if info["size"] > max_size:
         raise ValueError(f"File {src} is too big to be decompressed.")
 
-    file_obj = io.BytesIO()
-    for ts in tarstrm:
-        file_obj.write(ts)
+    file_obj = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE)
+
+    with tarfile.open(mode="r|", fileobj=_ChunkReader(tarstrm)) as tar:
+        for member in tar:
+            if member.name != src.name:
+                continue
+
+            content = tar.extractfile(member)
+
+            if content is None or member.size > max_size:
+                raise ValueError(f"File {src} cannot be decompressed.")
+
+            shutil.copyfileobj(content, file_obj, CHUNK_SIZE)
+            break
+        else:
+            raise ValueError(f"File {src} was not found.")
 
     file_obj.seek(0)
-    tar = tarfile.open(mode="r", fileobj=file_obj)
-    content = tar.extractfile(src.name)
 
-    return content
+    return file_obj
+
+
+class _ChunkReader(io.RawIOBase):
+    """ A file like object that reads from an iterator of bytes """
+
+    def __init__(self, chunks: Iterator[bytes]):
+        super().__init__()
+        self._chunks = iter(chunks)
+        # A view so that the remainder of a chunk is not copied on each read
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+
+        return n
@@ -0,0 +1,186 @@
+"""
+Keeps track of the docker images that are present on the execution host.
+Checking the presence of an image is cached, so that the images on the host
+do not need to be listed, or the io image pulled, for every job.
+
+The last use of each image that is loaded for a job is recorded, so that the
+least recently used images can be removed when the host runs out of space.
+"""
+import time
+from typing import Callable, Dict, Set, List
+
+import docker
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from docker.errors import ImageNotFound, APIError
+
+
+def _presence_key(*, client: docker.DockerClient, sha256: str) -> str:
+    return f"container_exec:image-present:{client.api.base_url}:{sha256}"
+
+
+def _usage_key(*, client: docker.DockerClient, sha256: str) -> str:
+    return f"container_exec:image-used:{client.api.base_url}:{sha256}"
+
+
+def _stats_key(*, client: docker.DockerClient, name: str) -> str:
+    return f"container_exec:images-{name}:{client.api.base_url}"
+
+
+def _incr(key: str, delta: int = 1) -> int:
+    cache.add(key, 0, None)
+    return cache.incr(key, delta)
+
+
+def image_is_present(*, client: docker.DockerClient, sha256: str) -> bool:
+    """
+    Is the image with this sha256 on the host of the client? Only the images
+    that are present are cached, for CONTAINER_EXEC_IMAGE_PRESENCE_TIMEOUT
+    seconds, so an image that is loaded by another worker is found directly.
+    """
+    key = _presence_key(client=client, sha256=sha256)
+
+    if cache.get(key):
+        return True
+
+    try:
+        client.images.get(sha256)
+    except ImageNotFound:
+        return False
+
+    mark_image_present(client=client, sha256=sha256)
+
+    return True
+
+
+def image_is_cached(*, client: docker.DockerClient, sha256: str) -> bool:
+    """
+    Is the image with this sha256 known to be on the host of the client?
+    Unlike image_is_present, the host is not queried.
+    """
+    return bool(cache.get(_presence_key(client=client, sha256=sha256)))
+
+
+def mark_image_present(*, client: docker.DockerClient, sha256: str):
+    cache.set(
+        _presence_key(client=client, sha256=sha256),
+        True,
+        settings.CONTAINER_EXEC_IMAGE_PRESENCE_TIMEOUT,
+    )
+
+
+def forget_image(*, client: docker.DockerClient, sha256: str):
+    """ Call this when an image is removed from the host """
+    cache.delete(_presence_key(client=client, sha256=sha256))
+
+
+def ensure_image(
+    *, client: docker.DockerClient, sha256: str, image: File
+) -> bool:
+    """
+    Loads the image from the saved image file if it is not present on the
+    host, and records that the image was used. Returns whether the image was
+    loaded.
+    """
+    cache.set(_usage_key(client=client, sha256=sha256), time.time(), None)
+
+    if image_is_present(client=client, sha256=sha256):
+        _incr(_stats_key(client=client, name="hits"))
+        return False
+
+    _incr(_stats_key(client=client, name="misses"))
+
+    with image.open("rb") as f:
+        client.images.load(f)
+
+    mark_image_present(client=client, sha256=sha256)
+
+    return True
+
+
+def ensure_io_image(*, client: docker.DockerClient) -> bool:
+    """
+    Pulls the io image from the registry if it is not present on the host.
+    Returns whether the image was pulled.
+    """
+    if image_is_present(
+        client=client, sha256=settings.CONTAINER_EXEC_IO_SHA256
+    ):
+        return False
+
+    image = client.images.pull(repository=settings.CONTAINER_EXEC_IO_IMAGE)
+
+    # The tag could point to a different image than the one that is expected
+    mark_image_present(client=client, sha256=image.id)
+
+    return True
+
+
+def evict_images(
+    *, client: docker.DockerClient, budget: int, keep: Callable[..., Set[str]]
+) -> List[str]:
+    """
+    Removes the least recently used images from the host until the images
+    that were loaded for jobs fit in the budget, in bytes. Other images on
+    the host are never removed, and neither are the images returned by keep,
+    eg. the images of the queued jobs. The size of an image includes the
+    layers that it shares with other images, so the total is an upper bound.
+
+    The images on the host are read before keep is called. Before an image
+    is removed it is checked again with keep(sha256s=[sha256]), so that the
+    image of a job that is queued in the meantime is not removed from under
+    it. An image that was used again since the images were read is not
+    removed either.
+
+    Returns the sha256 of the images that were removed.
+    """
+    sizes = {image.id: image.attrs["Size"] for image in client.images.list()}
+
+    keys = {
+        _usage_key(client=client, sha256=sha256): sha256 for sha256 in sizes
+    }
+    last_used = {keys[k]: v for k, v in cache.get_many(list(keys)).items()}
+
+    total = sum(sizes[sha256] for sha256 in last_used)
+    evicted = []
+    kept = keep()
+
+    for sha256 in sorted(last_used, key=last_used.get):
+        if total <= budget:
+            break
+
+        if sha256 in kept or keep(sha256s=[sha256]):
+            continue
+
+        usage_key = _usage_key(client=client, sha256=sha256)
+
+        if cache.get(usage_key) != last_used[sha256]:
+            continue
+
+        try:
+            client.images.remove(image=sha256)
+        except APIError:
+            # The image is still in use by a container
+            continue
+
+        forget_image(client=client, sha256=sha256)
+        cache.delete(usage_key)
+
+        total -= sizes[sha256]
+        evicted.append(sha256)
+
+    if evicted:
+        _incr(_stats_key(client=client, name="evictions"), len(evicted))
+
+    return evicted
+
+
+def get_image_stats(*, client: docker.DockerClient) -> Dict[str, int]:
+    """
+    Returns how often the image of a job was already on the host (hits),
+    how often it had to be loaded (misses), and how many images were evicted.
+    """
+    names = ("hits", "misses", "evictions")
+    values = cache.get_many([_stats_key(client=client, name=n) for n in names])
+    return {n: values.get(_stats_key(client=client, name=n), 0) for n in names}
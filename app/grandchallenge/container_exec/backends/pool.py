@@ -0,0 +1,172 @@
+"""
+The pool of docker hosts that execute the containers, which are set with
+CONTAINER_EXEC_DOCKER_HOSTS.
+
+The health of each host is checked with a ping at most once every
+CONTAINER_EXEC_HOST_CHECK_INTERVAL seconds, and the result is shared between
+the workers through the cache. A job is placed on one of the healthy hosts
+that has the resources that it requires, where the hosts that already have
+the image of the job are preferred, and then the hosts are chosen with
+CONTAINER_EXEC_HOST_SELECTION.
+
+The number of jobs, the time that they waited in the queue and the time that
+they ran for are counted per host.
+"""
+import logging
+import time
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from docker.errors import APIError
+from requests import RequestException
+
+from grandchallenge.container_exec.backends.docker import get_docker_client
+from grandchallenge.container_exec.backends.images import image_is_cached
+from grandchallenge.container_exec.backends.resources import (
+    Resources,
+    get_capacity,
+    get_reserved,
+    place_job,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _health_key(*, host: str) -> str:
+    return f"container_exec:host-healthy:{host}"
+
+
+def _stats_key(*, host: str, name: str) -> str:
+    return f"container_exec:host-{name}:{host}"
+
+
+def _incr(key: str, delta: int = 1) -> int:
+    cache.add(key, 0, None)
+    return cache.incr(key, delta)
+
+
+def get_hosts() -> List[str]:
+    """ The base urls of all of the docker hosts in the pool """
+    return list(settings.CONTAINER_EXEC_DOCKER_HOSTS)
+
+
+def host_is_healthy(*, host: str) -> bool:
+    key = _health_key(host=host)
+    healthy = cache.get(key)
+
+    if healthy is None:
+        try:
+            healthy = bool(get_docker_client(base_url=host).ping())
+        except (APIError, RequestException):
+            healthy = False
+
+        if not healthy:
+            logger.warning(f"Docker host {host} is unhealthy")
+
+        cache.set(key, healthy, settings.CONTAINER_EXEC_HOST_CHECK_INTERVAL)
+
+    return healthy
+
+
+def get_healthy_hosts() -> Dict[str, Resources]:
+    """ The capacity of each of the healthy hosts, keyed by base url """
+    return {
+        host: get_capacity(client=get_docker_client(base_url=host))
+        for host in get_hosts()
+        if host_is_healthy(host=host)
+    }
+
+
+def select_host(
+    *, job_id: str, requirements: Resources, image_sha256: str
+) -> Optional[str]:
+    """
+    Reserves the resources of a job on one of the healthy hosts.
+
+    :param job_id: The id of the job
+    :param requirements: The resources that are required by the job
+    :param image_sha256: The image of the job, the hosts that have this
+        image are preferred
+    :return: The base url of the host, or None if none of the healthy hosts
+        have enough free resources
+    """
+    hosts = get_healthy_hosts()
+
+    prefer = {
+        host
+        for host in hosts
+        if image_is_cached(
+            client=get_docker_client(base_url=host), sha256=image_sha256
+        )
+    }
+
+    return place_job(
+        job_id=job_id,
+        requirements=requirements,
+        hosts=hosts,
+        prefer=prefer,
+        strategy=settings.CONTAINER_EXEC_HOST_SELECTION,
+    )
+
+
+def get_least_loaded_host() -> Optional[str]:
+    """
+    The healthy host that has the largest fraction of its memory free, eg.
+    to load a new image onto
+    """
+    hosts = get_healthy_hosts()
+
+    return max(
+        hosts,
+        key=lambda h: 1 - get_reserved(host=h).memory_gb / hosts[h].memory_gb,
+        default=None,
+    )
+
+
+def record_job(*, host: str, queued: float, duration: float):
+    """
+    Counts a job that ran on a host.
+
+    :param host: The base url of the host
+    :param queued: The time, in seconds, that the job waited to be started
+    :param duration: The time, in seconds, that the job ran for
+    """
+    cache.add(_stats_key(host=host, name="since"), time.time(), None)
+    _incr(_stats_key(host=host, name="jobs"))
+    _incr(_stats_key(host=host, name="queued-ms"), int(queued * 1000))
+    _incr(_stats_key(host=host, name="running-ms"), int(duration * 1000))
+
+
+def get_host_stats() -> Dict[str, Dict[str, float]]:
+    """
+    Gets the statistics of each host in the pool, keyed by base url. Jobs is
+    the number of jobs since the statistics were first recorded, from which
+    the jobs per hour, the mean time that the jobs waited in the queue and
+    the mean time that they ran for are derived. The reserved resources are
+    of the jobs that are running.
+    """
+    names = ("since", "jobs", "queued-ms", "running-ms")
+    stats = {}
+
+    for host in get_hosts():
+        keys = {_stats_key(host=host, name=n): n for n in names}
+        values = {keys[k]: v for k, v in cache.get_many(list(keys)).items()}
+
+        jobs = values.get("jobs", 0)
+        hours = (time.time() - values.get("since", time.time())) / 3600
+
+        stats[host] = {
+            "healthy": host_is_healthy(host=host),
+            "jobs": jobs,
+            "jobs_per_hour": jobs / hours if hours else 0.0,
+            "mean_queued_seconds": (
+                values.get("queued-ms", 0) / 1000 / jobs if jobs else 0.0
+            ),
+            "mean_running_seconds": (
+                values.get("running-ms", 0) / 1000 / jobs if jobs else 0.0
+            ),
+            "reserved": dict(get_reserved(host=host)._asdict()),
+        }
+
+    return stats
@@ -0,0 +1,257 @@
+"""
+Keeps track of the resources of the execution hosts that are reserved by
+the running jobs, so that a job is only started on a host that has the
+memory, cpu cores and gpu memory that its container image requires.
+
+The reservations of each host are kept in the cache. A reservation expires
+after CELERY_TASK_TIME_LIMIT seconds, so the resources of a job whose worker
+was lost are freed again.
+"""
+import math
+import time
+from contextlib import contextmanager
+from typing import NamedTuple, Dict, Tuple, Optional, Iterable, Set
+
+import docker
+from django.conf import settings
+from django.core.cache import cache
+
+# How long, in seconds, the lock on the reservations of a host is held for
+# at most, how long a worker waits for it, and how long the capacity of a
+# host is cached for
+LOCK_TIMEOUT = 10
+LOCK_WAIT = 5
+CAPACITY_TIMEOUT = 60 * 10
+
+# The strategies for choosing between the hosts where a job fits
+BEST_FIT = "best_fit"
+LEAST_LOADED = "least_loaded"
+
+
+class LockTimeoutError(Exception):
+    """ The lock on the reservations of a host could not be taken in time """
+
+
+class Resources(NamedTuple):
+    memory_gb: float = 0.0
+    cpu_cores: float = 0.0
+    gpu_memory_gb: float = 0.0
+
+    def fits_in(self, other: "Resources") -> bool:
+        return all(a <= b for a, b in zip(self, other))
+
+    def minus(self, other: "Resources") -> "Resources":
+        return Resources(*(a - b for a, b in zip(self, other)))
+
+
+def _total(resources: Iterable[Resources]) -> Resources:
+    return Resources(*(sum(r) for r in zip(Resources(), *resources)))
+
+
+def _reservations_key(*, host: str) -> str:
+    return f"container_exec:reservations:{host}"
+
+
+def _capacity_key(*, host: str) -> str:
+    return f"container_exec:host-capacity:{host}"
+
+
+def get_requirements(container) -> Resources:
+    """
+    Gets the resources that are required by a job from its container image,
+    an instance of ContainerImageModel.
+    """
+    return Resources(
+        memory_gb=max(container.requires_memory_gb, 1),
+        cpu_cores=max(float(container.requires_cpu_cores), 0.01),
+        gpu_memory_gb=(
+            container.requires_gpu_memory_gb if container.requires_gpu else 0
+        ),
+    )
+
+
+def get_run_kwargs(requirements: Resources) -> dict:
+    """ The cgroup limits of the containers of a job """
+    period = settings.CONTAINER_EXEC_CPU_PERIOD
+
+    return {
+        "mem_limit": f"{int(requirements.memory_gb * 1024)}m",
+        "cpu_period": period,
+        "cpu_quota": int(requirements.cpu_cores * period),
+    }
+
+
+def get_capacity(*, client: docker.DockerClient) -> Resources:
+    """
+    Gets the resources of the docker host that can be reserved by jobs. The
+    memory and cpu cores are read from the docker host unless they are set
+    with CONTAINER_EXEC_HOST_MEMORY_GB and CONTAINER_EXEC_HOST_CPU_CORES.
+    The gpu memory is not limited unless CONTAINER_EXEC_HOST_GPU_MEMORY_GB is
+    set.
+    """
+    key = _capacity_key(host=client.api.base_url)
+    capacity = cache.get(key)
+
+    if capacity is None:
+        memory_gb = settings.CONTAINER_EXEC_HOST_MEMORY_GB
+        cpu_cores = settings.CONTAINER_EXEC_HOST_CPU_CORES
+        gpu_memory_gb = settings.CONTAINER_EXEC_HOST_GPU_MEMORY_GB
+
+        if memory_gb is None or cpu_cores is None:
+            info = client.info()
+
+            if memory_gb is None:
+                memory_gb = info["MemTotal"] / 2 ** 30
+
+            if cpu_cores is None:
+                cpu_cores = info["NCPU"]
+
+        if gpu_memory_gb is None:
+            gpu_memory_gb = math.inf
+
+        capacity = Resources(
+            memory_gb=memory_gb,
+            cpu_cores=cpu_cores,
+            gpu_memory_gb=gpu_memory_gb,
+        )
+        cache.set(key, capacity, CAPACITY_TIMEOUT)
+
+    return capacity
+
+
+@contextmanager
+def _locked(*, host: str):
+    """
+    Holds the lock on the reservations of a host. A lock that is not
+    released, eg. as the worker was lost, expires after LOCK_TIMEOUT.
+
+    Raises LockTimeoutError if the lock is not taken within LOCK_WAIT, eg. as
+    the cache cannot be reached.
+    """
+    key = f"{_reservations_key(host=host)}:lock"
+    deadline = time.monotonic() + LOCK_WAIT
+
+    while not cache.add(key, True, LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            raise LockTimeoutError(
+                f"Could not lock the reservations of {host}"
+            )
+
+        time.sleep(0.05)
+
+    try:
+        yield
+    finally:
+        cache.delete(key)
+
+
+def _get_reservations(*, host: str) -> Dict[str, Tuple[Resources, float]]:
+    now = time.time()
+    reservations = cache.get(_reservations_key(host=host)) or {}
+    return {k: v for k, v in reservations.items() if v[1] > now}
+
+
+def get_reserved(*, host: str) -> Resources:
+    """ The total of the resources that are reserved on a host """
+    return _total(r for r, _ in _get_reservations(host=host).values())
+
+
+def reserve(
+    *, host: str, capacity: Resources, job_id: str, requirements: Resources
+) -> bool:
+    """
+    Reserves the resources of a job on a host if they are free. Returns
+    whether the resources were reserved.
+    """
+    with _locked(host=host):
+        reservations = _get_reservations(host=host)
+
+        # The job could be retried after it was placed
+        reservations.pop(job_id, None)
+
+        reserved = _total(r for r, _ in reservations.values())
+
+        if not requirements.fits_in(capacity.minus(reserved)):
+            return False
+
+        reservations[job_id] = (
+            requirements,
+            time.time() + settings.CELERY_TASK_TIME_LIMIT,
+        )
+        cache.set(_reservations_key(host=host), reservations, None)
+
+    return True
+
+
+def release(*, host: str, job_id: str):
+    """ Frees the resources that are reserved by a job on a host """
+    with _locked(host=host):
+        reservations = _get_reservations(host=host)
+
+        if reservations.pop(job_id, None) is not None:
+            cache.set(_reservations_key(host=host), reservations, None)
+
+
+def _headroom(*, left: Resources, capacity: Resources) -> float:
+    """ The smallest fraction of a limited resource that is left on a host """
+    return min(
+        (a / b for a, b in zip(left, capacity) if 0 < b < math.inf),
+        default=1.0,
+    )
+
+
+def place_job(
+    *,
+    job_id: str,
+    requirements: Resources,
+    hosts: Dict[str, Resources],
+    prefer: Set[str] = frozenset(),
+    strategy: str = BEST_FIT,
+) -> Optional[str]:
+    """
+    Reserves the resources of a job on one of the hosts. The preferred
+    hosts are tried first, and then the hosts are tried in the order of the
+    strategy:
+
+    - BEST_FIT tries the host that has the least memory, and then cpu cores,
+      left after the job is placed first, so that the larger gaps are kept
+      for the jobs that need them.
+    - LEAST_LOADED tries the host that has the largest fraction of its
+      resources left after the job is placed first, which spreads the jobs.
+
+    :param job_id: The id of the job
+    :param requirements: The resources that are required by the job
+    :param hosts: The capacity of each host, keyed by host
+    :param prefer: The hosts that are tried first, eg. as they have the
+        image of the job
+    :param strategy: BEST_FIT or LEAST_LOADED
+    :return: The host where the resources were reserved, or None if none of
+        the hosts have enough free resources
+    """
+    candidates = []
+
+    for host, capacity in hosts.items():
+        left = capacity.minus(get_reserved(host=host)).minus(requirements)
+
+        if not all(v >= 0 for v in left):
+            continue
+
+        if strategy == LEAST_LOADED:
+            order = (-_headroom(left=left, capacity=capacity),)
+        elif strategy == BEST_FIT:
+            order = (left.memory_gb, left.cpu_cores)
+        else:
+            raise ValueError(f"Unknown placement strategy {strategy}")
+
+        candidates.append((host not in prefer, order, host))
+
+    for *_, host in sorted(candidates):
+        if reserve(
+            host=host,
+            capacity=hosts[host],
+            job_id=job_id,
+            requirements=requirements,
+        ):
+            return host
+
+    return None
@@ -1,11 +1,15 @@
 from decimal import Decimal
-from typing import Tuple, Type
+from typing import Tuple, Type, List, Dict
 
 from django.conf import settings
+from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.fields.jsonb import KeyTextTransform, KeyTransform
 from django.core.files import File
 from django.db import models
+from django.db.models import Avg, Sum, FloatField, QuerySet
+from django.db.models.functions import Cast
 
-from grandchallenge.container_exec.backends.docker import Executor
+from grandchallenge.container_exec.backends.docker import Executor, PHASES
 from grandchallenge.container_exec.tasks import execute_job
 from grandchallenge.core.validators import ExtensionValidator
 from grandchallenge.jqfileupload.models import StagedFile
@@ -34,15 +38,41 @@ class ContainerExecJobModel(models.Model):
         choices=STATUS_CHOICES, default=PENDING
     )
     output = models.TextField()
+    timings = JSONField(
+        default=dict,
+        editable=False,
+        help_text=(
+            "The wall time, in seconds, and the bytes moved of each phase of "
+            "the container execution"
+        ),
+    )
 
-    def update_status(self, *, status: STATUS_CHOICES, output: str = None):
+    # The lookup of the sha256 of the container image from the job, so that
+    # the images of the queued jobs can be read without loading the jobs
+    container_image_sha256_lookup = None
+
+    def update_status(
+        self,
+        *,
+        status: STATUS_CHOICES,
+        output: str = None,
+        timings: Dict[str, Dict[str, float]] = None,
+    ):
         self.status = status
 
         if output:
             self.output = output
 
+        if timings:
+            self.timings = timings
+
         self.save()
 
+    @property
+    def phase_timings(self) -> List[Tuple[str, Dict[str, float]]]:
+        """ The timings of the phases of this job, in order """
+        return [(p, self.timings[p]) for p in PHASES if p in self.timings]
+
     @property
     def container(self) -> "ContainerImageModel":
         """
@@ -95,6 +125,42 @@ class ContainerExecJobModel(models.Model):
         abstract = True
 
 
+def get_phase_timings(
+    *, jobs: QuerySet
+) -> Tuple[int, List[Tuple[str, Dict[str, float]]]]:
+    """
+    Aggregates the timings of the phases of jobs in the database, eg. of the
+    jobs of a challenge or an algorithm.
+
+    :param jobs: The jobs, a queryset of a subclass of ContainerExecJobModel
+    :return: The number of jobs that have timings, and the mean and total
+        seconds and bytes of each phase, in order
+    """
+    jobs = jobs.exclude(timings={})
+
+    aggregates = {}
+
+    for phase in PHASES:
+        for field in ("seconds", "bytes"):
+            value = Cast(
+                KeyTextTransform(field, KeyTransform(phase, "timings")),
+                FloatField(),
+            )
+            aggregates[f"{phase}_{field}"] = Avg(value)
+            aggregates[f"{phase}_total_{field}"] = Sum(value)
+
+    values = jobs.aggregate(**aggregates)
+    fields = ("seconds", "bytes", "total_seconds", "total_bytes")
+
+    timings = [
+        (phase, {f: values[f"{phase}_{f}"] for f in fields})
+        for phase in PHASES
+        if values[f"{phase}_seconds"] is not None
+    ]
+
+    return jobs.count(), timings
+
+
 def docker_image_path(instance, filename):
     return (
         f"docker/"
@@ -1,15 +1,44 @@
 import json
+import logging
 import tarfile
+import time
 import uuid
+from typing import Set, Dict, Iterable, List, Tuple
 
+import docker
 from celery import shared_task
 from django.apps import apps
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.files import File
 from django.db import OperationalError
+from django.utils import timezone
 
+from grandchallenge.container_exec.backends.clients import log_client_stats
+from grandchallenge.container_exec.backends.docker import (
+    get_docker_client,
+    remove_docker_objects,
+)
+from grandchallenge.container_exec.backends.images import (
+    ensure_image,
+    evict_images,
+)
+from grandchallenge.container_exec.backends.pool import (
+    get_healthy_hosts,
+    get_hosts,
+    get_least_loaded_host,
+    record_job,
+    select_host,
+)
+from grandchallenge.container_exec.backends.resources import (
+    LockTimeoutError,
+    get_requirements,
+    release,
+)
 from grandchallenge.jqfileupload.widgets.uploader import StagedAjaxFile
 
+logger = logging.getLogger(__name__)
+
 
 @shared_task()
 def validate_docker_image_async(
@@ -55,6 +84,155 @@ def validate_docker_image_async(
         image_sha256=f"sha256:{manifest[0]['Config'][:64]}", ready=True
     )
 
+    # Load the image now so that the first job does not need to wait for it
+    load_docker_image.apply_async(
+        kwargs={"pk": pk, "app_label": app_label, "model_name": model_name}
+    )
+
+
+@shared_task()
+def load_docker_image(*, pk: uuid.UUID, app_label: str, model_name: str):
+    """
+    Loads a validated container image onto the least loaded execution host,
+    which the first jobs of the image will then prefer
+    """
+    model = apps.get_model(app_label=app_label, model_name=model_name)
+
+    instance = model.objects.get(pk=pk)
+
+    if not instance.ready:
+        return
+
+    host = get_least_loaded_host()
+
+    if host is None:
+        return
+
+    loaded = ensure_image(
+        client=get_docker_client(base_url=host),
+        sha256=instance.image_sha256,
+        image=instance.image,
+    )
+
+    if loaded:
+        evict_docker_images.apply_async(kwargs={"host": host})
+
+
+@shared_task()
+def evict_docker_images(*, host: str = None) -> Dict[str, List[str]]:
+    """
+    Removes the least recently used images from an execution host, or from
+    all of the healthy hosts, when the loaded images exceed
+    CONTAINER_EXEC_IMAGE_DISK_BUDGET
+    """
+    hosts = [host] if host is not None else list(get_healthy_hosts())
+
+    return {
+        h: evict_images(
+            client=get_docker_client(base_url=h),
+            budget=settings.CONTAINER_EXEC_IMAGE_DISK_BUDGET,
+            keep=get_queued_images,
+        )
+        for h in hosts
+    }
+
+
+def get_queued_jobs():
+    """ Generates the jobs that are queued or running """
+    # Local import to avoid circular dependency
+    from grandchallenge.container_exec.models import ContainerExecJobModel
+
+    for model in apps.get_models():
+        if issubclass(model, ContainerExecJobModel):
+            yield from model.objects.filter(
+                status__in=(model.PENDING, model.STARTED, model.RETRY)
+            )
+
+
+def get_queued_images(*, sha256s: Iterable[str] = None) -> Set[str]:
+    """
+    The sha256 of the images that are used by queued or running jobs, with
+    one query per job model. Set sha256s to only check those images.
+    """
+    # Local import to avoid circular dependency
+    from grandchallenge.container_exec.models import ContainerExecJobModel
+
+    images = {settings.CONTAINER_EXEC_IO_SHA256}
+
+    for model in apps.get_models():
+        if not issubclass(model, ContainerExecJobModel):
+            continue
+
+        lookup = model.container_image_sha256_lookup
+
+        if lookup is None:
+            # The jobs of this model use the io image
+            continue
+
+        jobs = model.objects.filter(
+            status__in=(model.PENDING, model.STARTED, model.RETRY)
+        )
+
+        if sha256s is not None:
+            jobs = jobs.filter(**{f"{lookup}__in": sha256s})
+
+        images.update(jobs.values_list(lookup, flat=True).distinct())
+
+    if sha256s is not None:
+        images &= set(sha256s)
+
+    return images
+
+
+@shared_task()
+def cleanup_docker_objects() -> Dict[str, Dict[str, List[str]]]:
+    """
+    Removes the containers and volumes of jobs that are no longer queued or
+    running from the healthy execution hosts. The executor removes the
+    objects that it creates, this cleans up after jobs whose worker was lost
+    before it could do so.
+
+    The objects are listed before the active jobs are queried, so the
+    objects of a job that starts in between are kept.
+    """
+    objects = {
+        host: _list_docker_objects(client=get_docker_client(base_url=host))
+        for host in get_healthy_hosts()
+    }
+
+    active = {str(job.pk) for job in get_queued_jobs()}
+
+    removed = {}
+
+    for host, host_objects in objects.items():
+        removed[host] = {
+            kind: [name for name, job_id in names if job_id not in active]
+            for kind, names in host_objects.items()
+        }
+        remove_docker_objects(
+            client=get_docker_client(base_url=host), **removed[host]
+        )
+
+    return removed
+
+
+def _list_docker_objects(
+    *, client: docker.DockerClient
+) -> Dict[str, List[Tuple[str, str]]]:
+    """ The containers and volumes of the jobs, with the id of their job """
+    flt = {"label": "job_id"}
+
+    return {
+        "containers": [
+            (c["Id"], c["Labels"]["job_id"])
+            for c in client.api.containers(all=True, filters=flt)
+        ],
+        "volumes": [
+            (v["Name"], v["Labels"]["job_id"])
+            for v in client.api.volumes(filters=flt)["Volumes"] or []
+        ],
+    }
+
 
 def retry_if_dropped(func):
     """
@@ -91,40 +269,102 @@ def get_model_instance(*, pk, app_label, model_name):
     return model.objects.get(pk=pk)
 
 
-@shared_task
+@shared_task(max_retries=settings.CONTAINER_EXEC_CAPACITY_MAX_RETRIES)
 def execute_job(
     *, job_pk: uuid.UUID, job_app_label: str, job_model_name: str
 ) -> dict:
     job = get_model_instance(
         pk=job_pk, app_label=job_app_label, model_name=job_model_name
     )
-    job.update_status(status=job.STARTED)
 
     if not job.container.ready:
         msg = f"Method {job.container.pk} was not ready to be used."
         job.update_status(status=job.FAILURE, output=msg)
         raise RuntimeError(msg)
 
+    requirements = get_requirements(job.container)
+
+    try:
+        host = select_host(
+            job_id=str(job.pk),
+            requirements=requirements,
+            image_sha256=job.container.image_sha256,
+        )
+    except LockTimeoutError as e:
+        # The reservations cannot be read, so the job is retried later
+        logger.warning(f"Could not place job {job.pk}: {e}")
+        host = None
+
+    if host is None:
+        hosts = get_healthy_hosts()
+
+        if len(hosts) == len(get_hosts()) and not any(
+            requirements.fits_in(c) for c in hosts.values()
+        ):
+            msg = (
+                f"The resources required by this job ({requirements}) are "
+                f"not available on any of the execution hosts."
+            )
+            job.update_status(status=job.FAILURE, output=msg)
+            raise RuntimeError(msg)
+
+        if execute_job.request.retries >= execute_job.max_retries:
+            msg = "Timed out waiting for the required resources."
+            job.update_status(status=job.FAILURE, output=msg)
+            raise RuntimeError(msg)
+
+        # Wait for the running jobs to free up the resources
+        job.update_status(status=job.RETRY)
+        raise execute_job.retry(
+            countdown=settings.CONTAINER_EXEC_CAPACITY_RETRY_DELAY
+        )
+
+    job.update_status(status=job.STARTED)
+
+    queued = (timezone.now() - job.created).total_seconds()
+    start = time.monotonic()
+    ev = None
+
     try:
-        with job.executor_cls(
+        ev = job.executor_cls(
             job_id=job.pk,
             input_files=job.input_files,
             exec_image=job.container.image,
             exec_image_sha256=job.container.image_sha256,
-        ) as ev:
+            requirements=requirements,
+            docker_base_url=host,
+        )
+
+        with ev:
             result = ev.execute()  # This call is potentially very long
 
     except Exception as exc:
         job = get_model_instance(
             pk=job_pk, app_label=job_app_label, model_name=job_model_name
         )
-        job.update_status(status=job.FAILURE, output=str(exc))
+        job.update_status(
+            status=job.FAILURE,
+            output=str(exc),
+            timings=ev.timings if ev is not None else None,
+        )
         raise
 
+    finally:
+        try:
+            release(host=host, job_id=str(job.pk))
+        except LockTimeoutError as e:
+            # The reservation expires after CELERY_TASK_TIME_LIMIT
+            logger.warning(f"Could not release job {job.pk}: {e}")
+
+        record_job(host=host, queued=queued, duration=time.monotonic() - start)
+        # The clients are kept per worker process, so their statistics are
+        # logged by the worker rather than collected centrally
+        log_client_stats()
+
     job = get_model_instance(
         pk=job_pk, app_label=job_app_label, model_name=job_model_name
     )
     job.create_result(result=result)
-    job.update_status(status=job.SUCCESS)
+    job.update_status(status=job.SUCCESS, timings=ev.timings)
 
     return result
@@ -0,0 +1,34 @@
+from django.core.management import BaseCommand
+
+from grandchallenge.container_exec.backends.docker import get_docker_client
+from grandchallenge.container_exec.backends.images import get_image_stats
+from grandchallenge.container_exec.backends.pool import get_host_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Shows the jobs that ran on each of the execution hosts and the "
+        "resources that are reserved on them, and for the healthy hosts how "
+        "often the image of a job was already on the host"
+    )
+
+    def handle(self, *args, **options):
+        for host, stats in get_host_stats().items():
+            reserved = stats.pop("reserved")
+            stats.update({f"reserved_{k}": v for k, v in reserved.items()})
+
+            if stats["healthy"]:
+                stats.update(
+                    get_image_stats(client=get_docker_client(base_url=host))
+                )
+
+            self.stdout.write(
+                f"{host}: "
+                + " ".join(f"{k}={_format(v)}" for k, v in stats.items())
+            )
+
+
+def _format(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
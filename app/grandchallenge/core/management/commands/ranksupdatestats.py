@@ -0,0 +1,29 @@
+from django.core.management import BaseCommand
+
+from grandchallenge.challenges.models import Challenge
+from grandchallenge.evaluation.tasks import get_ranks_update_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Shows how many ranks updates were triggered for each challenge, and "
+        "how many of those were scheduled or merged into a pending update"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("challenge_short_name", nargs="*", type=str)
+
+    def handle(self, *args, **options):
+        challenges = Challenge.objects.order_by("short_name")
+
+        if options["challenge_short_name"]:
+            challenges = challenges.filter(
+                short_name__in=options["challenge_short_name"]
+            )
+
+        for challenge in challenges:
+            stats = get_ranks_update_stats(challenge_pk=challenge.pk)
+            self.stdout.write(
+                f"{challenge.short_name}: "
+                + " ".join(f"{k}={v}" for k, v in stats.items())
+            )
@@ -0,0 +1,18 @@
+from rest_framework.permissions import BasePermission
+
+
+class IsChallengeParticipantOrAdmin(BasePermission):
+    """
+    Allows access to the participants and admins of the challenge of the
+    request, the REST framework equivalent of
+    UserIsChallengeParticipantOrAdminMixin
+
+    Requires that grandchallenge.core.middleware.project is installed
+    """
+
+    def has_permission(self, request, view):
+        user = request.user
+        challenge = request.challenge
+        return user.is_authenticated and (
+            challenge.is_admin(user) or challenge.is_participant(user)
+        )
@@ -0,0 +1,730 @@
+import csv
+import json
+import logging
+import pickle
+import uuid
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, List, Iterator, NamedTuple, Optional, Tuple
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q, F, FilteredRelation
+from django.template.defaultfilters import floatformat
+from django.utils.safestring import mark_safe
+
+from grandchallenge.evaluation.models import Result, Config, Submission
+from grandchallenge.evaluation.templatetags.evaluation_extras import (
+    compile_jsonpath
+)
+from grandchallenge.evaluation.utils import JSONPath
+from grandchallenge.profiles.templatetags.profiles import user_profile_link
+from grandchallenge.subdomains.utils import reverse
+
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_CACHE_TIMEOUT = 60 * 60
+# The snapshot is stored in chunks of at most this many pickled bytes of rows
+# to stay below the maximum size of a cache item (1MB for memcached)
+LEADERBOARD_CHUNK_BYTES = 2 ** 19
+LEADERBOARD_PAGE_SIZE = 50
+EXPORT_CHUNK_SIZE = 2000
+
+
+class LeaderboardPage(NamedTuple):
+    rows: List[Dict]
+    # The cursor of the next page, None if this is the last page
+    next_cursor: Optional[str]
+
+
+def _version_key(*, challenge_pk: uuid.UUID) -> str:
+    return f"evaluation:leaderboard-version:{challenge_pk}"
+
+
+def _snapshot_key(*, challenge_pk: uuid.UUID, version: int) -> str:
+    return f"evaluation:leaderboard:{challenge_pk}:{version}"
+
+
+def _chunk_key(*, challenge_pk: uuid.UUID, version: int, chunk: int) -> str:
+    return f"evaluation:leaderboard:{challenge_pk}:{version}:{chunk}"
+
+
+def get_leaderboard(*, challenge_pk: uuid.UUID) -> List[Dict]:
+    """
+    Returns the rows of the leaderboard for this challenge. The rows are
+    served from the snapshot of the current version, which is built if it
+    is not in the cache.
+    """
+    version = cache.get(_version_key(challenge_pk=challenge_pk), 0)
+
+    rows = _get_snapshot(challenge_pk=challenge_pk, version=version)
+
+    if rows is None:
+        rows = build_leaderboard(challenge_pk=challenge_pk)
+        _set_snapshot(challenge_pk=challenge_pk, version=version, rows=rows)
+
+    return rows
+
+
+def update_leaderboard(*, challenge_pk: uuid.UUID):
+    """ Builds a new snapshot of the leaderboard and makes it current """
+    rows = build_leaderboard(challenge_pk=challenge_pk)
+    version = invalidate_leaderboard(challenge_pk=challenge_pk)
+    _set_snapshot(challenge_pk=challenge_pk, version=version, rows=rows)
+
+
+def _get_snapshot(*, challenge_pk: uuid.UUID, version: int):
+    """ Returns None if any part of the snapshot is not in the cache """
+    header = cache.get(
+        _snapshot_key(challenge_pk=challenge_pk, version=version)
+    )
+
+    if header is None:
+        return None
+
+    keys = [key for _, key in header]
+    chunks = cache.get_many(keys)
+
+    if len(chunks) != len(keys):
+        return None
+
+    return [row for key in keys for row in chunks[key]]
+
+
+def _get_snapshot_page(
+    *,
+    challenge_pk: uuid.UUID,
+    version: int,
+    after: Optional[Tuple[int, uuid.UUID]],
+    page_size: int,
+) -> Optional[List[Dict]]:
+    """
+    Gets up to page_size + 1 rows of the snapshot that follow the row with
+    the (rank, pk) key in after, only reading the chunks that contain them.
+    Returns None if any of these chunks is not in the cache.
+    """
+    header = cache.get(
+        _snapshot_key(challenge_pk=challenge_pk, version=version)
+    )
+
+    if header is None:
+        return None
+
+    if after is None:
+        start = 0
+    else:
+        start = _find_chunk(header=header, key=after)
+
+    rows = []
+
+    for _, key in header[start:]:
+        chunk = cache.get(key)
+
+        if chunk is None:
+            return None
+
+        rows += [r for r in chunk if after is None or _row_key(r) > after]
+
+        if len(rows) > page_size:
+            break
+
+    return rows[: page_size + 1]
+
+
+def _set_snapshot(
+    *,
+    challenge_pk: uuid.UUID,
+    version: int,
+    rows: List,
+    header: List[Tuple[Tuple[int, uuid.UUID], str]] = None,
+):
+    """
+    Stores the rows as the snapshot of a version. The rows are split into
+    chunks of LEADERBOARD_CHUNK_BYTES, and the header of the snapshot lists
+    the key of the first row and the cache key of each chunk. The header is
+    not stored if any of the chunks could not be stored.
+
+    Pass the header of an earlier snapshot to reuse its chunks, in which
+    case the rows are the patched chunks that replace None entries in the
+    header.
+    """
+    if header is None:
+        header = [None]
+        rows = [rows]
+
+    chunks = OrderedDict()
+    new_header = []
+
+    for entry, chunk_rows in zip(header, rows):
+        if entry is not None:
+            new_header.append(entry)
+            continue
+
+        for chunk in _split_rows(chunk_rows):
+            key = _chunk_key(
+                challenge_pk=challenge_pk, version=version, chunk=len(chunks)
+            )
+            chunks[key] = chunk
+            new_header.append((_row_key(chunk[0]), key))
+
+    failed = cache.set_many(chunks, LEADERBOARD_CACHE_TIMEOUT)
+
+    if failed:
+        logger.warning(
+            f"Could not store the leaderboard of challenge {challenge_pk}"
+        )
+        cache.delete_many(list(chunks))
+        return
+
+    # Set the header last so that the snapshot is only used once all of the
+    # chunks are stored
+    cache.set(
+        _snapshot_key(challenge_pk=challenge_pk, version=version),
+        new_header,
+        LEADERBOARD_CACHE_TIMEOUT,
+    )
+
+
+def _split_rows(rows: List[Dict]) -> List[List[Dict]]:
+    """ Splits the rows into chunks of at most LEADERBOARD_CHUNK_BYTES """
+    chunks = []
+    chunk = []
+    size = 0
+
+    for row in rows:
+        row_bytes = len(pickle.dumps(row, pickle.HIGHEST_PROTOCOL))
+
+        if chunk and size + row_bytes > LEADERBOARD_CHUNK_BYTES:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+
+        chunk.append(row)
+        size += row_bytes
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+def _row_key(row: Dict) -> Tuple[int, uuid.UUID]:
+    """ The rows of the snapshot are ordered by this key """
+    return row["rank"], row["pk"]
+
+
+def _find_chunk(*, header: List, key: Tuple[int, uuid.UUID]) -> int:
+    """ The index of the chunk in the header where a row with key belongs """
+    first_keys = [first_key for first_key, _ in header]
+    return max(bisect_right(first_keys, key) - 1, 0)
+
+
+def patch_leaderboard(
+    *, challenge_pk: uuid.UUID, previous_ranks: Dict[uuid.UUID, int]
+):
+    """
+    Updates the snapshot of the leaderboard for the results whose rows
+    changed, eg. after a single result was ranked. Only the chunks that
+    held or will hold these rows are rebuilt, the other chunks of the
+    current snapshot are reused by the new version.
+
+    Falls back to update_leaderboard if the current snapshot is not in the
+    cache, or if it does not match previous_ranks.
+
+    :param challenge_pk: The primary key of the challenge
+    :param previous_ranks: The rank that each of the changed results had in
+        the current snapshot, 0 if it was not shown
+    """
+    version = cache.get(_version_key(challenge_pk=challenge_pk), 0)
+    header = cache.get(
+        _snapshot_key(challenge_pk=challenge_pk, version=version)
+    )
+
+    if not header:
+        return update_leaderboard(challenge_pk=challenge_pk)
+
+    rows = build_leaderboard(challenge_pk=challenge_pk, pks=[*previous_ranks])
+
+    old_keys = {(rank, pk) for pk, rank in previous_ranks.items() if rank}
+    affected = {
+        _find_chunk(header=header, key=key)
+        for key in [*old_keys, *(_row_key(r) for r in rows)]
+    }
+
+    chunks = cache.get_many([header[idx][1] for idx in affected])
+
+    if len(chunks) != len(affected):
+        return update_leaderboard(challenge_pk=challenge_pk)
+
+    patched = {idx: [] for idx in affected}
+    removed = set()
+
+    for idx in affected:
+        for row in chunks[header[idx][1]]:
+            if row["pk"] in previous_ranks:
+                removed.add(_row_key(row))
+            else:
+                patched[idx].append(row)
+
+    if removed != old_keys:
+        # The snapshot is out of sync with the ranks
+        return update_leaderboard(challenge_pk=challenge_pk)
+
+    for row in rows:
+        patched[_find_chunk(header=header, key=_row_key(row))].append(row)
+
+    new_version = invalidate_leaderboard(challenge_pk=challenge_pk)
+
+    if new_version != version + 1:
+        # The leaderboard was invalidated in the meantime
+        _set_snapshot(
+            challenge_pk=challenge_pk,
+            version=new_version,
+            rows=build_leaderboard(challenge_pk=challenge_pk),
+        )
+    else:
+        _set_snapshot(
+            challenge_pk=challenge_pk,
+            version=new_version,
+            rows=[
+                sorted(patched[idx], key=_row_key) if idx in patched else None
+                for idx in range(len(header))
+            ],
+            header=[
+                None if idx in patched else entry
+                for idx, entry in enumerate(header)
+            ],
+        )
+
+
+def get_leaderboard_page(
+    *,
+    challenge_pk: uuid.UUID,
+    sort: str = "rank",
+    descending: bool = False,
+    cursor: str = None,
+    page_size: int = LEADERBOARD_PAGE_SIZE,
+) -> LeaderboardPage:
+    """
+    Gets a page of the leaderboard of this challenge, sorted by rank or by
+    the value of one of the jsonpaths in get_result_metric_paths. The pages
+    are keyset paginated: the cursor holds the sort key of the last row of
+    the previous page, and only the rows of this page are read.
+
+    Results without a value for the sorted metric are listed last.
+
+    Raises a ValueError if the cursor is invalid.
+    """
+    after = _decode_cursor(cursor=cursor) if cursor else None
+
+    if sort == "rank" and not descending:
+        # Served from the snapshot, which is ordered by (rank, pk)
+        if after is not None:
+            after = (int(after[0]), after[1])
+
+        version = cache.get(_version_key(challenge_pk=challenge_pk), 0)
+        rows = _get_snapshot_page(
+            challenge_pk=challenge_pk,
+            version=version,
+            after=after,
+            page_size=page_size,
+        )
+
+        if rows is None:
+            snapshot = get_leaderboard(challenge_pk=challenge_pk)
+            rows = [
+                r for r in snapshot if after is None or _row_key(r) > after
+            ][: page_size + 1]
+
+        keys = [_row_key(r) for r in rows]
+    else:
+        keys = _get_page_keys(
+            challenge_pk=challenge_pk,
+            sort=sort,
+            descending=descending,
+            after=after,
+            page_size=page_size,
+        )
+        rows = build_leaderboard(
+            challenge_pk=challenge_pk, pks=[pk for _, pk in keys]
+        )
+
+    if len(rows) > page_size:
+        next_cursor = _encode_cursor(key=keys[page_size - 1])
+    else:
+        next_cursor = None
+
+    return LeaderboardPage(rows=rows[:page_size], next_cursor=next_cursor)
+
+
+def _get_page_keys(
+    *,
+    challenge_pk: uuid.UUID,
+    sort: str,
+    descending: bool,
+    after: Optional[Tuple],
+    page_size: int,
+) -> List[Tuple]:
+    """
+    Gets the sort keys, (value, pk), of up to page_size + 1 results that
+    follow the key in after.
+    """
+    results = Result.objects.filter(
+        Q(challenge__pk=challenge_pk),
+        Q(published=True),
+        ~Q(rank=0),  # Exclude results without a rank
+    )
+
+    if sort == "rank":
+        field = "rank"
+    else:
+        results = results.annotate(
+            sort_metric=FilteredRelation(
+                "metric_values", condition=Q(metric_values__path=sort)
+            )
+        )
+        field = "sort_metric__value"
+
+    if descending:
+        order_by = (F(field).desc(nulls_last=True), "-pk")
+        beyond, pk_beyond = f"{field}__lt", "pk__lt"
+    else:
+        order_by = (F(field).asc(nulls_last=True), "pk")
+        beyond, pk_beyond = f"{field}__gt", "pk__gt"
+
+    if after is not None:
+        value, pk = after
+
+        if value is None:
+            results = results.filter(
+                Q(**{f"{field}__isnull": True}), Q(**{pk_beyond: pk})
+            )
+        else:
+            results = results.filter(
+                Q(**{beyond: value})
+                | Q(**{field: value, pk_beyond: pk})
+                | Q(**{f"{field}__isnull": True})
+            )
+
+    return list(
+        results.order_by(*order_by).values_list(field, "pk")[: page_size + 1]
+    )
+
+
+def _encode_cursor(*, key: Tuple) -> str:
+    value, pk = key
+    return urlsafe_b64encode(json.dumps([value, str(pk)]).encode()).decode()
+
+
+def _decode_cursor(*, cursor: str) -> Tuple:
+    try:
+        value, pk = json.loads(urlsafe_b64decode(cursor.encode()))
+        return value, uuid.UUID(pk)
+    except (TypeError, ValueError, UnicodeError):
+        # binascii.Error and json.JSONDecodeError are ValueErrors
+        raise ValueError("Invalid cursor")
+
+
+def invalidate_leaderboard(*, challenge_pk: uuid.UUID) -> int:
+    """
+    Moves the leaderboard of this challenge to a new version, the previous
+    snapshots will no longer be served. Returns the new version.
+    """
+    key = _version_key(challenge_pk=challenge_pk)
+    cache.add(key, 0, None)
+    return cache.incr(key)
+
+
+def invalidate_user_leaderboards(*, user_pk: int):
+    """
+    Invalidates the leaderboards where this user has a ranked result, eg.
+    as the profile link of the user in the snapshots has changed
+    """
+    challenge_pks = (
+        Result.objects.filter(
+            job__submission__creator__pk=user_pk, published=True
+        )
+        .exclude(rank=0)
+        .values_list("challenge__pk", flat=True)
+        .distinct()
+    )
+
+    for challenge_pk in challenge_pks:
+        invalidate_leaderboard(challenge_pk=challenge_pk)
+
+
+def build_leaderboard(
+    *, challenge_pk: uuid.UUID, pks: List[uuid.UUID] = None
+) -> List[Dict]:
+    """
+    Gets the ranked results of this challenge as a list of rows that can be
+    rendered directly, ordered by rank. The values of each column are
+    resolved here, so rendering the rows does not need any more queries.
+    The teams are looked up from the team map when rendering, see
+    grandchallenge.teams.utils.get_team_map.
+
+    If pks is set only the rows of those results are built, in that order.
+    """
+    config = Config.objects.get(challenge__pk=challenge_pk)
+
+    results = Result.objects.filter(
+        Q(challenge__pk=challenge_pk),
+        Q(published=True),
+        ~Q(rank=0),  # Exclude results without a rank
+    )
+
+    if pks is not None:
+        results = results.filter(pk__in=pks)
+
+    columns = [
+        {
+            "path": config.score_jsonpath,
+            "error_path": config.score_error_jsonpath,
+        },
+        *config.extra_results_columns,
+    ]
+
+    # Only the values at the paths of the columns are read, rather than the
+    # whole metrics json
+    paths = []
+
+    for col in columns:
+        paths += [col["path"], col.get("error_path")]
+
+    paths = list(OrderedDict((p, None) for p in paths if p))
+    annotations = {
+        f"metric_{idx}": JSONPath("metrics", p) for idx, p in enumerate(paths)
+    }
+
+    results = (
+        results.annotate(**annotations)
+        .order_by("rank", "pk")
+        .values_list(
+            "pk",
+            "rank",
+            "rank_score",
+            "created",
+            "rank_per_metric",
+            "job__submission__creator",
+            "job__submission__comment",
+            "job__submission__publication_url",
+            "job__submission__supplementary_file",
+            *annotations,
+        )
+    )
+
+    # Resolve the urls once rather than for every row
+    placeholder = uuid.UUID(int=0)
+    result_url = reverse(
+        "evaluation:result-detail",
+        kwargs={
+            "pk": placeholder,
+            "challenge_short_name": config.challenge.short_name,
+        },
+    )
+    supplementary_file_storage = Submission._meta.get_field(
+        "supplementary_file"
+    ).storage
+
+    results = list(results)
+
+    if pks is not None:
+        order = {pk: idx for idx, pk in enumerate(pks)}
+        results.sort(key=lambda r: order[r[0]])
+
+    users_html = _get_users_html(pks={r[6] for r in results if r[6]})
+
+    rows = []
+
+    for (
+        pk,
+        rank,
+        rank_score,
+        created,
+        rank_per_metric,
+        creator_pk,
+        comment,
+        publication_url,
+        supplementary_file,
+        *values,
+    ) in results:
+        # A missing value is shown as an empty string, as with get_jsonpath
+        metrics = {p: "" if v is None else v for p, v in zip(paths, values)}
+
+        rows.append(
+            {
+                "pk": pk,
+                "url": result_url.replace(str(placeholder), str(pk)),
+                "rank": rank,
+                "rank_score": rank_score,
+                "created": created,
+                "creator_pk": creator_pk,
+                "user_html": users_html.get(creator_pk, ""),
+                "metrics": [
+                    _format_metric(
+                        metrics=metrics,
+                        rank_per_metric=rank_per_metric,
+                        path=col["path"],
+                        error_path=col.get("error_path"),
+                        config=config,
+                    )
+                    for col in columns
+                ],
+                "comment": comment or "",
+                "publication_url": publication_url or "",
+                "supplementary_file_url": (
+                    supplementary_file_storage.url(supplementary_file)
+                    if supplementary_file
+                    else ""
+                ),
+            }
+        )
+
+    return rows
+
+
+def _get_users_html(*, pks) -> Dict[int, str]:
+    """ Gets the profile link of each user, with a single query """
+    users = (
+        get_user_model()
+        .objects.filter(pk__in=pks)
+        .select_related("user_profile")
+    )
+    return {user.pk: _get_user_html(user=user) for user in users}
+
+
+def _get_user_html(*, user) -> str:
+    try:
+        return user_profile_link(user)
+    except ObjectDoesNotExist:
+        # This user does not have a profile
+        return user.username
+
+
+def _format_metric(
+    *,
+    metrics: Dict,
+    rank_per_metric: Dict,
+    path: str,
+    error_path: Optional[str],
+    config: Config,
+) -> Dict:
+    """ Formats a column, metrics holds the value of each of the paths """
+    value = metrics[path]
+
+    # The output of floatformat is safe, so the parts can be joined directly
+    display = floatformat(value, config.score_decimal_places)
+
+    if error_path:
+        display += "&nbsp;±&nbsp;" + floatformat(
+            metrics[error_path], config.score_decimal_places
+        )
+
+    if config.scoring_method_choice != Config.ABSOLUTE:
+        display += f"&nbsp;({rank_per_metric.get(path, '')})"
+
+    return {"order": value, "display": mark_safe(display)}
+
+
+def get_export_fields(*, config: Config) -> List[str]:
+    """
+    The fields of an exported leaderboard record. The values of the jsonpaths
+    in the config are flattened into their own fields, eg. "metrics.dice".
+    """
+    paths = [config.score_jsonpath, config.score_error_jsonpath]
+
+    for col in config.extra_results_columns:
+        paths += [col["path"], col.get("error_path")]
+
+    paths = OrderedDict((p, None) for p in paths if p)
+
+    return [
+        "pk",
+        "rank",
+        "rank_score",
+        "created",
+        "user",
+        *(f"metrics.{p}" for p in paths),
+        "metrics",
+    ]
+
+
+def export_leaderboard(*, challenge_pk: uuid.UUID) -> Iterator[Dict]:
+    """
+    Yields a record for each result on the leaderboard of this challenge,
+    ordered by rank. The results are read with a server side cursor, so only
+    EXPORT_CHUNK_SIZE results are held in memory at any time.
+    """
+    config = Config.objects.get(challenge__pk=challenge_pk)
+    fields = get_export_fields(config=config)
+
+    getters = [
+        (f, compile_jsonpath(f[len("metrics.") :]))
+        for f in fields
+        if f.startswith("metrics.")
+    ]
+
+    results = (
+        Result.objects.filter(
+            Q(challenge__pk=challenge_pk),
+            Q(published=True),
+            ~Q(rank=0),  # Exclude results without a rank
+        )
+        .order_by("rank", "pk")
+        .values_list(
+            "pk",
+            "rank",
+            "rank_score",
+            "created",
+            "job__submission__creator__username",
+            "metrics",
+        )
+    )
+
+    for pk, rank, rank_score, created, username, metrics in results.iterator(
+        chunk_size=EXPORT_CHUNK_SIZE
+    ):
+        record = OrderedDict(
+            pk=str(pk),
+            rank=rank,
+            rank_score=rank_score,
+            created=created.isoformat(),
+            user=username,
+        )
+
+        for field, getter in getters:
+            record[field] = getter(metrics)
+
+        record["metrics"] = metrics
+
+        yield record
+
+
+class _Echo:
+    """ A file like object that returns what is written to it """
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(*, records: Iterator[Dict], fields: List[str]) -> Iterator[str]:
+    """ Yields the records as lines of a csv file, starting with a header """
+    writer = csv.writer(_Echo())
+
+    yield writer.writerow(fields)
+
+    for record in records:
+        yield writer.writerow(
+            [
+                json.dumps(v) if isinstance(v, (dict, list)) else v
+                for v in (record[f] for f in fields)
+            ]
+        )
+
+
+def stream_ndjson(*, records: Iterator[Dict]) -> Iterator[str]:
+    """ Yields the records as newline delimited json """
+    for record in records:
+        yield json.dumps(record) + "\n"
@@ -0,0 +1,57 @@
+# Generated by Django 2.1.4 on 2026-10-16 21:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("challenges", "0017_auto_20181214_1256"),
+        ("evaluation", "0021_auto_20181205_2226"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ResultMetric",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("path", models.CharField(max_length=255)),
+                ("value", models.FloatField()),
+                (
+                    "challenge",
+                    models.ForeignKey(
+                        editable=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="challenges.Challenge",
+                    ),
+                ),
+                (
+                    "result",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="metric_values",
+                        to="evaluation.Result",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="resultmetric",
+            index=models.Index(
+                fields=["challenge", "path", "value"],
+                name="evaluation__challen_404b58_idx",
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="resultmetric", unique_together={("result", "path")}
+        ),
+    ]
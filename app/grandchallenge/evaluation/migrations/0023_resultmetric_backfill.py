@@ -0,0 +1,71 @@
+# Generated by Django 2.1.4 on 2026-10-16 21:05
+
+from django.contrib.postgres.fields import JSONField
+from django.db import migrations
+from django.db.models import Func, Value
+
+
+class JSONPath(Func):
+    """
+    A frozen copy of grandchallenge.evaluation.utils.JSONPath, so that this
+    migration does not depend on the code of the app. Gets the json object
+    at a dotted path from a JSONField.
+    """
+
+    arg_joiner = " #> "
+    template = "%(expressions)s"
+
+    def __init__(self, expression, jsonpath: str, **extra):
+        super().__init__(
+            expression,
+            Value(jsonpath.split(".")),
+            output_field=JSONField(),
+            **extra,
+        )
+
+
+def store_result_metrics_forward(apps, schema_editor):
+    Config = apps.get_model("evaluation", "Config")
+    Result = apps.get_model("evaluation", "Result")
+    ResultMetric = apps.get_model("evaluation", "ResultMetric")
+
+    for config in Config.objects.all():
+        paths = [config.score_jsonpath]
+        paths += [col["path"] for col in config.extra_results_columns]
+        paths = list(dict.fromkeys(p for p in paths if p))
+
+        annotations = {
+            f"metric_{idx}": JSONPath("metrics", p)
+            for idx, p in enumerate(paths)
+        }
+        rows = (
+            Result.objects.filter(challenge=config.challenge_id)
+            .annotate(**annotations)
+            .values_list("pk", *annotations)
+        )
+
+        ResultMetric.objects.bulk_create(
+            (
+                ResultMetric(
+                    result_id=pk,
+                    challenge_id=config.challenge_id,
+                    path=p,
+                    value=v,
+                )
+                for pk, *values in rows
+                for p, v in zip(paths, values)
+                if isinstance(v, (int, float)) and not isinstance(v, bool)
+            ),
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("evaluation", "0022_resultmetric")]
+
+    operations = [
+        migrations.RunPython(
+            store_result_metrics_forward, migrations.RunPython.noop
+        )
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.4 on 2026-10-16 21:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("evaluation", "0023_resultmetric_backfill")]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="result",
+            index=models.Index(
+                fields=["challenge", "rank", "id"],
+                name="evaluation__challen_9f9df4_idx",
+            ),
+        )
+    ]
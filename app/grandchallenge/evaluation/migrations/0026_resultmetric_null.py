@@ -0,0 +1,88 @@
+# Generated by Django 2.1.4 on 2026-10-16 23:40
+
+from django.contrib.postgres.fields import JSONField
+from django.db import migrations, models
+from django.db.models import CharField, Func, Value
+
+
+class JSONPath(Func):
+    """
+    A frozen copy of grandchallenge.evaluation.utils.JSONPath, so that this
+    migration does not depend on the code of the app. Gets the json object
+    at a dotted path from a JSONField.
+    """
+
+    arg_joiner = " #> "
+    template = "%(expressions)s"
+
+    def __init__(self, expression, jsonpath: str, **extra):
+        super().__init__(
+            expression,
+            Value(jsonpath.split(".")),
+            output_field=JSONField(),
+            **extra,
+        )
+
+
+class JSONTypeOf(Func):
+    """
+    A frozen copy of grandchallenge.evaluation.utils.JSONTypeOf. Gets the
+    type of a json object.
+    """
+
+    function = "jsonb_typeof"
+    output_field = CharField()
+
+
+def store_null_result_metrics_forward(apps, schema_editor):
+    Config = apps.get_model("evaluation", "Config")
+    Result = apps.get_model("evaluation", "Result")
+    ResultMetric = apps.get_model("evaluation", "ResultMetric")
+
+    for config in Config.objects.all():
+        paths = [config.score_jsonpath]
+        paths += [col["path"] for col in config.extra_results_columns]
+        paths = list(dict.fromkeys(p for p in paths if p))
+
+        for p in paths:
+            pks = (
+                Result.objects.filter(challenge=config.challenge_id)
+                .annotate(metric_type=JSONTypeOf(JSONPath("metrics", p)))
+                .filter(metric_type="null")
+                .values_list("pk", flat=True)
+            )
+
+            ResultMetric.objects.bulk_create(
+                (
+                    ResultMetric(
+                        result_id=pk,
+                        challenge_id=config.challenge_id,
+                        path=p,
+                        value=None,
+                    )
+                    for pk in pks
+                ),
+                batch_size=1000,
+            )
+
+
+def delete_null_result_metrics_backward(apps, schema_editor):
+    ResultMetric = apps.get_model("evaluation", "ResultMetric")
+    ResultMetric.objects.filter(value__isnull=True).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("evaluation", "0025_job_timings")]
+
+    operations = [
+        migrations.AlterField(
+            model_name="resultmetric",
+            name="value",
+            field=models.FloatField(null=True),
+        ),
+        migrations.RunPython(
+            store_null_result_metrics_forward,
+            delete_null_result_metrics_backward,
+        ),
+    ]
@@ -7,7 +7,7 @@ from django.db import models
 from django.db.models import BooleanField
 
 from grandchallenge.challenges.models import Challenge
-from grandchallenge.container_exec.backends.docker import Executor, put_file
+from grandchallenge.container_exec.backends.docker import Executor
 from grandchallenge.container_exec.models import (
     ContainerExecJobModel,
     ContainerImageModel,
@@ -416,9 +416,15 @@ class SubmissionEvaluator(Executor):
         )
 
     def _copy_input_files(self, writer):
-        for file in self._input_files:
-            dest_file = "/tmp/submission-src"
-            put_file(container=writer, src=file, dest=dest_file)
+        # The files are sent in one archive and then unpacked one by one
+        sources = {
+            f"submission-src-{idx}": file
+            for idx, file in enumerate(self._input_files)
+        }
+        self._put_input_files(writer=writer, files=sources, dest="/tmp/")
+
+        for name, file in sources.items():
+            dest_file = f"/tmp/{name}"
 
             with file.open("rb") as f:
                 mimetype = get_file_mimetype(f)
@@ -473,6 +479,10 @@ class Result(UUIDModel):
     rank_score = models.FloatField(default=0.0)
     rank_per_metric = JSONField(default=dict)
 
+    class Meta:
+        # For the keyset pagination of the leaderboard
+        indexes = (models.Index(fields=["challenge", "rank", "id"]),)
+
     def save(self, *args, **kwargs):
         # Note: cannot use `self.pk is None` with a custom pk
         if self._state.adding:
@@ -492,6 +502,28 @@ class Result(UUIDModel):
         )
 
 
+class ResultMetric(models.Model):
+    """
+    Stores the value of one of the metrics of a result, for the jsonpaths
+    that are shown on the leaderboard. These are copied from Result.metrics
+    so that the results can be filtered and sorted by a metric with an index.
+    A json null is stored as NULL, so that it can be ranked last.
+    """
+
+    challenge = models.ForeignKey(
+        Challenge, on_delete=models.CASCADE, editable=False
+    )
+    result = models.ForeignKey(
+        "Result", on_delete=models.CASCADE, related_name="metric_values"
+    )
+    path = models.CharField(max_length=255)
+    value = models.FloatField(null=True)
+
+    class Meta:
+        unique_together = (("result", "path"),)
+        indexes = (models.Index(fields=["challenge", "path", "value"]),)
+
+
 class Job(UUIDModel, ContainerExecJobModel):
     """
     Stores information about a job for a given upload
@@ -501,6 +533,8 @@ class Job(UUIDModel, ContainerExecJobModel):
     submission = models.ForeignKey("Submission", on_delete=models.CASCADE)
     method = models.ForeignKey("Method", on_delete=models.CASCADE)
 
+    container_image_sha256_lookup = "method__image_sha256"
+
     @property
     def container(self):
         return self.method
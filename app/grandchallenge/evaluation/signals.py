@@ -1,11 +1,14 @@
-from typing import Union
-
+from django.conf import settings
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
 from grandchallenge.core.utils import disable_for_loaddata
 from grandchallenge.datasets.models import ImageSet
 from grandchallenge.evaluation.emails import send_new_result_email
+from grandchallenge.evaluation.leaderboard import (
+    invalidate_leaderboard,
+    invalidate_user_leaderboards,
+)
 from grandchallenge.evaluation.models import (
     Submission,
     Job,
@@ -13,7 +16,11 @@ from grandchallenge.evaluation.models import (
     Result,
     Config,
 )
-from grandchallenge.evaluation.tasks import calculate_ranks
+from grandchallenge.evaluation.tasks import (
+    schedule_ranks_update,
+    update_result_metrics,
+)
+from grandchallenge.profiles.models import UserProfile
 from grandchallenge.submission_conversion.models import (
     SubmissionToAnnotationSetJob
 )
@@ -47,12 +54,71 @@ def create_evaluation_job(
         )
 
 
+@receiver(post_save, sender=Submission)
+@disable_for_loaddata
+def submission_changed(
+    instance: Submission = None,
+    created: bool = False,
+    update_fields=None,
+    *_,
+    **__,
+):
+    """The leaderboard shows the details of the submissions"""
+    shown = {"comment", "publication_url", "supplementary_file"}
+
+    if not created and (update_fields is None or shown & set(update_fields)):
+        invalidate_leaderboard(challenge_pk=instance.challenge_id)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@disable_for_loaddata
+def user_changed(instance=None, update_fields=None, *_, **__):
+    """The leaderboard shows the username, which a login does not change"""
+    if update_fields is None or "username" in update_fields:
+        invalidate_user_leaderboards(user_pk=instance.pk)
+
+
+@receiver(post_save, sender=UserProfile)
+@disable_for_loaddata
+def user_profile_changed(
+    instance: UserProfile = None, update_fields=None, *_, **__
+):
+    """The leaderboard shows the mugshot of the user"""
+    if update_fields is None or "mugshot" in update_fields:
+        invalidate_user_leaderboards(user_pk=instance.user_id)
+
+
 @receiver(post_save, sender=Config)
+@disable_for_loaddata
+def recalculate_ranks(instance: Config = None, *_, **__):
+    """
+    Stores the values of the metrics and then recalculates the ranking when
+    the configuration changes
+    """
+    update_result_metrics.apply_async(
+        kwargs={"challenge_pk": instance.challenge.pk, "update_ranks": True}
+    )
+
+
+@receiver(post_save, sender=Result)
+@disable_for_loaddata
+def refresh_result_metrics(
+    instance: Result = None, update_fields=None, *_, **__
+):
+    """Stores the values of the metrics of a new or changed result"""
+    if update_fields is None or "metrics" in update_fields:
+        update_result_metrics(
+            challenge_pk=instance.challenge.pk, result_pk=instance.pk
+        )
+
+
 @receiver(post_save, sender=Result)
 @disable_for_loaddata
-def recalculate_ranks(instance: Union[Result, Config] = None, *_, **__):
-    """Recalculates the ranking on a new result"""
-    calculate_ranks.apply_async(kwargs={"challenge_pk": instance.challenge.pk})
+def update_result_rank(instance: Result = None, *_, **__):
+    """Updates the ranking for a new or changed result"""
+    schedule_ranks_update(
+        challenge_pk=instance.challenge.pk, result_pk=instance.pk
+    )
 
 
 @receiver(post_save, sender=Result)
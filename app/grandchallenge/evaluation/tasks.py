@@ -1,112 +1,666 @@
+import json
+import logging
+import time
 import uuid
-from statistics import mean, median
+from collections import OrderedDict
+from functools import partial
+from typing import Tuple, Dict, List, Optional
 
+import numpy as np
 from celery import shared_task
-from django.db.models import Q
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q, QuerySet
 
 from grandchallenge.challenges.models import Challenge
+from grandchallenge.evaluation.leaderboard import (
+    patch_leaderboard,
+    update_leaderboard,
+)
 from grandchallenge.evaluation.models import Result, Config
-from grandchallenge.evaluation.utils import rank_results, Metric
+from grandchallenge.evaluation.utils import (
+    Metric,
+    MetricValues,
+    Positions,
+    RankingIndex,
+    query_metric_values,
+    rank_values,
+    store_result_metrics,
+    unique_metrics,
+)
 
 
-def filter_by_creators_most_recent(*, results):
-    # Go through the results and only pass through the most recent
-    # submission for each user
-    users_seen = set()
-    filtered_qs = []
+logger = logging.getLogger(__name__)
 
-    for r in results:
-        creator = r.job.submission.creator
+RANKS_LOCK_TIMEOUT = settings.CELERY_TASK_TIME_LIMIT
+# A pending update that is not picked up in this time, eg. as its task was
+# lost, no longer absorbs new triggers
+RANKS_PENDING_TIMEOUT = 60 * 10
+RANKS_UPDATE_BATCH_SIZE = 1000
+# The size of the chunks that the ranking index is stored in, which must be
+# well under the 1MB item limit of memcached
+RANKING_INDEX_CHUNK_BYTES = 2 ** 19
 
-        if creator not in users_seen:
-            users_seen.add(creator)
-            filtered_qs.append(r)
 
-    return filtered_qs
+def filter_by_creators_most_recent(*, results: QuerySet) -> QuerySet:
+    # Only pass through the most recent submission for each user, selected
+    # in the database so that only one row per user is returned
+    most_recent = (
+        results.order_by("job__submission__creator", "-created")
+        .distinct("job__submission__creator")
+        .values("pk")
+    )
 
+    return results.filter(pk__in=most_recent)
 
-def filter_by_creators_best(*, results, ranks):
-    best_result_per_user = {}
 
-    for r in results:
-        creator = r.job.submission.creator
+def filter_by_creators_best(
+    *, values: MetricValues, ranks: Dict
+) -> MetricValues:
+    best_result_per_user = {}
 
+    for idx, (pk, creator) in enumerate(zip(values.pks, values.creators)):
         try:
-            this_rank = ranks[r.pk]
+            this_rank = ranks[pk]
         except KeyError:
             # This result was not ranked
             continue
 
         if creator not in best_result_per_user or (
-            this_rank < ranks[best_result_per_user[creator].pk]
+            this_rank < ranks[values.pks[best_result_per_user[creator]]]
         ):
-            best_result_per_user[creator] = r
+            best_result_per_user[creator] = idx
+
+    return values.subset(idx=sorted(best_result_per_user.values()))
+
+
+def ranking_index_key(*, challenge_pk: uuid.UUID) -> str:
+    return f"evaluation:ranking-index:{challenge_pk}"
+
+
+def _ranking_index_chunk_key(
+    *, challenge_pk: uuid.UUID, version: int, idx: int
+) -> str:
+    return f"{ranking_index_key(challenge_pk=challenge_pk)}:{version}:{idx}"
+
+
+def store_ranking_index(*, challenge_pk: uuid.UUID, index: RankingIndex):
+    """
+    Stores the ranking index of a challenge in the cache. A pickled index is
+    too large for a single cache item on large leaderboards, so the primary
+    keys and the keys of the results are stored as bytes in chunks of
+    RANKING_INDEX_CHUNK_BYTES, under a new version. The header that points
+    to the chunks is written last, so readers never see a partial index.
+    """
+    key = ranking_index_key(challenge_pk=challenge_pk)
+    previous = cache.get(key)
+
+    version = _incr(f"{key}:version")
+    pks, creators, keys = index.to_arrays()
+    # The creators are user ids, a missing creator is stored as -1
+    creators = np.array(
+        [-1 if c is None else c for c in creators], dtype=np.int64
+    )
+
+    row_bytes = 16 + creators.itemsize + keys.itemsize * len(index.metrics)
+    rows = max(RANKING_INDEX_CHUNK_BYTES // row_bytes, 1)
+
+    chunks = {
+        _ranking_index_chunk_key(
+            challenge_pk=challenge_pk, version=version, idx=idx
+        ): {
+            "pks": b"".join(pk.bytes for pk in pks[start : start + rows]),
+            "creators": creators[start : start + rows].tobytes(),
+            "keys": keys[start : start + rows].tobytes(),
+        }
+        for idx, start in enumerate(range(0, len(pks), rows))
+    }
+
+    failed = cache.set_many(chunks, None)
+
+    if failed:
+        logger.warning(
+            f"Could not store the ranking index of challenge {challenge_pk}"
+        )
+        cache.delete_many(list(chunks))
+        cache.delete(key)
+        return
+
+    cache.set(
+        key,
+        {
+            "version": version,
+            "metrics": index.metrics,
+            "score_method_choice": index.score_method_choice,
+            "display_choice": index.display_choice,
+            "chunks": len(chunks),
+        },
+        None,
+    )
+
+    if previous is not None:
+        _delete_ranking_index_chunks(
+            challenge_pk=challenge_pk, header=previous
+        )
+
+
+def load_ranking_index(*, challenge_pk: uuid.UUID) -> Optional[RankingIndex]:
+    """
+    Loads the ranking index of a challenge from the cache. Returns None if
+    the index, or any of its chunks, is not in the cache.
+    """
+    header = cache.get(ranking_index_key(challenge_pk=challenge_pk))
+
+    if header is None:
+        return None
+
+    chunk_keys = _get_ranking_index_chunk_keys(
+        challenge_pk=challenge_pk, header=header
+    )
+    chunks = cache.get_many(chunk_keys)
+
+    if len(chunks) != len(chunk_keys):
+        return None
+
+    pks = b"".join(chunks[k]["pks"] for k in chunk_keys)
+    creators = b"".join(chunks[k]["creators"] for k in chunk_keys)
+    keys = b"".join(chunks[k]["keys"] for k in chunk_keys)
+
+    return RankingIndex.from_arrays(
+        metrics=header["metrics"],
+        score_method_choice=header["score_method_choice"],
+        display_choice=header["display_choice"],
+        pks=[
+            uuid.UUID(bytes=pks[idx : idx + 16])
+            for idx in range(0, len(pks), 16)
+        ],
+        creators=[
+            None if c < 0 else c
+            for c in np.frombuffer(creators, dtype=np.int64).tolist()
+        ],
+        keys=np.frombuffer(keys, dtype=float),
+    )
+
+
+def _get_ranking_index_chunk_keys(
+    *, challenge_pk: uuid.UUID, header: Dict
+) -> List[str]:
+    return [
+        _ranking_index_chunk_key(
+            challenge_pk=challenge_pk, version=header["version"], idx=idx
+        )
+        for idx in range(header["chunks"])
+    ]
+
+
+def _delete_ranking_index_chunks(*, challenge_pk: uuid.UUID, header: Dict):
+    cache.delete_many(
+        _get_ranking_index_chunk_keys(challenge_pk=challenge_pk, header=header)
+    )
+
+
+def _ranks_key(*, challenge_pk: uuid.UUID, name: str) -> str:
+    return f"evaluation:ranks-{name}:{challenge_pk}"
 
-    return [r for r in best_result_per_user.values()]
+
+def _incr(key: str) -> int:
+    cache.add(key, 0, None)
+    return cache.incr(key)
+
+
+def schedule_ranks_update(
+    *, challenge_pk: uuid.UUID, result_pk: uuid.UUID = None
+):
+    """
+    Schedules an update of the ranks for this challenge. If an update is
+    already pending then this trigger is merged into it, so at most one
+    update is pending per challenge at any time. Leave result_pk empty to
+    schedule a full recalculation.
+    """
+    trigger = _incr(_ranks_key(challenge_pk=challenge_pk, name="triggers"))
+    pending_key = _ranks_key(challenge_pk=challenge_pk, name="pending")
+
+    if cache.add(
+        pending_key,
+        {"trigger": trigger, "result_pk": result_pk},
+        RANKS_PENDING_TIMEOUT,
+    ):
+        try:
+            process_ranks_update.apply_async(
+                kwargs={"challenge_pk": challenge_pk}
+            )
+        except Exception:
+            # Otherwise the next triggers would merge into an update that
+            # never runs
+            cache.delete(pending_key)
+            raise
+
+        _incr(_ranks_key(challenge_pk=challenge_pk, name="scheduled"))
+    else:
+        _incr(_ranks_key(challenge_pk=challenge_pk, name="merged"))
+
+
+def get_ranks_update_stats(*, challenge_pk: uuid.UUID) -> Dict[str, int]:
+    """
+    Returns the number of triggers for a ranks update of this challenge, how
+    many of those were scheduled as a task and how many were merged into an
+    already pending task.
+    """
+    names = ("triggers", "scheduled", "merged")
+    values = cache.get_many(
+        [_ranks_key(challenge_pk=challenge_pk, name=n) for n in names]
+    )
+    return {
+        n: values.get(_ranks_key(challenge_pk=challenge_pk, name=n), 0)
+        for n in names
+    }
 
 
 @shared_task
-def calculate_ranks(*, challenge_pk: uuid.UUID):
-    challenge = Challenge.objects.get(pk=challenge_pk)
-    display_choice = challenge.evaluation_config.result_display_choice
-    score_method_choice = challenge.evaluation_config.scoring_method_choice
+def process_ranks_update(*, challenge_pk: uuid.UUID):
+    """
+    Runs the pending ranks update for this challenge. Only one update can run
+    per challenge at a time, if another one is running this task does
+    nothing and the running update schedules the pending update once it is
+    done.
+    """
+    lock_key = _ranks_key(challenge_pk=challenge_pk, name="lock")
+    pending_key = _ranks_key(challenge_pk=challenge_pk, name="pending")
+    done_key = _ranks_key(challenge_pk=challenge_pk, name="done")
+
+    if not cache.add(lock_key, True, RANKS_LOCK_TIMEOUT):
+        return
+
+    try:
+        pending = cache.get(pending_key)
+        # New triggers will now schedule a new task
+        cache.delete(pending_key)
+
+        triggers = cache.get(
+            _ranks_key(challenge_pk=challenge_pk, name="triggers")
+        )
+
+        if pending is None and triggers == cache.get(done_key):
+            # The triggers were handled by an earlier update
+            return
+
+        if (
+            pending is not None
+            and pending["result_pk"] is not None
+            and pending["trigger"] == triggers
+        ):
+            # Nothing else happened since this update was scheduled
+            stats = update_rank(
+                challenge_pk=challenge_pk, result_pk=pending["result_pk"]
+            )
+        else:
+            stats = calculate_ranks(challenge_pk=challenge_pk)
 
+        cache.set(done_key, triggers, None)
+
+        return stats
+    finally:
+        cache.delete(lock_key)
+
+        if cache.get(pending_key) is not None:
+            # A trigger arrived while this update ran, its task could have
+            # found the lock taken
+            process_ranks_update.apply_async(
+                kwargs={"challenge_pk": challenge_pk}
+            )
+
+
+def get_ranking_metrics(*, config: Config) -> Tuple[Metric, ...]:
     metrics = (
         Metric(
-            path=challenge.evaluation_config.score_jsonpath,
-            reverse=(
-                challenge.evaluation_config.score_default_sort
-                == Config.DESCENDING
-            ),
+            path=config.score_jsonpath,
+            reverse=(config.score_default_sort == Config.DESCENDING),
         ),
     )
 
-    if score_method_choice != Config.ABSOLUTE:
+    if config.scoring_method_choice != Config.ABSOLUTE:
         metrics += tuple(
             Metric(path=col["path"], reverse=col["order"] == Config.DESCENDING)
-            for col in challenge.evaluation_config.extra_results_columns
+            for col in config.extra_results_columns
         )
 
+    return unique_metrics(metrics=metrics)
+
+
+def get_result_metric_paths(*, config: Config) -> Tuple[str, ...]:
+    """ The jsonpaths of the metrics that are shown on the leaderboard """
+    paths = [config.score_jsonpath]
+    paths += [col["path"] for col in config.extra_results_columns]
+    return tuple(OrderedDict((p, None) for p in paths if p))
+
+
+@shared_task
+def update_result_metrics(
+    *,
+    challenge_pk: uuid.UUID,
+    result_pk: uuid.UUID = None,
+    update_ranks: bool = False,
+):
+    """
+    Stores the values of the leaderboard metrics of a result as
+    ResultMetrics. Leave result_pk empty to update all of the results of
+    the challenge, eg. after the configuration changed. The ranks are read
+    from the stored values, so set update_ranks to update them afterwards.
+    """
+    config = Config.objects.get(challenge__pk=challenge_pk)
+    paths = get_result_metric_paths(config=config)
+
+    results = Result.objects.filter(challenge__pk=challenge_pk)
+
+    if result_pk is not None:
+        results = results.filter(pk=result_pk)
+
+    store_result_metrics(results=results, paths=paths)
+
+    if update_ranks:
+        schedule_ranks_update(challenge_pk=challenge_pk, result_pk=result_pk)
+
+
+def get_score_method(*, config: Config, metrics: Tuple[Metric, ...]):
+    score_method_choice = config.scoring_method_choice
+
     if score_method_choice == Config.ABSOLUTE and len(metrics) == 1:
-        score_method = lambda x: list(x)[0]
+        return lambda x: x[:, 0]
     elif score_method_choice == Config.MEAN:
-        score_method = mean
+        return partial(np.mean, axis=1)
     elif score_method_choice == Config.MEDIAN:
-        score_method = median
+        return partial(np.median, axis=1)
     else:
         raise NotImplementedError
 
-    valid_results = (
-        Result.objects.filter(Q(challenge=challenge), Q(published=True))
-        .order_by("-created")
-        .select_related("job__submission")
-    )
+
+def get_ranking_index(*, config: Config) -> RankingIndex:
+    """
+    Gets the ranking index of the results that are shown on the current
+    leaderboard of a challenge. The cached index is used if it is valid,
+    otherwise the index is built from the ranked results and cached.
+    """
+    metrics = get_ranking_metrics(config=config)
+    index = load_ranking_index(challenge_pk=config.challenge_id)
+
+    if index is None or not index.matches(
+        metrics=metrics,
+        score_method_choice=config.scoring_method_choice,
+        display_choice=config.result_display_choice,
+    ):
+        index = RankingIndex(
+            metrics=metrics,
+            score_method_choice=config.scoring_method_choice,
+            display_choice=config.result_display_choice,
+        )
+        values = query_metric_values(
+            challenge_pk=config.challenge_id,
+            results=Result.objects.filter(
+                Q(challenge__pk=config.challenge_id),
+                Q(published=True),
+                ~Q(rank=0),
+            ),
+            metrics=metrics,
+        )
+        index.add_values(
+            pks=values.pks, values=values.values, creators=values.creators
+        )
+        store_ranking_index(challenge_pk=config.challenge_id, index=index)
+
+    return index
+
+
+def rank_candidate(*, config: Config, metrics: Dict, creator=None) -> Dict:
+    """
+    Calculates the position that a result with these metrics would get on
+    the current leaderboard, without creating the result. If the
+    leaderboard only shows one result per participant the candidate is
+    ranked against the results that are shown. The candidate takes the
+    place of the result that is shown for its creator if it is the most
+    recent result, or if it outranks the shown result when the best result
+    is shown.
+
+    Returns a rank of 0 if the candidate would not be ranked.
+    """
+    ranking_metrics = get_ranking_metrics(config=config)
+    score_method = get_score_method(config=config, metrics=ranking_metrics)
+    index = get_ranking_index(config=config)
+
+    shown_pks = []
+
+    if creator is not None and config.result_display_choice != Config.ALL:
+        shown_pks = index.get_pks(creator=creator)
+
+    if shown_pks and config.result_display_choice == Config.BEST:
+        alongside = index.rank_candidate(
+            metrics=metrics, score_method=score_method
+        )
+        shown_rank = min(
+            index.rank(score_method=score_method).ranks[pk] for pk in shown_pks
+        )
+
+        if alongside is None or alongside[0] > shown_rank:
+            # The shown result stays, so the candidate is ranked alongside it
+            shown_pks = []
+
+    for pk in shown_pks:
+        index.remove_result(pk=pk)
+
+    position = index.rank_candidate(metrics=metrics, score_method=score_method)
+
+    if position is None:
+        return {"rank": 0, "rank_score": 0.0, "rank_per_metric": {}}
+
+    rank, rank_score, rank_per_metric = position
+
+    return {
+        "rank": rank,
+        "rank_score": rank_score,
+        "rank_per_metric": rank_per_metric,
+    }
+
+
+@shared_task
+def calculate_ranks(*, challenge_pk: uuid.UUID):
+    challenge = Challenge.objects.get(pk=challenge_pk)
+    config = challenge.evaluation_config
+    display_choice = config.result_display_choice
+
+    metrics = get_ranking_metrics(config=config)
+    score_method = get_score_method(config=config, metrics=metrics)
+
+    valid_results = Result.objects.filter(
+        Q(challenge=challenge), Q(published=True)
+    ).order_by("-created")
 
     if display_choice == Config.MOST_RECENT:
         valid_results = filter_by_creators_most_recent(results=valid_results)
-    elif display_choice == Config.BEST:
-        all_positions = rank_results(
-            results=valid_results, metrics=metrics, score_method=score_method
+
+    values = query_metric_values(
+        challenge_pk=challenge_pk, results=valid_results, metrics=metrics
+    )
+
+    if display_choice == Config.BEST:
+        all_positions = rank_values(
+            pks=values.pks,
+            values=values.values,
+            metrics=metrics,
+            score_method=score_method,
         )
-        valid_results = filter_by_creators_best(
-            results=valid_results, ranks=all_positions.ranks
+        values = filter_by_creators_best(
+            values=values, ranks=all_positions.ranks
         )
 
-    final_positions = rank_results(
-        results=valid_results, metrics=metrics, score_method=score_method
+    # The index holds the results that are shown on the leaderboard
+    index = RankingIndex(
+        metrics=metrics,
+        score_method_choice=config.scoring_method_choice,
+        display_choice=display_choice,
+    )
+    index.add_values(
+        pks=values.pks, values=values.values, creators=values.creators
     )
+    final_positions = index.rank(score_method=score_method)
+
+    stats = _update_positions(
+        positions=final_positions,
+        results=Result.objects.filter(Q(challenge=challenge)),
+    )
+
+    store_ranking_index(challenge_pk=challenge_pk, index=index)
+
+    update_leaderboard(challenge_pk=challenge_pk)
+
+    return stats
 
-    for res in Result.objects.filter(Q(challenge=challenge)):
-        try:
-            rank = final_positions.ranks[res.pk]
-            rank_score = final_positions.rank_scores[res.pk]
-            rank_per_metric = final_positions.rank_per_metric[res.pk]
-        except KeyError:
-            # This result will be excluded from the display
-            rank = 0
-            rank_score = 0.0
-            rank_per_metric = {}
 
-        Result.objects.filter(pk=res.pk).update(
-            rank=rank, rank_score=rank_score, rank_per_metric=rank_per_metric
+@shared_task
+def update_rank(*, challenge_pk: uuid.UUID, result_pk: uuid.UUID):
+    """
+    Updates the leaderboard for a single new or changed result. Only the
+    results whose position changed are written back to the database. Falls
+    back to calculating all of the ranks if the leaderboard cannot be
+    updated incrementally.
+    """
+    config = Config.objects.get(challenge__pk=challenge_pk)
+    index = load_ranking_index(challenge_pk=challenge_pk)
+    metrics = get_ranking_metrics(config=config)
+
+    # Only the leaderboards that display all results can be updated
+    # incrementally, as otherwise a new result could replace any other result
+    if (
+        index is None
+        or config.result_display_choice != Config.ALL
+        or not index.matches(
+            metrics=metrics,
+            score_method_choice=config.scoring_method_choice,
+            display_choice=config.result_display_choice,
         )
+    ):
+        return calculate_ranks(challenge_pk=challenge_pk)
+
+    score_method = get_score_method(config=config, metrics=metrics)
+    previous_positions = index.rank(score_method=score_method)
+
+    # Only the values of the metrics are read, rather than the whole result
+    values = query_metric_values(
+        challenge_pk=challenge_pk,
+        results=Result.objects.filter(pk=result_pk, published=True),
+        metrics=metrics,
+    )
+
+    index.remove_result(pk=result_pk)
+    index.add_values(
+        pks=values.pks, values=values.values, creators=values.creators
+    )
+
+    positions = index.rank(score_method=score_method)
+
+    changed_pks = {
+        pk
+        for pk in set(previous_positions.ranks) | set(positions.ranks)
+        if _get_position(positions=previous_positions, pk=pk)
+        != _get_position(positions=positions, pk=pk)
+    }
+    # The result itself is always checked as its rank could be out of sync
+    changed_pks.add(result_pk)
+
+    stats = _update_positions(
+        positions=positions, results=Result.objects.filter(pk__in=changed_pks)
+    )
+
+    store_ranking_index(challenge_pk=challenge_pk, index=index)
+
+    patch_leaderboard(
+        challenge_pk=challenge_pk,
+        previous_ranks={
+            pk: previous_positions.ranks.get(pk, 0) for pk in changed_pks
+        },
+    )
+
+    return stats
+
+
+def _get_position(*, positions: Positions, pk) -> Tuple[int, float, Dict]:
+    try:
+        return (
+            positions.ranks[pk],
+            positions.rank_scores[pk],
+            positions.rank_per_metric[pk],
+        )
+    except KeyError:
+        # This result will be excluded from the display
+        return 0, 0.0, {}
+
+
+def _update_positions(
+    *, positions: Positions, results: QuerySet
+) -> Dict[str, float]:
+    """
+    Writes the positions of the results back to the database. Only the
+    results whose position changed are updated, in batches of
+    RANKS_UPDATE_BATCH_SIZE rows per statement.
+
+    Returns the number of rows that were updated and the elapsed time.
+    """
+    start = time.monotonic()
+
+    changed = []
+
+    for pk, *current in results.values_list(
+        "pk", "rank", "rank_score", "rank_per_metric"
+    ):
+        position = _get_position(positions=positions, pk=pk)
+
+        if tuple(current) != position:
+            changed.append((pk, *position))
+
+    with transaction.atomic():
+        for idx in range(0, len(changed), RANKS_UPDATE_BATCH_SIZE):
+            _bulk_update_positions(
+                rows=changed[idx : idx + RANKS_UPDATE_BATCH_SIZE]
+            )
+
+    stats = {"rows": len(changed), "seconds": time.monotonic() - start}
+
+    logger.info(
+        f"Updated the positions of {stats['rows']} results in "
+        f"{stats['seconds']:.3f}s"
+    )
+
+    return stats
+
+
+def _bulk_update_positions(*, rows: List[Tuple[uuid.UUID, int, float, Dict]]):
+    """ Updates the positions of many results with a single statement """
+    if not rows:
+        return
+
+    meta = Result._meta
+    columns = [
+        meta.get_field(f).column
+        for f in ("id", "rank", "rank_score", "rank_per_metric")
+    ]
+
+    values = ", ".join(
+        "(%s::uuid, %s::integer, %s::double precision, %s::jsonb)"
+        for _ in rows
+    )
+    params = [
+        p
+        for pk, rank, rank_score, rank_per_metric in rows
+        for p in (str(pk), rank, rank_score, json.dumps(rank_per_metric))
+    ]
+
+    sql = (
+        f'UPDATE "{meta.db_table}" AS r '
+        f'SET "{columns[1]}" = v.rank, '
+        f'"{columns[2]}" = v.rank_score, '
+        f'"{columns[3]}" = v.rank_per_metric '
+        f"FROM (VALUES {values}) AS v (id, rank, rank_score, rank_per_metric) "
+        f'WHERE r."{columns[0]}" = v.id'
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
@@ -1,14 +1,59 @@
 import json
+from functools import lru_cache
+from typing import Callable, Any
 
 from django import template
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 
-from grandchallenge.teams.models import Team
+from grandchallenge.teams.utils import get_team_map
 
 register = template.Library()
 
 
+JSONPATH_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=JSONPATH_CACHE_SIZE)
+def compile_jsonpath(jsonpath: str) -> Callable[[Any], Any]:
+    """
+    Compiles a dotted jsonpath into a function that gets the value from an
+    object, see get_jsonpath. Segments that are integers are also used as
+    an index when the object at that level is a list, eg. "dice.0".
+
+    The compiled functions are cached as the same paths are used for every
+    result on a leaderboard.
+    """
+    segments = []
+
+    for key in jsonpath.split("."):
+        try:
+            index = int(key)
+        except ValueError:
+            index = None
+
+        segments.append((key, index))
+
+    segments = tuple(segments)
+
+    def getter(obj):
+        try:
+            val = obj
+
+            for key, index in segments:
+                if index is not None and isinstance(val, list):
+                    val = val[index]
+                else:
+                    val = val[key]
+
+            return val
+
+        except (KeyError, IndexError, TypeError):
+            return ""
+
+    return getter
+
+
 @register.filter
 def get_jsonpath(obj: dict, jsonpath):
     """
@@ -20,18 +65,7 @@ def get_jsonpath(obj: dict, jsonpath):
     :param jsonpath: The path to the object (singular)
     :return: The most relevant object in the dictionary
     """
-
-    try:
-        keys = jsonpath.split(".")
-        val = obj
-
-        for key in keys:
-            val = val[key]
-
-        return val
-
-    except KeyError:
-        return ""
+    return compile_jsonpath(jsonpath)(obj)
 
 
 @register.filter
@@ -82,13 +116,11 @@ def json_dumps(obj: dict):
 @register.filter
 def get_team_html(obj):
     try:
-        team = Team.objects.get(
-            challenge=obj.challenge,
-            teammember__user=obj.job.submission.creator,
-        )
-        return format_html(
-            '<a href="{}">{}</a>', team.get_absolute_url(), team.name
-        )
-
-    except Exception:
+        team = get_team_map(challenge_pk=obj.challenge_id)[
+            obj.job.submission.creator_id
+        ]
+    except (KeyError, AttributeError):
+        # The user is not in a team, or the result does not have a creator
         return ""
+
+    return format_html('<a href="{}">{}</a>', team["url"], team["name"])
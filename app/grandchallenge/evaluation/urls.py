@@ -12,6 +12,8 @@ from grandchallenge.evaluation.views import (
     SubmissionList,
     JobList,
     ResultList,
+    ResultExport,
+    ResultWhatIf,
     MethodDetail,
     SubmissionDetail,
     JobDetail,
@@ -63,6 +65,8 @@ urlpatterns = [
     path("jobs/create/", JobCreate.as_view(), name="job-create"),
     path("jobs/<uuid:pk>/", JobDetail.as_view(), name="job-detail"),
     path("results/", ResultList.as_view(), name="result-list"),
+    path("results/export/", ResultExport.as_view(), name="result-export"),
+    path("results/what-if/", ResultWhatIf.as_view(), name="result-what-if"),
     path("results/<uuid:pk>/", ResultDetail.as_view(), name="result-detail"),
     path(
         "results/<uuid:pk>/update/",
@@ -1,11 +1,19 @@
-from collections import OrderedDict
-from typing import Tuple, NamedTuple, List, Callable, Iterable, Dict
+from bisect import insort, bisect_left
+from collections import OrderedDict, defaultdict
+from typing import Tuple, NamedTuple, List, Callable, Iterable, Dict, Optional
 
-from grandchallenge.evaluation.models import Result
+import numpy as np
+from django.contrib.postgres.fields import JSONField
+from django.db import transaction
+from django.db.models import CharField, Func, Value, QuerySet
+
+from grandchallenge.evaluation.models import Config, Result, ResultMetric
 from grandchallenge.evaluation.templatetags.evaluation_extras import (
-    get_jsonpath
+    compile_jsonpath
 )
 
+RESULT_METRICS_BATCH_SIZE = 1000
+
 
 class Metric(NamedTuple):
     path: str
@@ -18,6 +26,48 @@ class Positions(NamedTuple):
     rank_per_metric: Dict[str, Dict[str, float]]
 
 
+class MetricValues(NamedTuple):
+    pks: List
+    creators: List
+    values: np.ndarray
+
+    def subset(self, *, idx: List[int]) -> "MetricValues":
+        return MetricValues(
+            pks=[self.pks[i] for i in idx],
+            creators=[self.creators[i] for i in idx],
+            values=self.values[idx],
+        )
+
+
+class JSONPath(Func):
+    """
+    Gets the json object at a dotted path from a JSONField in the database,
+    the equivalent of get_jsonpath. Evaluates to NULL if the path does not
+    exist.
+    """
+
+    arg_joiner = " #> "
+    template = "%(expressions)s"
+
+    def __init__(self, expression, jsonpath: str, **extra):
+        super().__init__(
+            expression,
+            Value(jsonpath.split(".")),
+            output_field=JSONField(),
+            **extra,
+        )
+
+
+class JSONTypeOf(Func):
+    """
+    Gets the type of a json object in the database, eg. "number", or "null"
+    for a json null. Evaluates to NULL if the object does not exist.
+    """
+
+    function = "jsonb_typeof"
+    output_field = CharField()
+
+
 def rank_results(
     *,
     results: Tuple[Result, ...],
@@ -27,90 +77,458 @@ def rank_results(
     """
     Calculates the overall rank for each result, along with the rank_score
     and the rank per metric.
+
+    The score_method must take a 2D array of ranks (results x metrics) and
+    reduce it along axis 1, eg. partial(np.mean, axis=1).
+    """
+    metrics = unique_metrics(metrics=metrics)
+
+    pks, values = _filter_valid_results(results=results, metrics=metrics)
+
+    return rank_values(
+        pks=pks, values=values, metrics=metrics, score_method=score_method
+    )
+
+
+def is_metric_value(value) -> bool:
+    """ Whether a value from the metrics json is a number """
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_rankable(value) -> bool:
+    """
+    A null value is ranked last, a result with any other value that is not a
+    number is not ranked, as if the metric was missing
+    """
+    return value is None or is_metric_value(value)
+
+
+def query_metric_values(
+    *, challenge_pk, results: QuerySet, metrics: Tuple[Metric, ...]
+) -> MetricValues:
+    """
+    Gets the values of the metrics for the results that have all of the
+    metrics, see _is_rankable. The values are read from the ResultMetrics of
+    the challenge, see store_result_metrics, rather than from the metrics
+    json, so that the index on the values is used.
+
+    The order of the results is preserved.
+    """
+    paths = [m.path for m in metrics]
+
+    stored = defaultdict(dict)
+
+    for result_pk, path, value in ResultMetric.objects.filter(
+        challenge__pk=challenge_pk, path__in=paths, result__in=results
+    ).values_list("result", "path", "value"):
+        stored[result_pk][path] = value
+
+    pks = []
+    creators = []
+    values = []
+
+    for pk, creator in results.values_list("pk", "job__submission__creator"):
+        row = stored.get(pk, {})
+
+        if not all(p in row for p in paths):
+            continue
+
+        pks.append(pk)
+        creators.append(creator)
+        values.append([row[p] for p in paths])
+
+    return MetricValues(
+        pks=pks,
+        creators=creators,
+        values=np.array(values, dtype=float).reshape(
+            (len(values), len(metrics))
+        ),
+    )
+
+
+def store_result_metrics(*, results: QuerySet, paths: Tuple[str, ...]):
+    """
+    Replaces the stored metric values of the results with the values at
+    each of the paths in Result.metrics. Only values that are numbers are
+    stored, a json null is stored as NULL so that it is ranked last. The
+    values are extracted from the metrics json in the database.
+    """
+    annotations = {}
+
+    for idx, p in enumerate(paths):
+        annotations[f"metric_{idx}"] = JSONPath("metrics", p)
+        annotations[f"type_{idx}"] = JSONTypeOf(JSONPath("metrics", p))
+
+    rows = results.annotate(**annotations).values_list(
+        "pk", "challenge", *annotations
+    )
+
+    with transaction.atomic():
+        ResultMetric.objects.filter(result__in=results).delete()
+        ResultMetric.objects.bulk_create(
+            (
+                ResultMetric(
+                    result_id=pk, challenge_id=challenge_pk, path=p, value=v
+                )
+                for pk, challenge_pk, *values in rows
+                for p, v, t in zip(paths, values[::2], values[1::2])
+                if is_metric_value(v) or t == "null"
+            ),
+            batch_size=RESULT_METRICS_BATCH_SIZE,
+        )
+
+
+def rank_values(
+    *,
+    pks: List,
+    values: np.ndarray,
+    metrics: Tuple[Metric, ...],
+    score_method: Callable,
+) -> Positions:
+    """
+    Ranks a matrix of metric values where each row belongs to the result
+    with the primary key in pks, and each column to the metric in metrics.
+    """
+    metric_ranks = _get_rank_per_metric(values=values, metrics=metrics)
+
+    return _ranks_to_positions(
+        pks=pks,
+        metric_ranks=metric_ranks,
+        metrics=metrics,
+        score_method=score_method,
+    )
+
+
+class RankingIndex:
+    """
+    Keeps the values of each metric for the ranked results of a challenge
+    in sorted order, so that a single result can be added or removed without
+    reloading and re-sorting all of the other results.
+
+    The creator of each result is kept too, so that the results of a
+    participant can be found on the leaderboards that show one result per
+    participant.
+
+    The index can be converted to and from a matrix of its keys with
+    to_arrays and from_arrays, eg. to store it in a compact form.
     """
 
-    results = _filter_valid_results(results=results, metrics=metrics)
+    def __init__(
+        self,
+        *,
+        metrics: Tuple[Metric, ...],
+        score_method_choice: str,
+        display_choice: str = Config.ALL,
+    ):
+        self.metrics = unique_metrics(metrics=metrics)
+        self.score_method_choice = score_method_choice
+        self.display_choice = display_choice
 
-    rank_per_metric = _get_rank_per_metric(results=results, metrics=metrics)
+        # The keys are the metric values negated for the metrics where a
+        # higher value is better, so the best key is always the lowest
+        self._keys = {}
+        self._sorted_keys = [[] for _ in self.metrics]
+        self._creators = {}
 
-    rank_scores = {
-        pk: score_method([m for m in metrics.values()])
-        for pk, metrics in rank_per_metric.items()
-    }
+        # The matrices of keys and ranks per metric of the last ranking
+        self._ranked = None
+
+    @classmethod
+    def from_arrays(
+        cls,
+        *,
+        metrics: Tuple[Metric, ...],
+        score_method_choice: str,
+        display_choice: str,
+        pks: List,
+        creators: List,
+        keys: np.ndarray,
+    ) -> "RankingIndex":
+        """
+        Creates an index from the primary keys and creators of the results
+        and the matrix of their keys, as returned by to_arrays.
+        """
+        index = cls(
+            metrics=metrics,
+            score_method_choice=score_method_choice,
+            display_choice=display_choice,
+        )
+        keys = keys.reshape((len(pks), len(index.metrics)))
+
+        index._keys = dict(zip(pks, map(tuple, keys.tolist())))
+        index._creators = dict(zip(pks, creators))
+        index._sorted_keys = [
+            np.sort(keys[:, idx]).tolist() for idx in range(keys.shape[1])
+        ]
+
+        return index
+
+    def to_arrays(self) -> Tuple[List, List, np.ndarray]:
+        """
+        Gets the primary keys and creators of the results in the index,
+        along with the matrix of their keys where the rows match the primary
+        keys.
+        """
+        pks = list(self._keys)
+        creators = [self._creators[pk] for pk in pks]
+        keys = np.array([self._keys[pk] for pk in pks], dtype=float)
+        return pks, creators, keys.reshape((len(pks), len(self.metrics)))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, pk):
+        return pk in self._keys
+
+    def matches(
+        self,
+        *,
+        metrics: Tuple[Metric, ...],
+        score_method_choice: str,
+        display_choice: str,
+    ) -> bool:
+        """ Is this index valid for the given ranking configuration? """
+        return (
+            self.metrics == unique_metrics(metrics=metrics)
+            and self.score_method_choice == score_method_choice
+            and self.display_choice == display_choice
+        )
+
+    def add_values(
+        self, *, pks: List, values: np.ndarray, creators: List = None
+    ):
+        """
+        Adds, or replaces, the metric values of valid results, the columns
+        of values must match the metrics of this index.
+        """
+        if creators is None:
+            creators = [None] * len(pks)
+
+        for pk, creator, row in zip(
+            pks, creators, self._values_to_keys(values=values)
+        ):
+            self.remove_result(pk=pk)
+            self._insert(pk=pk, keys=row, creator=creator)
+
+    def get_pks(self, *, creator) -> List:
+        """ The primary keys of the results of a creator in the index """
+        return [pk for pk, c in self._creators.items() if c == creator]
+
+    def remove_result(self, *, pk):
+        try:
+            keys = self._keys.pop(pk)
+        except KeyError:
+            return
+
+        del self._creators[pk]
+        self._ranked = None
+
+        for sorted_keys, key in zip(self._sorted_keys, keys):
+            del sorted_keys[bisect_left(sorted_keys, key)]
+
+    def rank(self, *, score_method: Callable) -> Positions:
+        """Calculates the positions of all of the results in the index"""
+        pks, keys, metric_ranks = self._get_ranked()
+
+        return _ranks_to_positions(
+            pks=pks,
+            metric_ranks=metric_ranks,
+            metrics=self.metrics,
+            score_method=score_method,
+        )
+
+    def rank_candidate(
+        self, *, metrics: Dict, score_method: Callable
+    ) -> Optional[Tuple[int, float, Dict[str, int]]]:
+        """
+        Calculates the rank, rank_score and rank per metric that a result
+        with these metrics would get if it was added to the index, without
+        changing the index. Returns None if the candidate would not be
+        ranked as it is missing some of the metrics.
+
+        Raises a ValueError if a metric value is not a number.
+        """
+        values = [compile_jsonpath(m.path)(metrics) for m in self.metrics]
+
+        if any(v == "" for v in values):
+            return None
+
+        try:
+            values = np.array([values], dtype=float)
+        except TypeError:
+            raise ValueError("The metric values must be numbers")
+
+        candidate = np.array(self._values_to_keys(values=values)[0])
+
+        _, keys, metric_ranks = self._get_ranked()
+
+        candidate_ranks = np.array(
+            [
+                bisect_left(sorted_keys, key) + 1
+                for sorted_keys, key in zip(self._sorted_keys, candidate)
+            ],
+            dtype=int,
+        )
+        # The other results move down one place for each metric where the
+        # candidate is strictly better
+        other_ranks = metric_ranks + (candidate[np.newaxis, :] < keys)
+
+        candidate_score = float(
+            np.asarray(score_method(candidate_ranks[np.newaxis, :]))[0]
+        )
+        other_scores = np.asarray(score_method(other_ranks))
+
+        return (
+            int(np.count_nonzero(other_scores < candidate_score)) + 1,
+            candidate_score,
+            dict(
+                zip((m.path for m in self.metrics), candidate_ranks.tolist())
+            ),
+        )
+
+    def _get_ranked(self) -> Tuple[List, np.ndarray, np.ndarray]:
+        """
+        Gets the primary keys of the results in the index, along with the
+        matrices of their keys and their ranks per metric.
+        """
+        if self._ranked is None:
+            pks, _, keys = self.to_arrays()
+
+            metric_ranks = np.empty(keys.shape, dtype=int)
+
+            for idx, sorted_keys in enumerate(self._sorted_keys):
+                # The rank is one more than the number of strictly better keys
+                metric_ranks[:, idx] = (
+                    np.searchsorted(sorted_keys, keys[:, idx], side="left") + 1
+                )
+
+            self._ranked = pks, keys, metric_ranks
+
+        return self._ranked
+
+    def _insert(self, *, pk, keys: Tuple[float, ...], creator):
+        self._ranked = None
+        self._keys[pk] = keys
+        self._creators[pk] = creator
+
+        for sorted_keys, key in zip(self._sorted_keys, keys):
+            insort(sorted_keys, key)
+
+    def _values_to_keys(
+        self, *, values: np.ndarray
+    ) -> List[Tuple[float, ...]]:
+        signs = np.array([-1 if m.reverse else 1 for m in self.metrics])
+        keys = values * signs
+        # Missing values are ranked last, and all tie with each other
+        keys[np.isnan(keys)] = np.inf
+        return [tuple(row) for row in keys.tolist()]
+
+
+def unique_metrics(*, metrics: Tuple[Metric, ...]) -> Tuple[Metric, ...]:
+    """Only the last definition of a metric is used if a path is repeated"""
+    return tuple(OrderedDict((m.path, m) for m in metrics).values())
+
+
+def _ranks_to_positions(
+    *,
+    pks: List,
+    metric_ranks: np.ndarray,
+    metrics: Tuple[Metric, ...],
+    score_method: Callable,
+) -> Positions:
+    rank_scores = np.asarray(score_method(metric_ranks))
+    ranks = _scores_to_ranks(scores=rank_scores, reverse=False)
+
+    paths = [m.path for m in metrics]
 
     return Positions(
-        ranks=_scores_to_ranks(scores=rank_scores, reverse=False),
-        rank_scores=rank_scores,
-        rank_per_metric=rank_per_metric,
+        ranks=dict(zip(pks, ranks.tolist())),
+        rank_scores=dict(zip(pks, rank_scores.tolist())),
+        rank_per_metric={
+            pk: dict(zip(paths, r))
+            for pk, r in zip(pks, metric_ranks.tolist())
+        },
     )
 
 
 def _filter_valid_results(
     *, results: Iterable[Result], metrics: Tuple[Metric, ...]
-) -> List[Result]:
-    """ Ensure that all of the metrics are in every result """
-    return [
-        res
-        for res in results
-        if all(get_jsonpath(res.metrics, m.path) != "" for m in metrics)
-    ]
+) -> Tuple[List, np.ndarray]:
+    """
+    Ensure that all of the metrics are in every result, see _is_rankable,
+    and extract the values of the metrics for the valid results.
+
+    Returns the primary keys of the valid results and a matrix of the
+    metric values, where the rows match the primary keys and the columns
+    match the metrics.
+    """
+    getters = [compile_jsonpath(m.path) for m in metrics]
+
+    pks = []
+    rows = []
+
+    for res in results:
+        row = [getter(res.metrics) for getter in getters]
+
+        if all(_is_rankable(v) for v in row):
+            pks.append(res.pk)
+            rows.append(row)
+
+    values = np.array(rows, dtype=float).reshape((len(rows), len(metrics)))
+
+    return pks, values
 
 
 def _get_rank_per_metric(
-    *, results: Iterable[Result], metrics: Tuple[Metric, ...]
-) -> Dict[str, Dict[str, float]]:
-    """
-    Takes results and calculates the rank for each of the individual metrics
-
-    Returns a dictionary where the key is the pk of the result, and the
-    values is another dictionary where the key is the path of the metric and
-    the value is the rank of this result for this metric
-    """
-    metric_rank = {}
-    for metric in metrics:
-        # Extract the value of the metric for this primary key and sort on the
-        # value of the metric
-        metric_scores = {
-            res.pk: get_jsonpath(res.metrics, metric.path) for res in results
-        }
-        metric_rank[metric.path] = _scores_to_ranks(
-            scores=metric_scores, reverse=metric.reverse
+    *, values: np.ndarray, metrics: Tuple[Metric, ...]
+) -> np.ndarray:
+    """
+    Takes a matrix of metric values (results x metrics) and calculates the
+    rank for each of the individual metrics.
+
+    Returns a matrix of the same shape where each value is the rank of this
+    result for this metric
+    """
+    ranks = np.empty(values.shape, dtype=int)
+
+    for idx, metric in enumerate(metrics):
+        ranks[:, idx] = _scores_to_ranks(
+            scores=values[:, idx], reverse=metric.reverse
         )
 
-    return {
-        res.pk: {
-            metric_path: ranks[res.pk]
-            for metric_path, ranks in metric_rank.items()
-        }
-        for res in results
-    }
+    return ranks
 
 
 def _scores_to_ranks(
-    *, scores: Dict, reverse: bool = False
-) -> Dict[str, float]:
+    *, scores: np.ndarray, reverse: bool = False
+) -> np.ndarray:
     """
     Go from a score (a scalar) to a rank (integer). If two scalars are the
-    same then they will have the same rank.
-
-    Takes a dictionary where the keys are the pk of the results and the values
-    are the scores.
+    same then they will have the same rank, and the next rank is skipped.
 
-    Outputs a dictionary where they keys are the pk of the results and the
-    values are the ranks.
+    Takes a 1D array of scores and outputs a 1D array of the same length
+    containing the ranks. Missing scores (NaN) are ranked last.
     """
-    scores = OrderedDict(
-        sorted(scores.items(), key=lambda t: t[1], reverse=reverse)
-    )
+    scores = np.asarray(scores, dtype=float)
+
+    if reverse:
+        # Negate rather than flip the sort so that NaNs still end up last
+        scores = -scores
 
-    ranks = {}
-    current_score = current_rank = None
+    order = np.argsort(scores, kind="mergesort")
+    sorted_scores = scores[order]
+
+    # A new rank starts wherever the sorted score differs from its predecessor
+    is_new_rank = np.ones(len(sorted_scores), dtype=bool)
+    is_new_rank[1:] = ~(
+        (sorted_scores[1:] == sorted_scores[:-1])
+        | (np.isnan(sorted_scores[1:]) & np.isnan(sorted_scores[:-1]))
+    )
 
-    for idx, (pk, score) in enumerate(scores.items()):
-        if score != current_score:
-            current_score = score
-            current_rank = idx + 1
+    positions = np.arange(1, len(sorted_scores) + 1)
+    sorted_ranks = np.maximum.accumulate(np.where(is_new_rank, positions, 0))
 
-        ranks[pk] = current_rank
+    ranks = np.empty(len(scores), dtype=int)
+    ranks[order] = sorted_ranks
 
     return ranks
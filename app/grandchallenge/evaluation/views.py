@@ -5,19 +5,48 @@ from django.contrib.messages.views import SuccessMessageMixin
 from django.core.files import File
 from django.db.models import Q
 from django.utils import timezone
-from django.views.generic import CreateView, ListView, DetailView, UpdateView
+from django.utils.http import urlencode
+from django.http import Http404, HttpResponseBadRequest, StreamingHttpResponse
+from django.views.generic import (
+    CreateView,
+    ListView,
+    DetailView,
+    UpdateView,
+    View,
+)
+from rest_framework.authentication import (
+    SessionAuthentication,
+    TokenAuthentication,
+)
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from grandchallenge.container_exec.models import get_phase_timings
 from grandchallenge.core.permissions.mixins import (
     UserIsChallengeAdminMixin,
     UserIsChallengeParticipantOrAdminMixin,
 )
+from grandchallenge.core.permissions.rest_framework import (
+    IsChallengeParticipantOrAdmin
+)
 from grandchallenge.subdomains.utils import reverse
+from grandchallenge.teams.utils import get_team_map
 from grandchallenge.evaluation.forms import (
     MethodForm,
     SubmissionForm,
     ConfigForm,
     LegacySubmissionForm,
 )
+from grandchallenge.evaluation.leaderboard import (
+    get_leaderboard_page,
+    export_leaderboard,
+    get_export_fields,
+    stream_csv,
+    stream_ndjson,
+)
 from grandchallenge.evaluation.models import (
     Result,
     Submission,
@@ -25,6 +54,10 @@ from grandchallenge.evaluation.models import (
     Method,
     Config,
 )
+from grandchallenge.evaluation.tasks import (
+    rank_candidate,
+    get_result_metric_paths,
+)
 from grandchallenge.jqfileupload.widgets.uploader import StagedAjaxFile
 
 
@@ -244,6 +277,19 @@ class JobList(UserIsChallengeParticipantOrAdminMixin, ListView):
                 Q(submission__creator__pk=self.request.user.pk),
             )
 
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(*args, **kwargs)
+
+        if self.request.challenge.is_admin(self.request.user):
+            timed_jobs, phase_timings = get_phase_timings(
+                jobs=Job.objects.filter(challenge=self.request.challenge)
+            )
+            context.update(
+                {"timed_jobs": timed_jobs, "phase_timings": phase_timings}
+            )
+
+        return context
+
 
 class JobDetail(UserIsChallengeAdminMixin, DetailView):
     # TODO - if participant: list only their jobs
@@ -252,31 +298,158 @@ class JobDetail(UserIsChallengeAdminMixin, DetailView):
 
 class ResultList(ListView):
     model = Result
+    template_name = "evaluation/result_list.html"
+
+    def get(self, request, *args, **kwargs):
+        config = Config.objects.get(challenge=self.request.challenge)
+        self.evaluation_config = config
+
+        # The results can be sorted by rank or by any of the metrics, by
+        # default in the order that puts the best result first
+        orders = {c["path"]: c["order"] for c in config.extra_results_columns}
+        orders[config.score_jsonpath] = config.score_default_sort
+
+        self.sort_orders = {
+            "rank": Config.ASCENDING,
+            **{p: orders[p] for p in get_result_metric_paths(config=config)},
+        }
+
+        self.sort = request.GET.get("sort", "rank")
+        self.order = request.GET.get("order", self.sort_orders.get(self.sort))
+
+        if self.sort not in self.sort_orders or self.order not in (
+            Config.ASCENDING,
+            Config.DESCENDING,
+        ):
+            raise Http404("Invalid sort")
+
+        return super().get(request, *args, **kwargs)
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
 
+        if self.evaluation_config.use_teams:
+            teams = get_team_map(challenge_pk=self.request.challenge.pk)
+        else:
+            teams = {}
+
+        sort_urls = {}
+        for sort, default_order in self.sort_orders.items():
+            if sort == self.sort:
+                # Reverse the current sort
+                order = (
+                    Config.ASCENDING
+                    if self.order == Config.DESCENDING
+                    else Config.DESCENDING
+                )
+            else:
+                order = default_order
+
+            sort_urls[sort] = "?" + urlencode({"sort": sort, "order": order})
+
+        query = {"sort": self.sort, "order": self.order}
+
         context.update(
             {
-                "evaluation_config": Config.objects.get(
-                    challenge=self.request.challenge
-                )
+                "evaluation_config": self.evaluation_config,
+                "teams": teams,
+                "sort": self.sort,
+                "order": self.order,
+                "sort_urls": sort_urls,
+                "first_page_url": "?" + urlencode(query),
+                "next_page_url": (
+                    "?" + urlencode({**query, "cursor": self.page.next_cursor})
+                    if self.page.next_cursor
+                    else ""
+                ),
+                "is_first_page": "cursor" not in self.request.GET,
             }
         )
 
         return context
 
     def get_queryset(self):
-        queryset = super().get_queryset()
-        queryset = queryset.select_related(
-            "job__submission__creator__user_profile"
-        )
-        return queryset.filter(
-            Q(challenge=self.request.challenge),
-            Q(published=True),
-            ~Q(rank=0),  # Exclude results without a rank
+        try:
+            self.page = get_leaderboard_page(
+                challenge_pk=self.request.challenge.pk,
+                sort=self.sort,
+                descending=(self.order == Config.DESCENDING),
+                cursor=self.request.GET.get("cursor"),
+            )
+        except ValueError:
+            raise Http404("Invalid cursor")
+
+        # The rows of the leaderboard snapshot rather than Result instances
+        return self.page.rows
+
+
+class ResultExport(View):
+    formats = {
+        "csv": ("text/csv", "csv"),
+        "ndjson": ("application/x-ndjson", "ndjson"),
+    }
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get("format", "csv")
+
+        try:
+            content_type, extension = self.formats[export_format]
+        except KeyError:
+            return HttpResponseBadRequest(
+                f"Format must be one of {', '.join(self.formats)}"
+            )
+
+        challenge = self.request.challenge
+        config = Config.objects.get(challenge=challenge)
+        records = export_leaderboard(challenge_pk=challenge.pk)
+
+        if export_format == "csv":
+            content = stream_csv(
+                records=records, fields=get_export_fields(config=config)
+            )
+        else:
+            content = stream_ndjson(records=records)
+
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response["Content-Disposition"] = (
+            f'attachment; filename="{challenge.short_name}-results.'
+            f'{extension}"'
         )
 
+        return response
+
+
+class ResultWhatIf(APIView):
+    """
+    Ranks a candidate result against the current leaderboard without
+    creating it. Expects the metrics of the candidate as a json object.
+
+    Participants can call this from scripts with an API token, in the
+    Authorization header, as well as from the site with their session.
+    """
+
+    authentication_classes = (SessionAuthentication, TokenAuthentication)
+    permission_classes = (IsChallengeParticipantOrAdmin,)
+    parser_classes = (JSONParser,)
+    renderer_classes = (JSONRenderer,)
+
+    def post(self, request, *args, **kwargs):
+        metrics = request.data
+
+        if not isinstance(metrics, dict):
+            raise ParseError("The metrics must be a json object")
+
+        config = Config.objects.get(challenge=request.challenge)
+
+        try:
+            position = rank_candidate(
+                config=config, metrics=metrics, creator=request.user.pk
+            )
+        except ValueError as e:
+            raise ParseError(str(e))
+
+        return Response(position)
+
 
 class ResultDetail(DetailView):
     model = Result
@@ -0,0 +1,21 @@
+# Generated by Django 2.1.4 on 2026-10-16 21:30
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("submission_conversion", "0002_auto_20181031_1043")]
+
+    operations = [
+        migrations.AddField(
+            model_name="submissiontoannotationsetjob",
+            name="timings",
+            field=django.contrib.postgres.fields.jsonb.JSONField(
+                default=dict,
+                editable=False,
+                help_text="The wall time, in seconds, and the bytes moved of each phase of the container execution",
+            ),
+        )
+    ]
@@ -8,12 +8,7 @@ from django.db import models
 from django.utils import timezone
 
 from grandchallenge.cases.models import RawImageUploadSession, RawImageFile
-from grandchallenge.container_exec.backends.docker import (
-    Executor,
-    put_file,
-    cleanup,
-    get_file,
-)
+from grandchallenge.container_exec.backends.docker import Executor
 from grandchallenge.container_exec.models import ContainerExecJobModel
 from grandchallenge.core.models import UUIDModel
 from grandchallenge.core.validators import get_file_mimetype
@@ -30,9 +25,15 @@ class SubmissionToAnnotationSetExecutor(Executor):
         self.__was_unzipped = False
 
     def _copy_input_files(self, writer):
-        for file in self._input_files:
-            dest_file = "/tmp/submission-src"
-            put_file(container=writer, src=file, dest=dest_file)
+        # The files are sent in one archive and then unpacked one by one
+        sources = {
+            f"submission-src-{idx}": file
+            for idx, file in enumerate(self._input_files)
+        }
+        self._put_input_files(writer=writer, files=sources, dest="/tmp/")
+
+        for name, file in sources.items():
+            dest_file = f"/tmp/{name}"
 
             with file.open("rb") as f:
                 mimetype = get_file_mimetype(f)
@@ -55,25 +56,13 @@ class SubmissionToAnnotationSetExecutor(Executor):
 
     def _get_result(self):
         """
-        Reads all of the images in /output/ and converts to upload session
+        Reads all of the converted files in /input/ and converts to upload
+        session
         """
-        base_dir = "/output/"
-
         try:
-            with cleanup(
-                self._client.containers.run(
-                    image=self._io_image,
-                    volumes={
-                        self._input_volume: {"bind": base_dir, "mode": "ro"}
-                    },
-                    detach=True,
-                    tty=True,
-                    **self._run_kwargs,
-                )
-            ) as reader:
-                self._copy_output_files(
-                    container=reader, base_dir=Path(base_dir)
-                )
+            self._copy_output_files(
+                container=self._helper, base_dir=Path("/input/")
+            )
         except Exception as exc:
             raise RuntimeError(str(exc))
 
@@ -110,7 +99,7 @@ class SubmissionToAnnotationSetExecutor(Executor):
             for file in output_files:
                 new_uuid = uuid.uuid4()
 
-                django_file = File(get_file(container=container, src=file))
+                django_file = File(self._get_file(src=file))
 
                 staged_file = StagedFile(
                     csrf="staging_conversion_csrf",
@@ -142,7 +131,7 @@ class SubmissionToAnnotationSetExecutor(Executor):
         else:
             assert len(output_files) == 1
 
-            f = get_file(container=container, src=output_files[0])
+            f = self._get_file(src=output_files[0])
             annotationset.labels = process_csv_file(f)
             annotationset.save()
 
@@ -158,6 +147,9 @@ class SubmissionToAnnotationSetJob(UUIDModel, ContainerExecJobModel):
             image = settings.CONTAINER_EXEC_IO_IMAGE
             image_sha256 = settings.CONTAINER_EXEC_IO_SHA256
             requires_gpu = False
+            requires_gpu_memory_gb = 0
+            requires_memory_gb = 4
+            requires_cpu_cores = 1
 
         return FakeContainer()
 
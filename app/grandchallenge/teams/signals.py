@@ -1,10 +1,11 @@
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from guardian.shortcuts import assign_perm
 
 from grandchallenge.core.utils import disable_for_loaddata
 from grandchallenge.teams.models import Team, TeamMember
+from grandchallenge.teams.utils import invalidate_team_map
 
 
 @receiver(post_save, sender=Team)
@@ -15,3 +16,30 @@ def create_team_admin(
     if created and instance.owner.username != settings.ANONYMOUS_USER_NAME:
         TeamMember.objects.create(user=instance.owner, team=instance)
         assign_perm("change_team", instance.owner, instance)
+
+
+@receiver(post_save, sender=Team)
+@disable_for_loaddata
+def team_changed(sender: Team, instance: Team = None, **kwargs):
+    invalidate_team_map(challenge_pk=instance.challenge_id)
+
+
+@receiver(post_delete, sender=Team)
+def team_deleted(sender: Team, instance: Team = None, **kwargs):
+    # post_delete is not sent by loaddata and has no raw argument
+    invalidate_team_map(challenge_pk=instance.challenge_id)
+
+
+@receiver(post_save, sender=TeamMember)
+@disable_for_loaddata
+def team_member_changed(
+    sender: TeamMember, instance: TeamMember = None, **kwargs
+):
+    invalidate_team_map(challenge_pk=instance.team.challenge_id)
+
+
+@receiver(post_delete, sender=TeamMember)
+def team_member_deleted(
+    sender: TeamMember, instance: TeamMember = None, **kwargs
+):
+    invalidate_team_map(challenge_pk=instance.team.challenge_id)
@@ -0,0 +1,38 @@
+import uuid
+from typing import Dict
+
+from django.core.cache import cache
+
+from grandchallenge.teams.models import TeamMember
+
+
+def _team_map_key(*, challenge_pk: uuid.UUID) -> str:
+    return f"teams:team-map:{challenge_pk}"
+
+
+def get_team_map(*, challenge_pk: uuid.UUID) -> Dict[int, Dict[str, str]]:
+    """
+    Gets the team of each member of a team in this challenge, as a dict of
+    user pk to the name and url of the team. The map is built with a single
+    query and cached until a team or team member of this challenge changes.
+    """
+    key = _team_map_key(challenge_pk=challenge_pk)
+    team_map = cache.get(key)
+
+    if team_map is None:
+        team_map = {
+            member.user_id: {
+                "name": member.team.name,
+                "url": member.team.get_absolute_url(),
+            }
+            for member in TeamMember.objects.filter(
+                team__challenge__pk=challenge_pk
+            ).select_related("team__challenge")
+        }
+        cache.set(key, team_map, None)
+
+    return team_map
+
+
+def invalidate_team_map(*, challenge_pk: uuid.UUID):
+    cache.delete(_team_map_key(challenge_pk=challenge_pk))
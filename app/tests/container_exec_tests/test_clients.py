@@ -0,0 +1,92 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from grandchallenge.container_exec.backends import clients
+from grandchallenge.container_exec.backends.clients import (
+    ClientKey,
+    get_client,
+    get_client_stats,
+    log_client_stats,
+)
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(clients, "_clients", {})
+    monkeypatch.setattr(clients, "_stats", {})
+
+
+def test_clients_are_shared(registry):
+    key = ClientKey(base_url="unix://var/run/docker.sock")
+
+    client = get_client(key=key)
+    assert get_client(key=key) is client
+    assert get_client(key=ClientKey(base_url="tcp://other:2375")) is not client
+
+    stats = get_client_stats()
+    assert stats["unix://var/run/docker.sock"]["created"] == 1
+    assert stats["unix://var/run/docker.sock"]["reused"] == 1
+    assert stats["tcp://other:2375"]["created"] == 1
+
+
+def test_clients_reconnect(registry, settings, mocker):
+    settings.CONTAINER_EXEC_DOCKER_CLIENT_CHECK_INTERVAL = -1
+    docker_client = mocker.patch(
+        "grandchallenge.container_exec.backends.clients.docker.DockerClient",
+        side_effect=lambda **_: MagicMock(),
+    )
+    key = ClientKey(base_url="tcp://docker:2376")
+
+    client = get_client(key=key)
+    client.ping.return_value = True
+    assert get_client(key=key) is client
+
+    # The docker host cannot be reached
+    client.ping.return_value = False
+    new_client = get_client(key=key)
+    assert new_client is not client
+    client.close.assert_called_once()
+
+    # A client is not shared with a forked process
+    mocker.patch(
+        "grandchallenge.container_exec.backends.clients.os.getpid",
+        return_value=-1,
+    )
+    assert get_client(key=key) is not new_client
+
+    assert docker_client.call_count == 3
+    assert get_client_stats()["tcp://docker:2376"]["reconnects"] == 1
+
+
+def test_clients_are_checked_without_the_lock(registry, settings, mocker):
+    settings.CONTAINER_EXEC_DOCKER_CLIENT_CHECK_INTERVAL = -1
+    mocker.patch(
+        "grandchallenge.container_exec.backends.clients.docker.DockerClient",
+        side_effect=lambda **_: MagicMock(),
+    )
+    slow = ClientKey(base_url="tcp://slow:2376")
+    other = ClientKey(base_url="tcp://other:2376")
+    other_client = get_client(key=other)
+
+    def ping():
+        # The clients of the other hosts can be handed out during the ping
+        assert not clients._lock.locked()
+        assert get_client(key=other) is other_client
+        return True
+
+    client = get_client(key=slow)
+    client.ping.side_effect = ping
+
+    assert get_client(key=slow) is client
+    client.ping.assert_called_once()
+
+
+def test_client_stats_are_logged(registry, caplog):
+    get_client(key=ClientKey(base_url="tcp://docker:2376"))
+
+    with caplog.at_level("INFO"):
+        log_client_stats()
+
+    assert "Docker client for tcp://docker:2376: " in caplog.text
+    assert "created=1" in caplog.text
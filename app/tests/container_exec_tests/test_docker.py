@@ -0,0 +1,241 @@
+import io
+import tarfile
+import uuid
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+from django.core.files.base import ContentFile
+from docker.errors import APIError
+
+from grandchallenge.container_exec.backends.docker import (
+    PHASES,
+    Executor,
+    put_file,
+    put_files,
+    get_file,
+)
+from grandchallenge.container_exec.backends.resources import Resources
+from grandchallenge.evaluation.models import SubmissionEvaluator
+
+
+def test_put_file_streams_a_tar_archive(mocker):
+    mocker.patch(
+        "grandchallenge.container_exec.backends.docker.CHUNK_SIZE", 100
+    )
+    content = bytes(range(256)) * 10
+    container = MagicMock()
+
+    put_file(
+        container=container,
+        src=ContentFile(content, name="input.bin"),
+        dest="/input/submission.bin",
+    )
+
+    path, stream = container.put_archive.call_args[0]
+    assert path == "/input"
+
+    chunks = list(stream)
+    # The file is read in chunks, the largest part is the end of the archive
+    assert max(len(c) for c in chunks) == 2 * tarfile.BLOCKSIZE
+
+    with tarfile.open(fileobj=io.BytesIO(b"".join(chunks))) as tar:
+        assert tar.getnames() == ["submission.bin"]
+        assert tar.extractfile("submission.bin").read() == content
+
+
+def test_put_files_sends_one_archive():
+    files = {
+        "image.mhd": ContentFile(b"ElementDataFile = image.zraw"),
+        "image.zraw": ContentFile(bytes(range(256)) * 3),
+    }
+    container = MagicMock()
+
+    stats = put_files(container=container, files=files, dest="/input/")
+
+    assert container.put_archive.call_count == 1
+    assert stats["files"] == 2
+    assert stats["bytes"] == sum(f.size for f in files.values())
+
+    path, stream = container.put_archive.call_args[0]
+    assert path == "/input/"
+
+    with tarfile.open(fileobj=io.BytesIO(b"".join(stream))) as tar:
+        assert tar.getnames() == list(files)
+
+        for name, f in files.items():
+            f.seek(0)
+            assert tar.extractfile(name).read() == f.read()
+
+
+def _tar_stream(*, files, chunk_size=1000):
+    archive = io.BytesIO()
+
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        for name, content in files.items():
+            tarinfo = tarfile.TarInfo(name=name)
+            tarinfo.size = len(content)
+            tar.addfile(tarinfo, fileobj=io.BytesIO(content))
+
+    archive = archive.getvalue()
+
+    return (
+        archive[i : i + chunk_size] for i in range(0, len(archive), chunk_size)
+    )
+
+
+def test_get_file_streams_the_archive(settings):
+    content = bytes(range(256)) * 5000
+    container = MagicMock()
+    container.get_archive.return_value = (
+        _tar_stream(files={"results.json": content}),
+        {"size": len(content)},
+    )
+
+    f = get_file(container=container, src=Path("/output/results.json"))
+
+    assert f.read() == content
+    # Larger files are written to disk rather than kept in memory
+    assert f._rolled
+
+    container.get_archive.return_value = (
+        _tar_stream(files={"other.json": b"{}"}),
+        {"size": 2},
+    )
+    with pytest.raises(ValueError):
+        get_file(container=container, src=Path("/output/results.json"))
+
+    settings.CONTAINER_EXEC_MAX_OUTPUT_FILE_SIZE = 10
+    container.get_archive.return_value = (
+        _tar_stream(files={"results.json": content}),
+        {"size": len(content)},
+    )
+    with pytest.raises(ValueError):
+        get_file(container=container, src=Path("/output/results.json"))
+
+
+def test_executor_uses_one_io_helper(mocker, settings):
+    settings.CONTAINER_EXEC_IO_MEMORY_LIMIT = "256m"
+    client = MagicMock()
+    mocker.patch(
+        "grandchallenge.container_exec.backends.docker.get_docker_client",
+        return_value=client,
+    )
+
+    # The io helper and the exec container are both this mock
+    helper = client.containers.run.return_value
+    helper.exec_run.return_value = MagicMock(exit_code=0)
+    helper.get_archive.return_value = (
+        _tar_stream(files={"results.json": b'{"acc": 0.5}'}),
+        {"size": 12},
+    )
+
+    job_id = uuid.uuid4()
+
+    with Executor(
+        job_id=job_id,
+        input_files=(ContentFile(b"1,2", name="submission.csv"),),
+        exec_image=MagicMock(),
+        exec_image_sha256="sha256:exec",
+        results_file=Path("/output/results.json"),
+        requirements=Resources(memory_gb=8, cpu_cores=2),
+    ) as ev:
+        assert ev.execute() == {"acc": 0.5}
+
+    # One helper and the exec container
+    assert client.containers.run.call_count == 2
+
+    # Only the exec container gets the resources reserved for the job
+    run_kwargs = {
+        c[1]["name"]: c[1] for c in client.containers.run.call_args_list
+    }
+    assert run_kwargs[f"{job_id}-io"]["mem_limit"] == "256m"
+    assert run_kwargs[f"{job_id}-exec"]["mem_limit"] == "8192m"
+    helper.put_archive.assert_called_once()
+    helper.exec_run.assert_called_once_with("chmod 777 /output/")
+    helper.remove.assert_called_once_with(force=True)
+
+    # Only the objects created for this job are removed, without a prune
+    removed_containers = {
+        c[0][0] for c in client.api.remove_container.call_args_list
+    }
+    removed_volumes = {
+        c[0][0] for c in client.api.remove_volume.call_args_list
+    }
+    assert removed_containers == {f"{job_id}-io", f"{job_id}-exec"}
+    assert removed_volumes == {f"{job_id}-input", f"{job_id}-output"}
+    client.containers.prune.assert_not_called()
+    client.volumes.prune.assert_not_called()
+
+    # Each phase of the job is timed
+    assert tuple(ev.timings) == PHASES
+    assert all(t["seconds"] >= 0 for t in ev.timings.values())
+    assert ev.timings["input"]["bytes"] == 3
+    assert ev.timings["input"]["files"] == 1
+    assert ev.timings["output"]["bytes"] == 12
+
+
+def test_executor_removes_the_objects_of_an_earlier_attempt(mocker):
+    client = MagicMock()
+    mocker.patch(
+        "grandchallenge.container_exec.backends.docker.get_docker_client",
+        return_value=client,
+    )
+    job_id = uuid.uuid4()
+
+    # The worker of the first attempt was lost before it cleaned up
+    existing = {f"{job_id}-io", f"{job_id}-exec", f"{job_id}-output"}
+
+    def remove(name, *, force):
+        existing.discard(name)
+
+    def run(*, name, **_):
+        if name in existing:
+            raise APIError(f"409 Conflict: {name} is already in use")
+        existing.add(name)
+        return helper
+
+    helper = MagicMock()
+    helper.exec_run.return_value = MagicMock(exit_code=0)
+    helper.get_archive.return_value = (
+        _tar_stream(files={"results.json": b'{"acc": 0.5}'}),
+        {"size": 12},
+    )
+    client.api.remove_container.side_effect = remove
+    client.api.remove_volume.side_effect = remove
+    client.containers.run.side_effect = run
+
+    with Executor(
+        job_id=job_id,
+        input_files=(ContentFile(b"1,2", name="submission.csv"),),
+        exec_image=MagicMock(),
+        exec_image_sha256="sha256:exec",
+        results_file=Path("/output/results.json"),
+    ) as ev:
+        assert ev.execute() == {"acc": 0.5}
+
+    assert client.containers.run.call_count == 2
+    assert existing == set()
+
+
+def test_submission_evaluator_sends_one_archive(mocker):
+    mocker.patch(
+        "grandchallenge.container_exec.backends.docker.get_docker_client"
+    )
+    writer = MagicMock()
+    writer.exec_run.return_value = MagicMock(exit_code=0, output=b"")
+
+    ev = SubmissionEvaluator(
+        job_id=uuid.uuid4(),
+        input_files=(ContentFile(b"1,2", name="submission.csv"),),
+        exec_image=MagicMock(),
+        exec_image_sha256="sha256:exec",
+    )
+    ev._copy_input_files(writer=writer)
+
+    writer.put_archive.assert_called_once()
+    assert writer.put_archive.call_args[0][0] == "/tmp/"
+    writer.exec_run.assert_called_once_with(
+        "mv /tmp/submission-src-0 /input/submission.csv"
+    )
+    assert ev.timings["input"]["files"] == 1
@@ -0,0 +1,137 @@
+from unittest.mock import MagicMock
+
+import pytest
+from django.core.cache import cache
+from docker.errors import ImageNotFound, APIError
+
+from grandchallenge.container_exec.backends.images import (
+    image_is_present,
+    ensure_image,
+    ensure_io_image,
+    forget_image,
+    evict_images,
+    get_image_stats,
+)
+
+
+@pytest.fixture
+def client():
+    cache.clear()
+    client = MagicMock()
+    client.api.base_url = "http+docker://localhost"
+    return client
+
+
+def test_image_presence_is_cached(client):
+    assert image_is_present(client=client, sha256="sha256:a") is True
+    assert image_is_present(client=client, sha256="sha256:a") is True
+    assert client.images.get.call_count == 1
+
+    forget_image(client=client, sha256="sha256:a")
+    client.images.get.side_effect = ImageNotFound("")
+
+    # Missing images are not cached
+    assert image_is_present(client=client, sha256="sha256:a") is False
+    assert image_is_present(client=client, sha256="sha256:a") is False
+    assert client.images.get.call_count == 3
+
+
+def test_ensure_image(client):
+    client.images.get.side_effect = ImageNotFound("")
+    image = MagicMock()
+
+    assert ensure_image(client=client, sha256="sha256:a", image=image) is True
+    assert ensure_image(client=client, sha256="sha256:a", image=image) is False
+    assert client.images.load.call_count == 1
+    assert get_image_stats(client=client) == {
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+    }
+
+
+def test_ensure_io_image(client, settings):
+    client.images.get.side_effect = ImageNotFound("")
+    client.images.pull.return_value.id = settings.CONTAINER_EXEC_IO_SHA256
+
+    assert ensure_io_image(client=client) is True
+    assert ensure_io_image(client=client) is False
+    client.images.pull.assert_called_once_with(
+        repository=settings.CONTAINER_EXEC_IO_IMAGE
+    )
+
+
+def _keep(*images):
+    def keep(*, sha256s=None):
+        if sha256s is None:
+            return set(images)
+        return set(images) & set(sha256s)
+
+    return keep
+
+
+def test_evict_images(client, mocker):
+    time = mocker.patch("grandchallenge.container_exec.backends.images.time")
+    client.images.get.side_effect = ImageNotFound("")
+
+    # Used in the order c, b, a, d
+    for t, sha256 in enumerate(("c", "b", "a", "d")):
+        time.time.return_value = t
+        ensure_image(client=client, sha256=sha256, image=MagicMock())
+
+    # e was not loaded for a job so is never removed
+    client.images.list.return_value = [
+        MagicMock(id=sha256, attrs={"Size": 10}) for sha256 in "abcde"
+    ]
+
+    def remove(*, image):
+        if image == "b":
+            raise APIError("Used by a container")
+
+    client.images.remove.side_effect = remove
+
+    # c is kept, b cannot be removed, then a is the least recently used
+    assert evict_images(client=client, budget=30, keep=_keep("c")) == ["a"]
+    assert get_image_stats(client=client)["evictions"] == 1
+    assert image_is_present(client=client, sha256="a") is False
+
+    # Under budget
+    client.images.list.return_value = [
+        MagicMock(id=sha256, attrs={"Size": 10}) for sha256 in "bcde"
+    ]
+    assert evict_images(client=client, budget=30, keep=_keep()) == []
+
+
+def test_evict_images_rechecks_keep(client, mocker):
+    time = mocker.patch("grandchallenge.container_exec.backends.images.time")
+    client.images.get.side_effect = ImageNotFound("")
+
+    for t, sha256 in enumerate("abc"):
+        time.time.return_value = t
+        ensure_image(client=client, sha256=sha256, image=MagicMock())
+
+    client.images.list.return_value = [
+        MagicMock(id=sha256, attrs={"Size": 10}) for sha256 in "abc"
+    ]
+    queued = set()
+    checked = []
+
+    def keep(*, sha256s=None):
+        # The images are read from the host before the queued jobs
+        client.images.list.assert_called_once()
+        checked.append(sha256s)
+        return queued if sha256s is None else queued & set(sha256s)
+
+    def remove(*, image):
+        # A job for c is queued, and b is used, while a is removed
+        queued.add("c")
+        time.time.return_value = 3
+        ensure_image(client=client, sha256="b", image=MagicMock())
+
+    client.images.remove.side_effect = remove
+
+    assert evict_images(client=client, budget=0, keep=keep) == ["a"]
+    assert image_is_present(client=client, sha256="b") is True
+    assert image_is_present(client=client, sha256="c") is True
+    # The queued images are read once, then only the image to be removed
+    assert checked == [None, ["a"], ["b"], ["c"]]
@@ -0,0 +1,51 @@
+import pytest
+from django.db.models.signals import post_save
+from factory.django import mute_signals
+
+from grandchallenge.container_exec.models import get_phase_timings
+from grandchallenge.evaluation.models import Job
+from tests.factories import JobFactory
+
+
+@pytest.mark.django_db
+def test_get_phase_timings():
+    with mute_signals(post_save):
+        job = JobFactory(
+            timings={
+                "teardown": {"seconds": 1.0, "bytes": 0},
+                "image": {"seconds": 10.0, "bytes": 1000},
+            }
+        )
+        JobFactory(
+            challenge=job.challenge,
+            timings={"image": {"seconds": 20.0, "bytes": 0}},
+        )
+        JobFactory(challenge=job.challenge)
+
+    assert [p for p, _ in job.phase_timings] == ["image", "teardown"]
+
+    timed_jobs, timings = get_phase_timings(
+        jobs=Job.objects.filter(challenge=job.challenge)
+    )
+
+    assert timed_jobs == 2
+    assert timings == [
+        (
+            "image",
+            {
+                "seconds": 15.0,
+                "bytes": 500.0,
+                "total_seconds": 30.0,
+                "total_bytes": 1000.0,
+            },
+        ),
+        (
+            "teardown",
+            {
+                "seconds": 1.0,
+                "bytes": 0.0,
+                "total_seconds": 1.0,
+                "total_bytes": 0.0,
+            },
+        ),
+    ]
@@ -0,0 +1,114 @@
+from unittest.mock import MagicMock
+
+import pytest
+from django.core.cache import cache
+from django.core.management import call_command
+
+from grandchallenge.container_exec.backends.images import (
+    ensure_image,
+    mark_image_present,
+)
+from grandchallenge.container_exec.backends.pool import (
+    get_host_stats,
+    host_is_healthy,
+    record_job,
+    select_host,
+)
+from grandchallenge.container_exec.backends.resources import (
+    Resources,
+    get_reserved,
+)
+
+
+@pytest.fixture
+def clients(settings, mocker):
+    cache.clear()
+    settings.CONTAINER_EXEC_DOCKER_HOSTS = ["tcp://a:2376", "tcp://b:2376"]
+    settings.CONTAINER_EXEC_HOST_MEMORY_GB = 16
+    settings.CONTAINER_EXEC_HOST_CPU_CORES = 8
+    settings.CONTAINER_EXEC_HOST_SELECTION = "least_loaded"
+
+    clients = {}
+
+    for host in settings.CONTAINER_EXEC_DOCKER_HOSTS:
+        clients[host] = MagicMock()
+        clients[host].api.base_url = host
+        clients[host].ping.return_value = True
+
+    for module in (
+        "grandchallenge.container_exec.backends.pool",
+        "grandchallenge.core.management.commands.dockerhoststats",
+    ):
+        mocker.patch(
+            f"{module}.get_docker_client",
+            side_effect=lambda base_url: clients[base_url],
+        )
+
+    return clients
+
+
+def test_host_health_is_cached(clients):
+    clients["tcp://b:2376"].ping.return_value = False
+
+    assert host_is_healthy(host="tcp://a:2376") is True
+    assert host_is_healthy(host="tcp://b:2376") is False
+    assert host_is_healthy(host="tcp://b:2376") is False
+    assert clients["tcp://b:2376"].ping.call_count == 1
+
+
+def test_select_host(clients):
+    job = Resources(memory_gb=4, cpu_cores=1)
+    mark_image_present(client=clients["tcp://b:2376"], sha256="sha256:a")
+
+    # The host with the image is preferred
+    assert (
+        select_host(job_id="1", requirements=job, image_sha256="sha256:a")
+        == "tcp://b:2376"
+    )
+    assert (
+        select_host(job_id="2", requirements=job, image_sha256="sha256:b")
+        == "tcp://a:2376"
+    )
+    assert get_reserved(host="tcp://b:2376") == job
+
+    # Unhealthy hosts are not used
+    cache.clear()
+    clients["tcp://b:2376"].ping.return_value = False
+    assert (
+        select_host(job_id="3", requirements=job, image_sha256="sha256:a")
+        == "tcp://a:2376"
+    )
+
+
+def test_host_stats(clients):
+    record_job(host="tcp://a:2376", queued=10, duration=60)
+    record_job(host="tcp://a:2376", queued=20, duration=120)
+
+    stats = get_host_stats()
+
+    assert stats["tcp://a:2376"]["jobs"] == 2
+    assert stats["tcp://a:2376"]["mean_queued_seconds"] == 15
+    assert stats["tcp://a:2376"]["mean_running_seconds"] == 90
+    assert stats["tcp://b:2376"]["jobs"] == 0
+
+
+def test_docker_host_stats_command(clients, capsys):
+    clients["tcp://b:2376"].ping.return_value = False
+    ensure_image(
+        client=clients["tcp://a:2376"], sha256="sha256:a", image=MagicMock()
+    )
+    record_job(host="tcp://a:2376", queued=10, duration=60)
+
+    call_command("dockerhoststats")
+
+    out, _ = capsys.readouterr()
+    host_a, host_b = out.splitlines()
+
+    assert host_a.startswith("tcp://a:2376: healthy=True jobs=1 ")
+    assert "mean_running_seconds=60.00" in host_a
+    assert "reserved_memory_gb=0.00" in host_a
+    assert host_a.endswith(" hits=1 misses=0 evictions=0")
+
+    # The image statistics are only read from the healthy hosts
+    assert host_b.startswith("tcp://b:2376: healthy=False jobs=0 ")
+    assert "hits=" not in host_b
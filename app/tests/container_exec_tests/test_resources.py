@@ -0,0 +1,135 @@
+import math
+from decimal import Decimal
+from unittest.mock import MagicMock
+
+import pytest
+from django.core.cache import cache
+
+from grandchallenge.container_exec.backends.resources import (
+    LEAST_LOADED,
+    LockTimeoutError,
+    Resources,
+    get_capacity,
+    get_requirements,
+    get_run_kwargs,
+    get_reserved,
+    place_job,
+    release,
+    reserve,
+)
+
+
+@pytest.fixture
+def clear_cache():
+    cache.clear()
+
+
+def test_requirements_and_limits(settings):
+    settings.CONTAINER_EXEC_CPU_PERIOD = 100000
+    container = MagicMock(
+        requires_gpu=False,
+        requires_gpu_memory_gb=4,
+        requires_memory_gb=2,
+        requires_cpu_cores=Decimal("0.5"),
+    )
+
+    requirements = get_requirements(container)
+
+    assert requirements == Resources(
+        memory_gb=2, cpu_cores=0.5, gpu_memory_gb=0
+    )
+    assert get_run_kwargs(requirements) == {
+        "mem_limit": "2048m",
+        "cpu_period": 100000,
+        "cpu_quota": 50000,
+    }
+
+
+def test_capacity_is_read_from_the_host(clear_cache, settings):
+    settings.CONTAINER_EXEC_HOST_MEMORY_GB = None
+    settings.CONTAINER_EXEC_HOST_CPU_CORES = 6
+    settings.CONTAINER_EXEC_HOST_GPU_MEMORY_GB = None
+    client = MagicMock()
+    client.api.base_url = "http+docker://localhost"
+    client.info.return_value = {"MemTotal": 16 * 2 ** 30, "NCPU": 12}
+
+    assert get_capacity(client=client) == Resources(
+        memory_gb=16, cpu_cores=6, gpu_memory_gb=math.inf
+    )
+    assert get_capacity(client=client) == get_capacity(client=client)
+    assert client.info.call_count == 1
+
+
+def test_reserve_and_release(clear_cache):
+    capacity = Resources(memory_gb=8, cpu_cores=4)
+    big = Resources(memory_gb=6, cpu_cores=1)
+
+    assert reserve(host="a", capacity=capacity, job_id="1", requirements=big)
+    assert not reserve(
+        host="a", capacity=capacity, job_id="2", requirements=big
+    )
+    # A job that is retried does not count against itself
+    assert reserve(host="a", capacity=capacity, job_id="1", requirements=big)
+    assert get_reserved(host="a") == big
+
+    release(host="a", job_id="1")
+
+    assert get_reserved(host="a") == Resources()
+    assert reserve(host="a", capacity=capacity, job_id="2", requirements=big)
+
+
+def test_reserve_gives_up_on_a_held_lock(clear_cache, monkeypatch):
+    monkeypatch.setattr(
+        "grandchallenge.container_exec.backends.resources.LOCK_WAIT", 0.1
+    )
+    capacity = Resources(memory_gb=8, cpu_cores=4)
+    job = Resources(memory_gb=1, cpu_cores=1)
+
+    cache.add("container_exec:reservations:a:lock", True, 10)
+
+    with pytest.raises(LockTimeoutError):
+        reserve(host="a", capacity=capacity, job_id="1", requirements=job)
+
+    with pytest.raises(LockTimeoutError):
+        release(host="a", job_id="1")
+
+
+def test_reservations_expire(clear_cache, settings):
+    settings.CELERY_TASK_TIME_LIMIT = -1
+    capacity = Resources(memory_gb=8, cpu_cores=4)
+    big = Resources(memory_gb=6, cpu_cores=1)
+
+    assert reserve(host="a", capacity=capacity, job_id="1", requirements=big)
+    assert get_reserved(host="a") == Resources()
+
+
+def test_place_job_best_fit(clear_cache):
+    hosts = {
+        "large": Resources(memory_gb=32, cpu_cores=8),
+        "small": Resources(memory_gb=8, cpu_cores=8),
+    }
+    small = Resources(memory_gb=4, cpu_cores=1)
+    large = Resources(memory_gb=16, cpu_cores=1)
+
+    # The small jobs fill the small host first
+    assert place_job(job_id="1", requirements=small, hosts=hosts) == "small"
+    assert place_job(job_id="2", requirements=small, hosts=hosts) == "small"
+    assert place_job(job_id="3", requirements=small, hosts=hosts) == "large"
+
+    assert place_job(job_id="4", requirements=large, hosts=hosts) == "large"
+    assert place_job(job_id="5", requirements=large, hosts=hosts) is None
+
+
+def test_place_job_least_loaded(clear_cache):
+    hosts = {
+        "a": Resources(memory_gb=16, cpu_cores=8),
+        "b": Resources(memory_gb=16, cpu_cores=8),
+    }
+    job = Resources(memory_gb=4, cpu_cores=1)
+    kwargs = {"requirements": job, "hosts": hosts, "strategy": LEAST_LOADED}
+
+    # The jobs are spread over the hosts
+    assert place_job(job_id="1", **kwargs) == "a"
+    assert place_job(job_id="2", **kwargs) == "b"
+    # Unless a host is preferred
+    assert place_job(job_id="3", prefer={"b"}, **kwargs) == "b"
@@ -0,0 +1,100 @@
+from unittest.mock import MagicMock
+
+import pytest
+from django.db.models.signals import post_save
+from factory.django import mute_signals
+
+from grandchallenge.container_exec.tasks import (
+    get_queued_images,
+    cleanup_docker_objects,
+)
+from grandchallenge.evaluation.models import Job
+from tests.factories import JobFactory
+
+
+@pytest.mark.django_db
+def test_get_queued_images(settings, django_assert_num_queries):
+    with mute_signals(post_save):
+        queued = JobFactory(method__image_sha256="sha256:queued")
+        JobFactory(method__image_sha256="sha256:queued", status=Job.RETRY)
+        JobFactory(method__image_sha256="sha256:done", status=Job.SUCCESS)
+
+    # One query per job model, however many jobs there are
+    with django_assert_num_queries(2):
+        images = get_queued_images()
+
+    assert images == {
+        settings.CONTAINER_EXEC_IO_SHA256,
+        queued.method.image_sha256,
+    }
+    assert get_queued_images(sha256s=["sha256:queued", "sha256:done"]) == {
+        "sha256:queued"
+    }
+
+
+@pytest.mark.django_db
+def test_cleanup_docker_objects(mocker):
+    with mute_signals(post_save):
+        running = JobFactory(status=Job.STARTED)
+        done = JobFactory(status=Job.SUCCESS)
+
+    client = MagicMock()
+    client.api.containers.return_value = [
+        {"Id": "running", "Labels": {"job_id": str(running.pk)}},
+        {"Id": "done", "Labels": {"job_id": str(done.pk)}},
+    ]
+    client.api.volumes.return_value = {
+        "Volumes": [
+            {
+                "Name": f"{running.pk}-input",
+                "Labels": {"job_id": str(running.pk)},
+            },
+            {"Name": f"{done.pk}-input", "Labels": {"job_id": str(done.pk)}},
+        ]
+    }
+    mocker.patch(
+        "grandchallenge.container_exec.tasks.get_docker_client",
+        return_value=client,
+    )
+    mocker.patch(
+        "grandchallenge.container_exec.tasks.get_healthy_hosts",
+        return_value={"tcp://docker:2376": None},
+    )
+
+    assert cleanup_docker_objects() == {
+        "tcp://docker:2376": {
+            "containers": ["done"],
+            "volumes": [f"{done.pk}-input"],
+        }
+    }
+    client.api.remove_container.assert_called_once_with("done", force=True)
+    client.api.remove_volume.assert_called_once_with(
+        f"{done.pk}-input", force=True
+    )
+
+
+@pytest.mark.django_db
+def test_cleanup_keeps_the_objects_of_new_jobs(mocker):
+    def containers(**_):
+        # A job is started while the objects are listed
+        with mute_signals(post_save):
+            job = JobFactory(status=Job.STARTED)
+
+        return [{"Id": "new", "Labels": {"job_id": str(job.pk)}}]
+
+    client = MagicMock()
+    client.api.containers.side_effect = containers
+    client.api.volumes.return_value = {"Volumes": None}
+    mocker.patch(
+        "grandchallenge.container_exec.tasks.get_docker_client",
+        return_value=client,
+    )
+    mocker.patch(
+        "grandchallenge.container_exec.tasks.get_healthy_hosts",
+        return_value={"tcp://docker:2376": None},
+    )
+
+    assert cleanup_docker_objects() == {
+        "tcp://docker:2376": {"containers": [], "volumes": []}
+    }
+    client.api.remove_container.assert_not_called()
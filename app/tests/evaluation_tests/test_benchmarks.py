@@ -0,0 +1,264 @@
+"""
+Benchmarks for the ranking of results.
+
+These are skipped unless RANKING_BENCHMARKS is set, eg.
+
+    $ RANKING_BENCHMARKS=1 pytest -m benchmark
+
+The timings are written as json to the file in RANKING_BENCHMARKS_OUTPUT
+(default: ranking_benchmarks.json) so that they can be compared between
+commits. The numbers of results can be set with RANKING_BENCHMARKS_SIZES,
+eg. RANKING_BENCHMARKS_SIZES=1000,10000.
+"""
+import json
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime
+from functools import partial
+from types import SimpleNamespace
+from typing import Dict, Any
+
+import numpy as np
+import pytest
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save
+from factory.django import mute_signals
+
+from grandchallenge.evaluation.models import Config, Result, Submission, Job
+from grandchallenge.evaluation.tasks import (
+    calculate_ranks,
+    update_result_metrics,
+)
+from grandchallenge.evaluation.utils import Metric, rank_results
+from tests.factories import ChallengeFactory, MethodFactory
+
+pytestmark = [
+    pytest.mark.benchmark,
+    pytest.mark.skipif(
+        not os.environ.get("RANKING_BENCHMARKS"),
+        reason="Set RANKING_BENCHMARKS to run the ranking benchmarks",
+    ),
+]
+
+SIZES = tuple(
+    int(n)
+    for n in os.environ.get(
+        "RANKING_BENCHMARKS_SIZES", "1000,10000,100000"
+    ).split(",")
+)
+N_METRICS = (1, 5, 20)
+REPEATS = 3
+
+# Fraction of the metrics that are missing from a result
+MISSING_FRACTION = 0.01
+# Values are rounded to this many decimals, which creates ties
+DECIMALS = 2
+
+SCORE_METHODS = {
+    Config.ABSOLUTE: lambda x: x[:, 0],
+    Config.MEAN: partial(np.mean, axis=1),
+    Config.MEDIAN: partial(np.median, axis=1),
+}
+
+
+@pytest.fixture(scope="module")
+def benchmark_log():
+    """ Collects the timings and writes them out at the end of the module """
+    log = []
+
+    yield log
+
+    try:
+        commit = (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    with open(
+        os.environ.get("RANKING_BENCHMARKS_OUTPUT", "ranking_benchmarks.json"),
+        "w",
+    ) as f:
+        json.dump(
+            {
+                "commit": commit,
+                "created": datetime.utcnow().isoformat(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "benchmarks": log,
+            },
+            f,
+            indent=2,
+        )
+
+
+def _time(func, *, setup=None, repeats: int = REPEATS) -> Dict[str, Any]:
+    """
+    Times several runs of func. Returns the fastest run and the timings of
+    all runs, in seconds. The optional setup is called before each run and
+    is not timed.
+    """
+    timings = []
+
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return {"seconds": min(timings), "timings": timings}
+
+
+def generate_metrics(*, n_results: int, n_metrics: int, seed: int = 42):
+    """
+    Generates the metrics of n_results synthetic results. Each metric is
+    nested, eg. {"metric_0": {"mean": 0.12}}, some values are tied and some
+    metrics are missing.
+    """
+    rng = np.random.RandomState(seed)
+    values = rng.rand(n_results, n_metrics).round(DECIMALS)
+    missing = rng.rand(n_results, n_metrics) < MISSING_FRACTION
+
+    metrics = [
+        {
+            f"metric_{m}": {"mean": values[r, m]}
+            for m in range(n_metrics)
+            if not missing[r, m]
+        }
+        for r in range(n_results)
+    ]
+
+    paths = [
+        Metric(path=f"metric_{m}.mean", reverse=bool(m % 2))
+        for m in range(n_metrics)
+    ]
+
+    return metrics, paths
+
+
+@pytest.mark.parametrize("n_results", SIZES)
+@pytest.mark.parametrize("n_metrics", N_METRICS)
+@pytest.mark.parametrize("score_method_choice", tuple(SCORE_METHODS))
+def test_rank_results(
+    benchmark_log, n_results, n_metrics, score_method_choice
+):
+    if score_method_choice == Config.ABSOLUTE and n_metrics != 1:
+        pytest.skip("Absolute ranking only uses one metric")
+
+    metrics, paths = generate_metrics(n_results=n_results, n_metrics=n_metrics)
+    results = [
+        SimpleNamespace(pk=idx, metrics=m) for idx, m in enumerate(metrics)
+    ]
+
+    timings = _time(
+        lambda: rank_results(
+            results=results,
+            metrics=paths,
+            score_method=SCORE_METHODS[score_method_choice],
+        )
+    )
+
+    benchmark_log.append(
+        {
+            "name": "rank_results",
+            "n_results": n_results,
+            "n_metrics": n_metrics,
+            "score_method": score_method_choice,
+            **timings,
+        }
+    )
+
+
+def _create_results(*, challenge, n_results: int, n_metrics: int):
+    """ Creates the results directly in the database, without signals """
+    metrics, paths = generate_metrics(n_results=n_results, n_metrics=n_metrics)
+
+    # Each user has 10 results on average
+    users = get_user_model().objects.bulk_create(
+        get_user_model()(username=f"benchmark_{idx}")
+        for idx in range(max(n_results // 10, 1))
+    )
+    submissions = Submission.objects.bulk_create(
+        Submission(challenge=challenge, creator=users[idx % len(users)])
+        for idx in range(n_results)
+    )
+    method = MethodFactory(challenge=challenge)
+    jobs = Job.objects.bulk_create(
+        Job(challenge=challenge, submission=s, method=method)
+        for s in submissions
+    )
+    Result.objects.bulk_create(
+        (
+            Result(challenge=challenge, job=j, metrics=m)
+            for j, m in zip(jobs, metrics)
+        ),
+        batch_size=10000,
+    )
+
+    return paths
+
+
+def _reset_positions(*, challenge):
+    Result.objects.filter(challenge=challenge).update(
+        rank=0, rank_score=0.0, rank_per_metric={}
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("n_results", SIZES)
+def test_calculate_ranks(benchmark_log, n_results):
+    n_metrics = 5
+
+    challenge = ChallengeFactory()
+
+    with mute_signals(post_save):
+        paths = _create_results(
+            challenge=challenge, n_results=n_results, n_metrics=n_metrics
+        )
+
+        config = challenge.evaluation_config
+        config.score_jsonpath = paths[0].path
+        config.extra_results_columns = [
+            {
+                "title": p.path,
+                "path": p.path,
+                "order": Config.DESCENDING if p.reverse else Config.ASCENDING,
+            }
+            for p in paths[1:]
+        ]
+        config.save()
+
+        # The ranks are calculated from the stored metric values
+        update_result_metrics(challenge_pk=challenge.pk)
+
+        for display_choice in (Config.ALL, Config.MOST_RECENT, Config.BEST):
+            for score_method_choice in SCORE_METHODS:
+                config.result_display_choice = display_choice
+                config.scoring_method_choice = score_method_choice
+                config.save()
+
+                # The positions are reset before each run, so that every
+                # run writes all of the ranks
+                timings = _time(
+                    lambda: calculate_ranks(challenge_pk=challenge.pk),
+                    setup=lambda: _reset_positions(challenge=challenge),
+                )
+
+                benchmark_log.append(
+                    {
+                        "name": "calculate_ranks",
+                        "n_results": n_results,
+                        "n_metrics": n_metrics,
+                        "display_choice": display_choice,
+                        "score_method": score_method_choice,
+                        **timings,
+                    }
+                )
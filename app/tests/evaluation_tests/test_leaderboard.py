@@ -0,0 +1,348 @@
+import csv
+import json
+
+import pytest
+from django.core.cache import cache
+from django.db.models.signals import post_save
+from factory.django import mute_signals
+
+from grandchallenge.evaluation.leaderboard import (
+    build_leaderboard,
+    get_leaderboard,
+    get_leaderboard_page,
+    invalidate_leaderboard,
+    export_leaderboard,
+    get_export_fields,
+    stream_csv,
+    stream_ndjson,
+)
+from grandchallenge.evaluation.models import Config
+from grandchallenge.evaluation.tasks import (
+    calculate_ranks,
+    update_rank,
+    update_result_metrics,
+)
+from tests.factories import ChallengeFactory, ResultFactory
+
+
+@pytest.mark.django_db
+def test_leaderboard_snapshot(django_assert_num_queries, monkeypatch):
+    # Store each row in its own chunk
+    monkeypatch.setattr(
+        "grandchallenge.evaluation.leaderboard.LEADERBOARD_CHUNK_BYTES", 1
+    )
+
+    challenge = ChallengeFactory()
+    challenge.evaluation_config.score_jsonpath = "a"
+    challenge.evaluation_config.score_error_jsonpath = "a_err"
+    challenge.evaluation_config.score_decimal_places = 2
+    challenge.evaluation_config.scoring_method_choice = Config.MEAN
+    challenge.evaluation_config.extra_results_columns = [
+        {"title": "b", "path": "b", "order": Config.DESCENDING}
+    ]
+    challenge.evaluation_config.save()
+
+    with mute_signals(post_save):
+        results = (
+            ResultFactory(
+                challenge=challenge, metrics={"a": 0.5, "a_err": 0.1, "b": 1}
+            ),
+            ResultFactory(
+                challenge=challenge, metrics={"a": 0.7, "a_err": 0.2, "b": 2}
+            ),
+            # Not ranked
+            ResultFactory(challenge=challenge, metrics={"a": 0.9}),
+        )
+
+    update_result_metrics(challenge_pk=challenge.pk)
+    calculate_ranks(challenge_pk=challenge.pk)
+
+    # The snapshot is built by calculate_ranks
+    with django_assert_num_queries(0):
+        rows = get_leaderboard(challenge_pk=challenge.pk)
+
+    assert [r["pk"] for r in rows] == [results[1].pk, results[0].pk]
+    assert [r["rank"] for r in rows] == [1, 2]
+    assert [m["order"] for m in rows[0]["metrics"]] == [0.7, 2]
+    assert rows[0]["metrics"][0]["display"] == "0.70&nbsp;±&nbsp;0.20&nbsp;(1)"
+    assert rows[0]["metrics"][1]["display"] == "2.00&nbsp;(1)"
+    assert rows[0]["url"] == results[1].get_absolute_url()
+
+    # A snapshot with a missing chunk is rebuilt
+    version = cache.get(f"evaluation:leaderboard-version:{challenge.pk}")
+    cache.delete(f"evaluation:leaderboard:{challenge.pk}:{version}:1")
+
+    with django_assert_num_queries(4):
+        assert get_leaderboard(challenge_pk=challenge.pk) == rows
+
+    with django_assert_num_queries(0):
+        assert get_leaderboard(challenge_pk=challenge.pk) == rows
+
+    # A new version is rebuilt
+    with mute_signals(post_save):
+        results[1].published = False
+        results[1].save()
+
+    invalidate_leaderboard(challenge_pk=challenge.pk)
+
+    rows = get_leaderboard(challenge_pk=challenge.pk)
+    assert [r["pk"] for r in rows] == [results[0].pk]
+
+
+@pytest.mark.django_db
+def test_leaderboard_snapshot_is_invalidated():
+    challenge = ChallengeFactory()
+
+    with mute_signals(post_save):
+        challenge.evaluation_config.score_jsonpath = "acc"
+        challenge.evaluation_config.save()
+
+        result = ResultFactory(challenge=challenge, metrics={"acc": 0.5})
+
+    update_result_metrics(challenge_pk=challenge.pk)
+    calculate_ranks(challenge_pk=challenge.pk)
+
+    submission = result.job.submission
+    submission.comment = "New comment"
+    submission.save()
+
+    rows = get_leaderboard(challenge_pk=challenge.pk)
+    assert rows[0]["comment"] == "New comment"
+
+    user = submission.creator
+    user.username = "renamed_user"
+    user.save()
+
+    rows = get_leaderboard(challenge_pk=challenge.pk)
+    assert "renamed_user" in rows[0]["user_html"]
+
+    # Logging in does not change the leaderboard
+    version = cache.get(f"evaluation:leaderboard-version:{challenge.pk}")
+    user.save(update_fields=["last_login"])
+    assert (
+        cache.get(f"evaluation:leaderboard-version:{challenge.pk}") == version
+    )
+
+
+@pytest.mark.django_db
+def test_leaderboard_snapshot_is_not_partial(mocker):
+    challenge = ChallengeFactory()
+
+    with mute_signals(post_save):
+        challenge.evaluation_config.score_jsonpath = "acc"
+        challenge.evaluation_config.save()
+
+        ResultFactory(challenge=challenge, metrics={"acc": 0.5})
+
+    update_result_metrics(challenge_pk=challenge.pk)
+    calculate_ranks(challenge_pk=challenge.pk)
+
+    # A chunk is too large to be stored
+    mocker.patch.object(
+        cache, "set_many", side_effect=lambda data, *_, **__: list(data)
+    )
+    invalidate_leaderboard(challenge_pk=challenge.pk)
+    rows = get_leaderboard(challenge_pk=challenge.pk)
+
+    assert len(rows) == 1
+    assert _get_snapshot_header(challenge_pk=challenge.pk) is None
+
+
+def _get_snapshot_header(*, challenge_pk):
+    version = cache.get(f"evaluation:leaderboard-version:{challenge_pk}")
+    return cache.get(f"evaluation:leaderboard:{challenge_pk}:{version}")
+
+
+@pytest.mark.django_db
+def test_leaderboard_snapshot_is_patched(monkeypatch):
+    monkeypatch.setattr(
+        "grandchallenge.evaluation.leaderboard.LEADERBOARD_CHUNK_BYTES", 1
+    )
+
+    challenge = ChallengeFactory()
+
+    with mute_signals(post_save):
+        challenge.evaluation_config.score_jsonpath = "a"
+        challenge.evaluation_config.save()
+
+        results = [
+            ResultFactory(challenge=challenge, metrics={"a": a})
+            for a in (0.4, 0.3, 0.2, 0.1)
+        ]
+
+    update_result_metrics(challenge_pk=challenge.pk)
+    calculate_ranks(challenge_pk=challenge.pk)
+    header = _get_snapshot_header(challenge_pk=challenge.pk)
+    assert len(header) == 4
+
+    # The last two results swap places, so the first chunk is reused
+    with mute_signals(post_save):
+        results[3].metrics = {"a": 0.25}
+        results[3].save()
+
+    update_result_metrics(challenge_pk=challenge.pk, result_pk=results[3].pk)
+    update_rank(challenge_pk=challenge.pk, result_pk=results[3].pk)
+
+    rows = get_leaderboard(challenge_pk=challenge.pk)
+    assert [r["pk"] for r in rows] == [
+        results[0].pk,
+        results[1].pk,
+        results[3].pk,
+        results[2].pk,
+    ]
+    assert rows == build_leaderboard(challenge_pk=challenge.pk)
+
+    patched_header = _get_snapshot_header(challenge_pk=challenge.pk)
+    assert patched_header[0] == header[0]
+    assert patched_header[-1] != header[-1]
+
+    # All of the results move up when the first one is removed
+    with mute_signals(post_save):
+        results[0].published = False
+        results[0].save()
+
+    update_rank(challenge_pk=challenge.pk, result_pk=results[0].pk)
+
+    rows = get_leaderboard(challenge_pk=challenge.pk)
+    assert [r["rank"] for r in rows] == [1, 2, 3]
+    assert rows == build_leaderboard(challenge_pk=challenge.pk)
+
+
+def _get_all_pages(**kwargs):
+    rows = []
+    cursor = None
+
+    while True:
+        page = get_leaderboard_page(page_size=2, cursor=cursor, **kwargs)
+        rows += page.rows
+        cursor = page.next_cursor
+
+        if cursor is None:
+            return rows
+
+
+@pytest.mark.django_db
+def test_leaderboard_page(django_assert_num_queries, monkeypatch):
+    monkeypatch.setattr(
+        "grandchallenge.evaluation.leaderboard.LEADERBOARD_CHUNK_BYTES", 1
+    )
+
+    challenge = ChallengeFactory()
+    challenge.evaluation_config.score_jsonpath = "a"
+    challenge.evaluation_config.extra_results_columns = [
+        {"title": "b", "path": "b", "order": Config.DESCENDING}
+    ]
+    challenge.evaluation_config.save()
+
+    metrics = (
+        {"a": 0.5, "b": 3},
+        {"a": 0.1, "b": 2},
+        {"a": 0.5},
+        {"a": 0.7, "b": 2},
+        {"a": 0.3},
+        # Not ranked
+        {"b": 1},
+    )
+
+    with mute_signals(post_save):
+        results = [
+            ResultFactory(challenge=challenge, metrics=m) for m in metrics
+        ]
+
+    update_result_metrics(challenge_pk=challenge.pk)
+    calculate_ranks(challenge_pk=challenge.pk)
+
+    leaderboard = get_leaderboard(challenge_pk=challenge.pk)
+    assert [r["rank"] for r in leaderboard] == [1, 2, 2, 4, 5]
+
+    # The pages by rank are read from the snapshot
+    with django_assert_num_queries(0):
+        assert _get_all_pages(challenge_pk=challenge.pk) == leaderboard
+
+    assert _get_all_pages(challenge_pk=challenge.pk, descending=True) == (
+        sorted(leaderboard, key=lambda r: (r["rank"], r["pk"]), reverse=True)
+    )
+
+    # Results without a value for the metric are listed last
+    rows = _get_all_pages(challenge_pk=challenge.pk, sort="b", descending=True)
+    pks = [r["pk"] for r in rows]
+    assert pks[:3] == [
+        results[0].pk,
+        *sorted([results[1].pk, results[3].pk], reverse=True),
+    ]
+    assert set(pks[3:]) == {results[2].pk, results[4].pk}
+
+    rows = _get_all_pages(challenge_pk=challenge.pk, sort="b")
+    assert [r["pk"] for r in rows][:3] == [
+        *sorted([results[1].pk, results[3].pk]),
+        results[0].pk,
+    ]
+
+    with pytest.raises(ValueError):
+        get_leaderboard_page(challenge_pk=challenge.pk, cursor="invalid")
+
+
+@pytest.mark.django_db
+def test_export_leaderboard():
+    challenge = ChallengeFactory()
+    config = challenge.evaluation_config
+    config.score_jsonpath = "a.mean"
+    config.extra_results_columns = [
+        {
+            "title": "b",
+            "path": "b",
+            "error_path": "b_err",
+            "order": Config.DESCENDING,
+        }
+    ]
+    config.save()
+
+    with mute_signals(post_save):
+        results = (
+            ResultFactory(
+                challenge=challenge,
+                metrics={"a": {"mean": 0.5}, "b": 1, "b_err": 0.1},
+            ),
+            ResultFactory(
+                challenge=challenge, metrics={"a": {"mean": 0.7}, "b": 2}
+            ),
+            # Not ranked
+            ResultFactory(challenge=challenge, metrics={"b": 3}),
+        )
+
+    update_result_metrics(challenge_pk=challenge.pk)
+    calculate_ranks(challenge_pk=challenge.pk)
+
+    fields = get_export_fields(config=config)
+    assert fields == [
+        "pk",
+        "rank",
+        "rank_score",
+        "created",
+        "user",
+        "metrics.a.mean",
+        "metrics.b",
+        "metrics.b_err",
+        "metrics",
+    ]
+
+    records = list(export_leaderboard(challenge_pk=challenge.pk))
+    assert [r["pk"] for r in records] == [
+        str(results[1].pk),
+        str(results[0].pk),
+    ]
+    assert [r["metrics.b_err"] for r in records] == ["", 0.1]
+    assert records[1]["metrics"] == results[0].metrics
+
+    lines = list(
+        csv.DictReader(
+            "".join(
+                stream_csv(records=iter(records), fields=fields)
+            ).splitlines()
+        )
+    )
+    assert [l["metrics.a.mean"] for l in lines] == ["0.7", "0.5"]
+    assert json.loads(lines[1]["metrics"]) == results[0].metrics
+
+    ndjson = "".join(stream_ndjson(records=iter(records))).splitlines()
+    assert [json.loads(l) for l in ndjson] == json.loads(json.dumps(records))
@@ -1,6 +1,9 @@
 import pytest
+from django.db.models.signals import post_save
+from factory.django import mute_signals
 
-from tests.factories import ChallengeFactory, ResultFactory
+from grandchallenge.evaluation.models import Config, Result, ResultMetric
+from tests.factories import ChallengeFactory, ResultFactory, JobFactory
 
 
 @pytest.mark.django_db
@@ -21,3 +24,48 @@ def test_public_private_default():
     # The public/private status should only update on first save
     r1.save()
     assert r1.published == True
+
+
+@pytest.mark.django_db
+def test_result_metrics():
+    challenge = ChallengeFactory()
+    challenge.evaluation_config.score_jsonpath = "a.mean"
+    challenge.evaluation_config.save()
+
+    with mute_signals(post_save):
+        job = JobFactory(challenge=challenge, submission__challenge=challenge)
+
+    job.create_result(result={"a": {"mean": 0.5}, "b": 2, "c": "high"})
+
+    result = Result.objects.get(job=job)
+    assert list(result.metric_values.values_list("path", "value")) == [
+        ("a.mean", 0.5)
+    ]
+
+    # The other results are updated when the config changes
+    challenge.evaluation_config.extra_results_columns = [
+        {"title": "b", "path": "b", "order": Config.DESCENDING},
+        {"title": "c", "path": "c", "order": Config.DESCENDING},
+    ]
+    challenge.evaluation_config.save()
+
+    assert sorted(result.metric_values.values_list("path", "value")) == [
+        ("a.mean", 0.5),
+        ("b", 2.0),
+    ]
+    assert (
+        ResultMetric.objects.filter(challenge=challenge, path="b", value__gt=1)
+        .get()
+        .result
+        == result
+    )
+
+    # The values are refreshed when the metrics of the result change
+    result.metrics = {"a": {"mean": 0.7}, "b": None, "c": "n/a"}
+    result.save()
+
+    # A json null is stored so that it is ranked last
+    assert sorted(result.metric_values.values_list("path", "value")) == [
+        ("a.mean", 0.7),
+        ("b", None),
+    ]
@@ -1,12 +1,20 @@
+import uuid
 from pathlib import Path
 
 import docker
 import pytest
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 
 from grandchallenge.container_exec.tasks import validate_docker_image_async
 from grandchallenge.evaluation.models import Method
-from tests.factories import SubmissionFactory, MethodFactory
+from grandchallenge.evaluation.tasks import (
+    schedule_ranks_update,
+    get_ranks_update_stats,
+    process_ranks_update,
+)
+from tests.factories import ChallengeFactory, SubmissionFactory, MethodFactory
 
 
 @pytest.mark.django_db
@@ -115,3 +123,97 @@ def test_method_validation_not_a_docker_tar(submission_file):
     method = Method.objects.get(pk=method.pk)
     assert method.ready == False
     assert "manifest.json not found" in method.status
+
+
+def test_ranks_updates_are_merged(mocker):
+    process_ranks_update = mocker.patch(
+        "grandchallenge.evaluation.tasks.process_ranks_update"
+    )
+    challenge_pk = uuid.uuid4()
+
+    schedule_ranks_update(challenge_pk=challenge_pk, result_pk=uuid.uuid4())
+    schedule_ranks_update(challenge_pk=challenge_pk, result_pk=uuid.uuid4())
+    schedule_ranks_update(challenge_pk=challenge_pk)
+
+    assert process_ranks_update.apply_async.call_count == 1
+    assert get_ranks_update_stats(challenge_pk=challenge_pk) == {
+        "triggers": 3,
+        "scheduled": 1,
+        "merged": 2,
+    }
+
+
+def test_ranks_update_is_not_left_pending(mocker):
+    process_ranks_update = mocker.patch(
+        "grandchallenge.evaluation.tasks.process_ranks_update"
+    )
+    process_ranks_update.apply_async.side_effect = ConnectionError
+    challenge_pk = uuid.uuid4()
+
+    with pytest.raises(ConnectionError):
+        schedule_ranks_update(challenge_pk=challenge_pk)
+
+    # The next trigger schedules a new update rather than merging into it
+    process_ranks_update.apply_async.side_effect = None
+    schedule_ranks_update(challenge_pk=challenge_pk)
+
+    assert process_ranks_update.apply_async.call_count == 2
+    assert get_ranks_update_stats(challenge_pk=challenge_pk)["merged"] == 0
+
+
+def test_ranks_update_waits_for_the_running_update(mocker):
+    calculate_ranks = mocker.patch(
+        "grandchallenge.evaluation.tasks.calculate_ranks"
+    )
+    apply_async = mocker.patch(
+        "grandchallenge.evaluation.tasks.process_ranks_update.apply_async"
+    )
+    challenge_pk = uuid.uuid4()
+    lock_key = f"evaluation:ranks-lock:{challenge_pk}"
+
+    schedule_ranks_update(challenge_pk=challenge_pk)
+
+    # Another update is running, so the task does nothing
+    cache.add(lock_key, True)
+    process_ranks_update(challenge_pk=challenge_pk)
+    assert calculate_ranks.call_count == 0
+    assert apply_async.call_count == 1
+
+    # A trigger arrives while the update runs, so it is scheduled again
+    cache.delete(lock_key)
+    calculate_ranks.side_effect = lambda **_: schedule_ranks_update(
+        challenge_pk=challenge_pk
+    )
+    process_ranks_update(challenge_pk=challenge_pk)
+    assert calculate_ranks.call_count == 1
+    assert apply_async.call_count == 3
+
+    calculate_ranks.side_effect = None
+    process_ranks_update(challenge_pk=challenge_pk)
+    assert calculate_ranks.call_count == 2
+
+    # A duplicate task has nothing left to do
+    process_ranks_update(challenge_pk=challenge_pk)
+    assert calculate_ranks.call_count == 2
+    assert apply_async.call_count == 3
+
+
+@pytest.mark.django_db
+def test_ranks_update_stats_command(capsys, mocker):
+    mocker.patch("grandchallenge.evaluation.tasks.process_ranks_update")
+    challenge, _ = ChallengeFactory(), ChallengeFactory()
+
+    schedule_ranks_update(challenge_pk=challenge.pk)
+    schedule_ranks_update(challenge_pk=challenge.pk)
+    stats = get_ranks_update_stats(challenge_pk=challenge.pk)
+
+    call_command("ranksupdatestats", challenge.short_name)
+
+    out, _ = capsys.readouterr()
+
+    # Only the requested challenge is shown
+    assert out == (
+        f"{challenge.short_name}: triggers={stats['triggers']} "
+        f"scheduled={stats['scheduled']} merged={stats['merged']}\n"
+    )
+    assert stats["merged"] >= 1
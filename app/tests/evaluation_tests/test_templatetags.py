@@ -18,6 +18,19 @@ def test_get_jsonpath():
     assert get_jsonpath(obj=obj, jsonpath="") == ""
 
 
+def test_get_jsonpath_list_index():
+    obj = {"dice": [0.5, {"mean": 0.6}], "case": {"0": 0.7}}
+    assert get_jsonpath(obj=obj, jsonpath="dice.0") == 0.5
+    assert get_jsonpath(obj=obj, jsonpath="dice.1.mean") == 0.6
+    assert get_jsonpath(obj=obj, jsonpath="dice.-1.mean") == 0.6
+    # Integer keys of dictionaries are still strings
+    assert get_jsonpath(obj=obj, jsonpath="case.0") == 0.7
+    # Out of range, or indexing something that is not a container
+    assert get_jsonpath(obj=obj, jsonpath="dice.2") == ""
+    assert get_jsonpath(obj=obj, jsonpath="dice.0.mean") == ""
+    assert get_jsonpath(obj=obj, jsonpath="dice.mean") == ""
+
+
 def test_user_error():
     assert user_error(obj="foo\n") == "foo"
     assert user_error(obj="foo") == "foo"
@@ -1,8 +1,30 @@
+import uuid
+from functools import partial
+
+import numpy as np
 import pytest
+from django.core.cache import cache
 from django.db.models.signals import post_save
 from factory.django import mute_signals
 
-from grandchallenge.evaluation.models import Config
+from grandchallenge.evaluation.models import Config, Result
+from grandchallenge.evaluation.tasks import (
+    calculate_ranks,
+    update_rank,
+    rank_candidate,
+    load_ranking_index,
+    ranking_index_key,
+    store_ranking_index,
+    update_result_metrics,
+    _get_ranking_index_chunk_keys,
+)
+from grandchallenge.evaluation.utils import (
+    _scores_to_ranks,
+    query_metric_values,
+    Metric,
+    RankingIndex,
+    rank_values,
+)
 from tests.factories import ResultFactory, ChallengeFactory, UserFactory
 
 
@@ -209,6 +231,315 @@ def test_results_display(settings):
     assert_ranks(queryset, expected_ranks)
 
 
+@pytest.mark.django_db
+def test_update_rank():
+    challenge = ChallengeFactory()
+
+    with mute_signals(post_save):
+        challenge.evaluation_config.score_jsonpath = "a"
+        challenge.evaluation_config.save()
+
+        queryset = [
+            ResultFactory(challenge=challenge, metrics={"a": a})
+            for a in (0.1, 0.5, 0.3)
+        ]
+
+    update_result_metrics(challenge_pk=challenge.pk)
+    calculate_ranks(challenge_pk=challenge.pk)
+    assert_ranks(queryset, [3, 1, 2])
+
+    with mute_signals(post_save):
+        queryset.append(ResultFactory(challenge=challenge, metrics={"a": 0.4}))
+
+    update_result_metrics(challenge_pk=challenge.pk, result_pk=queryset[-1].pk)
+    update_rank(challenge_pk=challenge.pk, result_pk=queryset[-1].pk)
+    assert_ranks(queryset, [4, 1, 3, 2])
+
+    with mute_signals(post_save):
+        queryset[1].published = False
+        queryset[1].save()
+
+    update_rank(challenge_pk=challenge.pk, result_pk=queryset[1].pk)
+    assert_ranks(queryset, [3, 0, 2, 1])
+
+    with mute_signals(post_save):
+        queryset[0].metrics = {"b": 0.9}
+        queryset[0].save()
+
+    update_result_metrics(challenge_pk=challenge.pk, result_pk=queryset[0].pk)
+    update_rank(challenge_pk=challenge.pk, result_pk=queryset[0].pk)
+    assert_ranks(queryset, [0, 0, 2, 1])
+
+
+@pytest.mark.django_db
+def test_calculate_ranks_with_a_string_metric():
+    challenge = ChallengeFactory()
+
+    with mute_signals(post_save):
+        challenge.evaluation_config.score_jsonpath = "a"
+        challenge.evaluation_config.save()
+
+        queryset = [
+            ResultFactory(challenge=challenge, metrics={"a": a})
+            for a in (0.5, "high", 0.7)
+        ]
+
+    update_result_metrics(challenge_pk=challenge.pk)
+
+    # The result with a string value is not ranked, as if it was missing
+    calculate_ranks(challenge_pk=challenge.pk)
+    assert_ranks(queryset, [2, 0, 1])
+
+
+@pytest.mark.parametrize("score_method", (np.mean, np.median))
+def test_ranking_index_rank_candidate(score_method):
+    metrics = (Metric(path="a", reverse=True), Metric(path="b", reverse=False))
+    score_method = partial(score_method, axis=1)
+
+    rng = np.random.RandomState(42)
+    # Round the values so that the candidates tie with some of the results
+    values = rng.rand(50, 2).round(1)
+    values[3, 0] = np.nan
+
+    index = RankingIndex(metrics=metrics, score_method_choice=Config.MEAN)
+    index.add_values(pks=list(range(len(values))), values=values)
+
+    for candidate in rng.rand(20, 2).round(1):
+        rank, rank_score, rank_per_metric = index.rank_candidate(
+            metrics={"a": candidate[0], "b": candidate[1]},
+            score_method=score_method,
+        )
+
+        # Compare with ranking all of the results including the candidate
+        positions = rank_values(
+            pks=[*range(len(values)), "candidate"],
+            values=np.vstack([values, candidate]),
+            metrics=metrics,
+            score_method=score_method,
+        )
+
+        assert rank == positions.ranks["candidate"]
+        assert rank_score == positions.rank_scores["candidate"]
+        assert rank_per_metric == positions.rank_per_metric["candidate"]
+
+    # The index is not changed
+    assert len(index) == len(values)
+
+    # Candidates that are missing a metric are not ranked
+    assert (
+        index.rank_candidate(metrics={"a": 0.5}, score_method=score_method)
+        is None
+    )
+
+    with pytest.raises(ValueError):
+        index.rank_candidate(
+            metrics={"a": 0.5, "b": [0.1]}, score_method=score_method
+        )
+
+
+def test_ranking_index_is_stored_in_chunks():
+    challenge_pk = uuid.uuid4()
+    metrics = tuple(
+        Metric(path=f"m{i}", reverse=bool(i % 2)) for i in range(10)
+    )
+    score_method = partial(np.mean, axis=1)
+
+    # Too large to be stored as a single memcached item
+    rng = np.random.RandomState(42)
+    pks = [uuid.uuid4() for _ in range(20000)]
+    creators = [None, *rng.randint(1, 1000, len(pks) - 1).tolist()]
+    keys = rng.rand(len(pks), len(metrics)).round(2)
+    keys[0, 0] = np.inf
+
+    index = RankingIndex.from_arrays(
+        metrics=metrics,
+        score_method_choice=Config.MEAN,
+        display_choice=Config.BEST,
+        pks=pks,
+        creators=creators,
+        keys=keys,
+    )
+    store_ranking_index(challenge_pk=challenge_pk, index=index)
+
+    header = cache.get(ranking_index_key(challenge_pk=challenge_pk))
+    assert header["chunks"] > 1
+
+    loaded = load_ranking_index(challenge_pk=challenge_pk)
+    assert loaded.matches(
+        metrics=metrics,
+        score_method_choice=Config.MEAN,
+        display_choice=Config.BEST,
+    )
+    loaded_pks, loaded_creators, loaded_keys = loaded.to_arrays()
+    assert loaded_pks == pks
+    assert loaded_creators == creators
+    np.testing.assert_array_equal(loaded_keys, keys)
+    assert loaded.rank(score_method=score_method) == index.rank(
+        score_method=score_method
+    )
+
+    # The chunks of the previous version are removed
+    loaded.remove_result(pk=pks[0])
+    store_ranking_index(challenge_pk=challenge_pk, index=loaded)
+    assert not cache.get_many(
+        _get_ranking_index_chunk_keys(challenge_pk=challenge_pk, header=header)
+    )
+    assert len(load_ranking_index(challenge_pk=challenge_pk)) == len(pks) - 1
+
+    # The index is not used if any of its chunks is missing
+    header = cache.get(ranking_index_key(challenge_pk=challenge_pk))
+    cache.delete(
+        _get_ranking_index_chunk_keys(
+            challenge_pk=challenge_pk, header=header
+        )[0]
+    )
+    assert load_ranking_index(challenge_pk=challenge_pk) is None
+
+
+@pytest.mark.django_db
+def test_rank_candidate(django_assert_num_queries):
+    challenge = ChallengeFactory()
+
+    with mute_signals(post_save):
+        challenge.evaluation_config.score_jsonpath = "a"
+        challenge.evaluation_config.save()
+
+        user = UserFactory()
+        queryset = [
+            ResultFactory(
+                challenge=challenge,
+                metrics={"a": a},
+                job__submission__creator=user,
+            )
+            for a in (0.1, 0.5, 0.3)
+        ]
+
+    update_result_metrics(challenge_pk=challenge.pk)
+    calculate_ranks(challenge_pk=challenge.pk)
+
+    config = Config.objects.get(challenge=challenge)
+
+    # The cached index is used
+    with django_assert_num_queries(0):
+        assert rank_candidate(config=config, metrics={"a": 0.4}) == {
+            "rank": 2,
+            "rank_score": 2.0,
+            "rank_per_metric": {"a": 2},
+        }
+
+    assert rank_candidate(config=config, metrics={"b": 0.4})["rank"] == 0
+
+    # Nothing is written
+    assert Result.objects.filter(challenge=challenge).count() == 3
+    assert_ranks(queryset, [3, 1, 2])
+
+    # Only the displayed results are used
+    with mute_signals(post_save):
+        config.result_display_choice = Config.MOST_RECENT
+        config.save()
+
+    calculate_ranks(challenge_pk=challenge.pk)
+    assert_ranks(queryset, [0, 0, 1])
+
+    assert rank_candidate(config=config, metrics={"a": 0.2})["rank"] == 2
+
+    with mute_signals(post_save):
+        ResultFactory(challenge=challenge, metrics={"a": 0.25})
+
+    update_result_metrics(challenge_pk=challenge.pk)
+    calculate_ranks(challenge_pk=challenge.pk)
+
+    # The index of the displayed results is cached for every display choice
+    with django_assert_num_queries(0):
+        assert rank_candidate(config=config, metrics={"a": 0.2})["rank"] == 3
+
+        # The candidate takes the place of the result shown for its creator
+        position = rank_candidate(
+            config=config, metrics={"a": 0.2}, creator=user.pk
+        )
+        assert position["rank"] == 2
+
+    with mute_signals(post_save):
+        config.result_display_choice = Config.BEST
+        config.save()
+
+    calculate_ranks(challenge_pk=challenge.pk)
+    assert_ranks(queryset, [0, 1, 0])
+
+    # A rebuilt index is cached
+    cache.delete(ranking_index_key(challenge_pk=challenge.pk))
+    rank_candidate(config=config, metrics={"a": 0.2})
+
+    with django_assert_num_queries(0):
+        # A worse candidate is ranked alongside the best result of its creator
+        position = rank_candidate(
+            config=config, metrics={"a": 0.2}, creator=user.pk
+        )
+        assert position["rank"] == 3
+
+        # A better candidate takes the place of the best result
+        position = rank_candidate(
+            config=config, metrics={"a": 0.6}, creator=user.pk
+        )
+        assert position["rank"] == 1
+
+
+@pytest.mark.django_db
+def test_query_metric_values():
+    challenge = ChallengeFactory()
+
+    with mute_signals(post_save):
+        challenge.evaluation_config.score_jsonpath = "a.b"
+        challenge.evaluation_config.save()
+
+        queryset = (
+            ResultFactory(challenge=challenge, metrics={"a": {"b": 0.5}}),
+            ResultFactory(challenge=challenge, metrics={"a": {"b": None}}),
+            # Invalid as the value is missing
+            ResultFactory(challenge=challenge, metrics={"a": 0.1}),
+            # Invalid as the value is not a number
+            ResultFactory(challenge=challenge, metrics={"a": {"b": "high"}}),
+        )
+
+    update_result_metrics(challenge_pk=challenge.pk)
+
+    values = query_metric_values(
+        challenge_pk=challenge.pk,
+        results=Result.objects.filter(challenge=challenge).order_by("created"),
+        metrics=(Metric(path="a.b", reverse=False),),
+    )
+
+    assert values.pks == [queryset[0].pk, queryset[1].pk]
+    assert values.creators == [
+        r.job.submission.creator.pk for r in queryset[:2]
+    ]
+    assert values.values.shape == (2, 1)
+    assert values.values[0, 0] == 0.5
+    assert np.isnan(values.values[1, 0])
+
+
+@pytest.mark.parametrize(
+    "scores,reverse,expected",
+    (
+        ([], False, []),
+        ([0.5], False, [1]),
+        ([0.1, 0.3, 0.2], False, [1, 3, 2]),
+        ([0.1, 0.3, 0.2], True, [3, 1, 2]),
+        # Ties share a rank and the following rank is skipped
+        ([1.0, 0.5, 1.0, 0.2], True, [1, 3, 1, 4]),
+        ([1.0, 0.5, 1.0, 0.2], False, [3, 2, 3, 1]),
+        # Missing values are always ranked last
+        ([np.nan, 0.5, 0.7], True, [3, 2, 1]),
+        ([np.nan, 0.5, np.nan], False, [2, 1, 2]),
+    ),
+)
+def test_scores_to_ranks(scores, reverse, expected):
+    assert (
+        _scores_to_ranks(scores=np.array(scores), reverse=reverse).tolist()
+        == expected
+    )
+
+
 def assert_ranks(queryset, expected_ranks, expected_rank_scores=None):
     for r in queryset:
         r.refresh_from_db()
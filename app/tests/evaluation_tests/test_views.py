@@ -4,13 +4,22 @@ from datetime import timedelta
 import factory
 import pytest
 from django.db.models import signals
+from django.test import Client
 from django.utils import timezone
+from rest_framework.authtoken.models import Token
 
+from grandchallenge.evaluation.models import Config, Result
+from grandchallenge.evaluation.tasks import (
+    calculate_ranks,
+    update_result_metrics,
+)
 from tests.factories import (
+    ChallengeFactory,
     MethodFactory,
     SubmissionFactory,
     JobFactory,
     ResultFactory,
+    UserFactory,
 )
 
 # TODO: Test creation with forms.
@@ -335,6 +344,178 @@ def test_result_list(client, EvalChallengeSet):
     )
 
 
+@pytest.mark.django_db
+def test_result_export(client, EvalChallengeSet):
+    validate_open_view(
+        viewname="evaluation:result-export",
+        challenge_set=EvalChallengeSet.ChallengeSet,
+        client=client,
+    )
+
+
+@pytest.mark.django_db
+def test_result_export_content(client):
+    challenge = ChallengeFactory()
+    challenge.evaluation_config.score_jsonpath = "acc"
+    challenge.evaluation_config.save()
+
+    with factory.django.mute_signals(signals.post_save):
+        results = [
+            ResultFactory(challenge=challenge, metrics={"acc": 0.5}),
+            ResultFactory(challenge=challenge, metrics={"acc": 0.7}),
+        ]
+
+    update_result_metrics(challenge_pk=challenge.pk)
+    calculate_ranks(challenge_pk=challenge.pk)
+
+    response = get_view_for_user(
+        viewname="evaluation:result-list", challenge=challenge, client=client
+    )
+    assert response.status_code == 200
+    assert str(results[0].pk) in response.rendered_content
+
+    response = get_view_for_user(
+        viewname="evaluation:result-list",
+        challenge=challenge,
+        client=client,
+        data={"sort": "acc", "order": "asc"},
+    )
+    assert response.status_code == 200
+    assert [r["pk"] for r in response.context["object_list"]] == [
+        results[0].pk,
+        results[1].pk,
+    ]
+
+    for data in ({"sort": "unknown"}, {"cursor": "invalid"}):
+        response = get_view_for_user(
+            viewname="evaluation:result-list",
+            challenge=challenge,
+            client=client,
+            data=data,
+        )
+        assert response.status_code == 404
+
+    response = get_view_for_user(
+        viewname="evaluation:result-export",
+        challenge=challenge,
+        client=client,
+        data={"format": "ndjson"},
+    )
+    assert response.status_code == 200
+    assert response["Content-Type"] == "application/x-ndjson"
+    lines = b"".join(response.streaming_content).decode().splitlines()
+    assert len(lines) == 2
+    assert str(results[1].pk) in lines[0]
+
+    response = get_view_for_user(
+        viewname="evaluation:result-export",
+        challenge=challenge,
+        client=client,
+        data={"format": "xml"},
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_result_what_if(client):
+    challenge = ChallengeFactory()
+    challenge.evaluation_config.score_jsonpath = "acc"
+    challenge.evaluation_config.score_default_sort = Config.DESCENDING
+    challenge.evaluation_config.save()
+
+    with factory.django.mute_signals(signals.post_save):
+        for acc in (0.5, 0.7):
+            ResultFactory(challenge=challenge, metrics={"acc": acc})
+
+    update_result_metrics(challenge_pk=challenge.pk)
+    calculate_ranks(challenge_pk=challenge.pk)
+
+    participant = UserFactory()
+    challenge.add_participant(participant)
+
+    def what_if(*, user, data):
+        return get_view_for_user(
+            viewname="evaluation:result-what-if",
+            challenge=challenge,
+            client=client,
+            method=client.post,
+            user=user,
+            data=data,
+            content_type="application/json",
+        )
+
+    response = what_if(user=UserFactory(), data={"acc": 0.6})
+    assert response.status_code == 403
+
+    response = what_if(user=participant, data={"acc": 0.6})
+    assert response.status_code == 200
+    assert response.json() == {
+        "rank": 2,
+        "rank_score": 2.0,
+        "rank_per_metric": {"acc": 2},
+    }
+    # Nothing is created
+    assert Result.objects.filter(challenge=challenge).count() == 2
+
+    response = what_if(user=participant, data="{not json")
+    assert response.status_code == 400
+
+    response = what_if(user=participant, data={"acc": "high"})
+    assert response.status_code == 400
+
+    # Scripts can use an api token, without a csrf token
+    token = Token.objects.create(user=participant)
+    token_client = Client(enforce_csrf_checks=True)
+    response = get_view_for_user(
+        viewname="evaluation:result-what-if",
+        challenge=challenge,
+        client=token_client,
+        method=token_client.post,
+        data={"acc": 0.6},
+        content_type="application/json",
+        HTTP_AUTHORIZATION=f"Token {token.key}",
+    )
+    assert response.status_code == 200
+    assert response.json()["rank"] == 2
+
+
+@pytest.mark.django_db
+def test_result_what_if_replaces_own_result(client):
+    challenge = ChallengeFactory()
+    challenge.evaluation_config.score_jsonpath = "acc"
+    challenge.evaluation_config.score_default_sort = Config.DESCENDING
+    challenge.evaluation_config.result_display_choice = Config.MOST_RECENT
+    challenge.evaluation_config.save()
+
+    participant = UserFactory()
+    challenge.add_participant(participant)
+
+    with factory.django.mute_signals(signals.post_save):
+        ResultFactory(challenge=challenge, metrics={"acc": 0.5})
+        ResultFactory(
+            challenge=challenge,
+            metrics={"acc": 0.7},
+            job__submission__creator=participant,
+        )
+
+    update_result_metrics(challenge_pk=challenge.pk)
+    calculate_ranks(challenge_pk=challenge.pk)
+
+    response = get_view_for_user(
+        viewname="evaluation:result-what-if",
+        challenge=challenge,
+        client=client,
+        method=client.post,
+        user=participant,
+        data={"acc": 0.6},
+        content_type="application/json",
+    )
+
+    # The candidate replaces the result that is shown for the participant
+    assert response.status_code == 200
+    assert response.json()["rank"] == 1
+
+
 # TODO: test that private results cannot be seen
 @pytest.mark.django_db
 def test_result_detail(client, EvalChallengeSet):
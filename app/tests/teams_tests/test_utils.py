@@ -0,0 +1,42 @@
+import pytest
+
+from grandchallenge.teams.utils import get_team_map
+from tests.factories import TeamFactory, TeamMemberFactory, UserFactory
+
+
+@pytest.mark.django_db
+def test_team_map(django_assert_num_queries):
+    team = TeamFactory(owner=UserFactory())
+    other_team = TeamFactory(owner=UserFactory())
+    member = UserFactory()
+    TeamMemberFactory(team=team, user=member)
+
+    with django_assert_num_queries(1):
+        team_map = get_team_map(challenge_pk=team.challenge.pk)
+
+    assert set(team_map) == {team.owner.pk, member.pk}
+    assert team_map[member.pk] == {
+        "name": team.name,
+        "url": team.get_absolute_url(),
+    }
+    assert other_team.owner.pk not in team_map
+
+    # The map is cached
+    with django_assert_num_queries(0):
+        assert get_team_map(challenge_pk=team.challenge.pk) == team_map
+
+    # Changes to the teams or members invalidate the map
+    team.name = "renamed"
+    team.save()
+    team_map = get_team_map(challenge_pk=team.challenge.pk)
+    assert team_map[member.pk]["name"] == "renamed"
+
+    new_member = UserFactory()
+    tm = TeamMemberFactory(team=team, user=new_member)
+    assert new_member.pk in get_team_map(challenge_pk=team.challenge.pk)
+
+    tm.delete()
+    assert new_member.pk not in get_team_map(challenge_pk=team.challenge.pk)
+
+    team.delete()
+    assert get_team_map(challenge_pk=team.challenge.pk) == {}